@@ -85,6 +85,7 @@ class Answerfile:
         results.update(self.parseDriverSource())
         results.update(self.parseFCoEInterface())
         results.update(self.parseUIConfirmationPrompt())
+        results['profile-commands'] = getBoolAttribute(self.top_node, ['profile-commands'], default=False)
 
         return results
 
@@ -355,6 +356,22 @@ class Answerfile:
             guest_disks.add(primary_disk)
         for node in getElementsByTagName(self.top_node, ['guest-disk']):
             guest_disks.add(normalize_disk(getText(node)))
+
+        # Check the disks against the inventory the disk screens use, which
+        # log_available_disks has just built
+        inventory = diskutil.getDiskInventory()
+        raid_members = inventory.raidMembers()
+        for disk in sorted(guest_disks & raid_members):
+            # as the guest disk screen does, keep RAID members out of the SR
+            logger.log("Warning: not using %s for guest storage, it is a member of a RAID array" % disk)
+            guest_disks.discard(disk)
+        for disk in [primary_disk] + sorted(guest_disks - set([primary_disk])):
+            info = inventory.get(disk)
+            if info:
+                logger.log("Disk %s: %s" % (disk, info.entryText()))
+            else:
+                logger.log("Warning: disk %s was not found" % disk)
+
         results['sr-on-primary'] = results['primary-disk'] in guest_disks
         results['guest-disks'] = list(guest_disks)
 
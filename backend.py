@@ -31,6 +31,7 @@ import hardware
 import upgrade
 import init_constants
 import scripts
+import cmdprofile
 import xcp.bootloader as bootloader
 import netinterface
 import tui.repo
@@ -74,7 +75,7 @@ class Task:
         self.pass_progress_callback = pass_progress_callback
         self.progress_text = progress_text
 
-    def execute(self, answers, progress_callback=lambda x: ()):
+    def execute(self, answers, progress_callback=lambda x, text=None: ()):
         args = self.args(answers)
         assert type(args) == list
 
@@ -86,6 +87,7 @@ class Task:
         if self.pass_progress_callback:
             args.insert(0, progress_callback)
 
+        cmdprofile.setPhase(self.fn.__name__)
         rv = apply(self.fn, args)
         if type(rv) is not tuple:
             rv = (rv,)
@@ -258,9 +260,9 @@ def executeSequence(sequence, seq_name, answers, ui, cleanup):
             except:
                 logger.log("FAILED to perform cleanup action %s" % tag)
 
-    def progressCallback(x):
+    def progressCallback(x, text=None):
         if ui:
-            ui.progress.displayProgressDialog(current + x, pd)
+            ui.progress.displayProgressDialog(current + x, pd, updated_text=text)
 
     try:
         current = 0
@@ -630,6 +632,7 @@ def removeBlockingVGs(disks):
         util.runCmd2(['vgreduce', '--removemissing', vg])
         util.runCmd2(['lvremove', vg])
         util.runCmd2(['vgremove', vg])
+    invalidateLVMSnapshot()
 
 ###
 # Functions to write partition tables to disk
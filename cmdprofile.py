@@ -0,0 +1,185 @@
+# Copyright (c) Citrix Systems 2009.  All rights reserved.
+# Xen, the Xen logo, XenCenter, XenMotion are trademarks or registered
+# trademarks of Citrix Systems, Inc., in the United States and other
+# countries.
+
+###
+#
+# Opt-in profiling of the external commands the installer runs.  Once
+# enabled, every process started through subprocess.Popen (and so
+# util.runCmd2) or os.system is recorded when it exits, and collectLogs
+# adds a summary and a Chrome trace (chrome://tracing, Perfetto) of them to
+# the support tarball.
+#
+###
+
+import os
+import sys
+import time
+import threading
+import subprocess
+import simplejson as json
+from xcp import logger
+
+REPORT_FILE = 'command-profile-log'
+TRACE_FILE = 'command-trace.json'
+# Number of commands listed in each table of the report
+REPORT_TOP = 30
+
+_lock = threading.Lock()
+_enabled = False
+_records = []
+_phase = 'startup'
+_started = time.time()
+
+_real_popen = subprocess.Popen
+_real_system = os.system
+
+class Record:
+    def __init__(self, command, caller, phase, thread, start, duration, rc, output_bytes):
+        self.command = command
+        self.caller = caller
+        self.phase = phase
+        self.thread = thread
+        self.start = start
+        self.duration = duration
+        self.rc = rc
+        self.output_bytes = output_bytes
+
+def _commandName(args):
+    if isinstance(args, basestring):
+        args = args.split()
+    return args and os.path.basename(args[0]) or '?'
+
+def _caller():
+    """Returns module.function of the code that ran the command"""
+    frame = sys._getframe(1)
+    while frame:
+        code = frame.f_code
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        if module not in ('cmdprofile', 'subprocess') and \
+                not (module == 'util' and code.co_name in ('runCmd2', 'runCmdStream')):
+            return "%s.%s" % (module, code.co_name)
+        frame = frame.f_back
+    return '?'
+
+def _record(command, caller, phase, thread, start, rc, output_bytes=None):
+    record = Record(command, caller, phase, thread, start, time.time() - start, rc, output_bytes)
+    _lock.acquire()
+    try:
+        _records.append(record)
+    finally:
+        _lock.release()
+
+class ProfiledPopen(_real_popen):
+    """subprocess.Popen recording the process when it is reaped.  Callers
+    that read its output may set output_bytes before waiting for it."""
+    def __init__(self, args, *rest, **kwargs):
+        self.profile_command = _commandName(args)
+        self.profile_caller = _caller()
+        self.profile_phase = _phase
+        self.profile_thread = threading.current_thread().name
+        self.profile_start = time.time()
+        self.output_bytes = None
+        _real_popen.__init__(self, args, *rest, **kwargs)
+
+    def _handle_exitstatus(self, sts, *rest):
+        _real_popen._handle_exitstatus(self, sts, *rest)
+        _record(self.profile_command, self.profile_caller, self.profile_phase, self.profile_thread,
+                self.profile_start, self.returncode, self.output_bytes)
+
+def _system(command):
+    caller = _caller()
+    phase = _phase
+    start = time.time()
+    status = _real_system(command)
+    _record(_commandName(command), caller, phase, threading.current_thread().name, start, status >> 8)
+    return status
+
+def enable():
+    """Starts recording commands, from now on"""
+    global _enabled
+    if _enabled:
+        return
+    _enabled = True
+    subprocess.Popen = ProfiledPopen
+    os.system = _system
+    logger.log("Profiling external commands")
+
+def enabled():
+    return _enabled
+
+def setPhase(phase):
+    """Attributes the commands run from now on to phase"""
+    global _phase
+    _phase = phase
+
+def _totals(records, key):
+    totals = {}
+    for record in records:
+        count, seconds = totals.get(key(record), (0, 0))
+        totals[key(record)] = (count + 1, seconds + record.duration)
+    return sorted(totals.items(), key=lambda item: item[1][1], reverse=True)
+
+def report():
+    """Returns a summary of the commands recorded as text"""
+    _lock.acquire()
+    try:
+        records = list(_records)
+    finally:
+        _lock.release()
+    lines = ["%d commands, %.2fs in total" % (len(records), sum([r.duration for r in records]))]
+
+    for title, key in (("command", lambda r: r.command),
+                       ("phase", lambda r: r.phase),
+                       ("phase and command", lambda r: "%s: %s" % (r.phase, r.command)),
+                       ("caller", lambda r: "%s: %s" % (r.caller, r.command))):
+        lines += ["", "Time by %s:" % title, "%10s %6s  %s" % ("seconds", "count", title)]
+        for name, (count, seconds) in _totals(records, key)[:REPORT_TOP]:
+            lines.append("%10.2f %6d  %s" % (seconds, count, name))
+
+    lines += ["", "Slowest commands:", "%10s %4s %10s  %s" % ("seconds", "rc", "output", "command")]
+    for r in sorted(records, key=lambda r: r.duration, reverse=True)[:REPORT_TOP]:
+        output = r.output_bytes is not None and str(r.output_bytes) or '-'
+        lines.append("%10.2f %4s %10s  %s from %s in %s" % (r.duration, r.rc, output, r.command, r.caller, r.phase))
+    return "\n".join(lines) + "\n"
+
+def trace():
+    """Returns the commands recorded in the Chrome trace event format"""
+    _lock.acquire()
+    try:
+        records = list(_records)
+    finally:
+        _lock.release()
+    threads = {}
+    events = []
+    for r in records:
+        tid = threads.setdefault(r.thread, len(threads) + 1)
+        events.append({
+            'name': r.command,
+            'cat': r.phase,
+            'ph': 'X',
+            'ts': int((r.start - _started) * 1000000),
+            'dur': int(r.duration * 1000000),
+            'pid': 1,
+            'tid': tid,
+            'args': {'caller': r.caller, 'rc': r.rc, 'output_bytes': r.output_bytes},
+            })
+    for name, tid in threads.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': name}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def writeReport(directory):
+    """Writes the report and trace into directory, if profiling is enabled"""
+    if not _enabled:
+        return
+    fd = open(os.path.join(directory, REPORT_FILE), 'w')
+    try:
+        fd.write(report())
+    finally:
+        fd.close()
+    fd = open(os.path.join(directory, TRACE_FILE), 'w')
+    try:
+        json.dump(trace(), fd)
+    finally:
+        fd.close()
@@ -133,6 +133,7 @@ ANSWERFILE_PATH = '/tmp/answerfile'
 ANSWERFILE_GENERATOR_PATH = '/tmp/answerfile_generator'
 SCRIPTS_DIR = "/tmp/scripts"
 EXTRA_SCRIPTS_DIR = "/tmp/extra-scripts"
+SCAN_CACHE_FILE = '/tmp/install-scan-cache.json'
 defaults_data_file = '/opt/xensource/installer/defaults.json'
 SYSFS_IBFT_DIR = "/sys/firmware/ibft"
 
@@ -47,6 +47,8 @@ import errno
 import time
 import struct
 import copy
+import threading
+import Queue
 
 if sys.platform == 'mac':
     # This module needs work for MacOS9, especially in the area of pathname
@@ -60,6 +62,11 @@ try:
 except ImportError:
     grp = pwd = None
 
+try:
+    import ctypes, ctypes.util
+except ImportError:
+    ctypes = None
+
 # from cpiofile import *
 __all__ = ["CpioFile", "CpioInfo", "is_cpiofile", "CpioError"]
 
@@ -72,6 +79,7 @@ WORDSIZE        = 4                  # pad size
 NUL             = "\0"               # the null character
 BLOCKSIZE       = 512                # length of processing blocks
 HEADERSIZE_SVR4 = 110                # length of fixed header
+SPARSE_BLOCKSIZE = 4096              # granularity of holes on extraction
 
 #---------------------------------------------------------
 # Bits used in the mode field, values in octal.
@@ -126,6 +134,46 @@ def copyfileobj(src, dst, length=None):
         dst.write(buf)
     return
 
+_libc = None
+
+def fallocate(fd, length):
+    """Reserve length bytes of disk space for the file open on fd.
+       This is only a hint to the filesystem, so it silently does
+       nothing where posix_fallocate() is not available.
+    """
+    global _libc
+    if length <= 0:
+        return
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, length)
+        except EnvironmentError:
+            pass
+        return
+    if ctypes is None:
+        return
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        except (OSError, TypeError):
+            _libc = False
+    if not _libc or not hasattr(_libc, "posix_fallocate64"):
+        return
+    # The return value is an error number; failure is harmless here.
+    _libc.posix_fallocate64(fd, ctypes.c_longlong(0), ctypes.c_longlong(length))
+
+def writezeros(dst, length):
+    """Write length NUL bytes to fileobj dst.
+    """
+    BUFSIZE = 16 * 1024
+    blocks, remainder = divmod(length, BUFSIZE)
+    if blocks:
+        buf = NUL * BUFSIZE
+        for b in xrange(blocks):
+            dst.write(buf)
+    if remainder:
+        dst.write(NUL * remainder)
+
 filemode_table = (
     ((S_IFLNK,      "l"),
      (S_IFREG,      "-"),
@@ -527,6 +575,92 @@ class _BZ2Proxy(object):
         self.fileobj.close()
 # class _BZ2Proxy
 
+#------------------
+# Sparse file maps
+#------------------
+class _section:
+    """A base class for _data and _hole.
+    """
+
+    def __init__(self, offset, size):
+        self.offset = offset
+        self.size = size
+
+    def __contains__(self, offset):
+        return self.offset <= offset < self.offset + self.size
+
+class _data(_section):
+    """Represent a data section in a sparse file.
+    """
+
+    def __init__(self, offset, size, realpos):
+        _section.__init__(self, offset, size)
+        self.realpos = realpos
+
+class _hole(_section):
+    """Represent a hole section in a sparse file.
+    """
+    pass
+
+class _ringbuffer(list):
+    """Ringbuffer class which increases performance
+       over a regular list.
+    """
+
+    def __init__(self):
+        self.idx = 0
+
+    def find(self, offset):
+        idx = self.idx
+        while True:
+            item = self[idx]
+            if offset in item:
+                break
+            idx += 1
+            if idx == len(self):
+                idx = 0
+            if idx == self.idx:
+                # End of File
+                return None
+        self.idx = idx
+        return item
+
+def sparsemap(fd, size):
+    """Return a _ringbuffer of the _data and _hole sections of the
+       first size bytes of the file open on fd, using SEEK_DATA and
+       SEEK_HOLE. Return None if the file has no holes or the platform
+       or filesystem cannot tell.
+    """
+    sections = _ringbuffer()
+    offset = 0
+    try:
+        try:
+            while offset < size:
+                try:
+                    start = os.lseek(fd, offset, SEEK_DATA)
+                except OSError as e:
+                    if e.errno != errno.ENXIO:
+                        raise
+                    # Nothing but a hole up to the end of the file.
+                    start = size
+                start = min(start, size)
+                if start > offset:
+                    sections.append(_hole(offset, start - offset))
+                if start == size:
+                    break
+                end = min(os.lseek(fd, start, SEEK_HOLE), size)
+                sections.append(_data(start, end - start, start))
+                offset = end
+        finally:
+            os.lseek(fd, 0, SEEK_SET)
+    except OSError:
+        return None
+
+    for section in sections:
+        if isinstance(section, _hole):
+            return sections
+    return None
+
 #------------------------
 # Extraction file object
 #------------------------
@@ -608,6 +742,8 @@ class _FileInFile(object):
 SEEK_SET = 0
 SEEK_CUR = 1
 SEEK_END = 2
+SEEK_DATA = getattr(os, "SEEK_DATA", 3)     # Linux values
+SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
 
 class ExFileObject(object):
     """File-like object for reading an archive member.
@@ -849,7 +985,7 @@ class CpioInfo(object):
     def isfifo(self):
         return stat.S_ISFIFO(self.mode)
     def issparse(self):
-        return False
+        return getattr(self, "sparse", None) is not None
     def isdev(self):
         return (stat.S_ISCHR(self.mode) or stat.S_ISBLK(self.mode))
 # class CpioInfo
@@ -872,6 +1008,21 @@ class CpioFile(object):
 
     fileobject = ExFileObject
 
+    pipeline_depth = 64         # Number of files that the reader may queue
+                                # ahead of the writers in extractall().
+
+    pipeline_bufsize = 1024 * 1024
+                                # Files up to this size are handed to a writer
+                                # in one piece, larger ones are streamed.
+
+    fallocate_threshold = 1024 * 1024
+                                # Preallocate extracted files of at least
+                                # this size.
+
+    sparse = False              # If true, runs of zeros in extracted files
+                                # are skipped over, leaving holes, and the
+                                # files are not preallocated.
+
     def __init__(self, name=None, mode="r", fileobj=None):
         """Open an (uncompressed) cpio archive `name'. `mode' is either 'r' to
            read from an existing archive, 'a' to append data to an existing
@@ -907,6 +1058,7 @@ class CpioFile(object):
         self.offset = 0L        # current position in the archive file
         self.inodes = {}        # dictionary caching the inodes of
                                 # archive members already added
+        self._owners = {}       # cache of (uid, gid) lookups for chown()
 
         if self._mode == "r":
             self.firstmember = None
@@ -1257,6 +1409,7 @@ class CpioFile(object):
         # Append the cpio header and data to the archive.
         if cpioinfo.isreg():
             f = file(name, "rb")
+            cpioinfo.sparse = sparsemap(f.fileno(), cpioinfo.size)
             self.addfile(cpioinfo, f)
             f.close()
 
@@ -1294,7 +1447,17 @@ class CpioFile(object):
 
         # If there's data to follow, append it.
         if fileobj is not None:
-            copyfileobj(fileobj, self.fileobj, cpioinfo.size)
+            if cpioinfo.issparse() and cpioinfo.size > 0:
+                # Only read the data sections, the holes are known to
+                # read as zeros.
+                for section in cpioinfo.sparse:
+                    if isinstance(section, _data):
+                        fileobj.seek(section.offset)
+                        copyfileobj(fileobj, self.fileobj, section.size)
+                    else:
+                        writezeros(self.fileobj, section.size)
+            else:
+                copyfileobj(fileobj, self.fileobj, cpioinfo.size)
             self.offset += cpioinfo.size
 
             words, remainder = divmod(self.offset, WORDSIZE)
@@ -1305,13 +1468,21 @@ class CpioFile(object):
 
         self.members.append(cpioinfo)
 
-    def extractall(self, path=".", members=None):
+    def extractall(self, path=".", members=None, workers=0):
         """Extract all members from the archive to the current working
            directory and set owner, modification time and permissions on
            directories afterwards. `path' specifies a different directory
            to extract to. `members' is optional and must be a subset of the
            list returned by getmembers().
+           If `workers' is greater than zero, the calling thread only reads
+           the archive while that many threads write out the regular files,
+           and owner, modification time and permissions are applied to all
+           members in one pass at the end.
         """
+        if workers > 0:
+            self._extractall_pipelined(path, members, workers)
+            return
+
         directories = []
 
         if members is None:
@@ -1380,6 +1551,161 @@ class CpioFile(object):
             else:
                 self._dbg(1, "cpiofile: %s" % e)
 
+    def _extractall_pipelined(self, path, members, workers):
+        """Extract members using a pool of `workers' writer threads.
+        """
+        self._check("r")
+
+        if members is None:
+            members = self
+
+        jobs = Queue.Queue(self.pipeline_depth)
+        errors = []
+        threads = []
+        for i in xrange(workers):
+            t = threading.Thread(target=self._extract_worker,
+                                 args=(jobs, errors))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+
+        directories = []        # directories, fixed up last
+        extracted = []          # (cpioinfo, cpiogetpath) of everything else
+        datafiles = {}          # inode -> path of the copy holding the data
+        links = {}              # inode -> paths of data-less hard links
+
+        try:
+            for cpioinfo in members:
+                cpiogetpath = os.path.normpath(os.path.join(path, cpioinfo.name))
+                if cpioinfo.issym():
+                    self._dbg(1, "%s -> %s" % (cpioinfo.name, cpioinfo.linkname))
+                else:
+                    self._dbg(1, cpioinfo.name)
+
+                try:
+                    if cpioinfo.isdir():
+                        try:
+                            os.makedirs(cpiogetpath, 0777)
+                        except EnvironmentError:
+                            pass
+                        directories.append((cpioinfo, cpiogetpath))
+                        continue
+
+                    self._makeupperdirs(cpiogetpath)
+                    if cpioinfo.isfifo():
+                        self.makefifo(cpioinfo, cpiogetpath)
+                    elif cpioinfo.ischr() or cpioinfo.isblk():
+                        self.makedev(cpioinfo, cpiogetpath)
+                    elif cpioinfo.issym():
+                        self.makesymlink(cpioinfo, cpiogetpath)
+                    elif cpioinfo.nlink > 1 and cpioinfo.size == 0:
+                        # The data, if any, travels with another link to
+                        # this inode; link to it once it has been written.
+                        links.setdefault(cpioinfo.ino, []).append(cpiogetpath)
+                    else:
+                        if cpioinfo.nlink > 1:
+                            datafiles[cpioinfo.ino] = cpiogetpath
+                        self._queuefile(jobs, cpioinfo, cpiogetpath)
+                    extracted.append((cpioinfo, cpiogetpath))
+                except (EnvironmentError, ExtractError) as e:
+                    self._extracterror(e)
+        finally:
+            for t in threads:
+                jobs.put(None)
+            for t in threads:
+                t.join()
+
+        for e in errors:
+            self._extracterror(e)
+
+        for ino, paths in links.iteritems():
+            try:
+                if ino not in datafiles:
+                    # Every link was empty: create the file for the others.
+                    file(paths[0], "wb").close()
+                    datafiles[ino] = paths.pop(0)
+                for cpiogetpath in paths:
+                    os.link(datafiles[ino], cpiogetpath)
+            except EnvironmentError as e:
+                self._extracterror(e)
+
+        # Set correct owner, mtime and filemode now that all data is in place,
+        # directories last and deepest first.
+        directories.sort(key=lambda d: d[0].name, reverse=True)
+        for cpioinfo, cpiogetpath in extracted + directories:
+            try:
+                self.chown(cpioinfo, cpiogetpath)
+                if not cpioinfo.issym():
+                    self.chmod(cpioinfo, cpiogetpath)
+                    self.utime(cpioinfo, cpiogetpath)
+            except ExtractError as e:
+                self._extracterror(e)
+
+    def _queuefile(self, jobs, cpioinfo, cpiogetpath):
+        """Read the data of a regular file member and hand it to a writer.
+        """
+        source = self.fileobject(self, cpioinfo)
+        if cpioinfo.size <= self.pipeline_bufsize:
+            jobs.put((cpioinfo, cpiogetpath, source.read(), None))
+        else:
+            chunks = Queue.Queue(self.pipeline_depth)
+            jobs.put((cpioinfo, cpiogetpath, None, chunks))
+            try:
+                while True:
+                    buf = source.read(self.pipeline_bufsize)
+                    if not buf:
+                        break
+                    chunks.put(buf)
+            finally:
+                chunks.put(None)
+        source.close()
+
+    def _extract_worker(self, jobs, errors):
+        """Writer thread body for _extractall_pipelined().
+        """
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            cpioinfo, cpiogetpath, data, chunks = job
+            if chunks is None:
+                buffers = iter([data])
+            else:
+                buffers = iter(chunks.get, None)
+            try:
+                self.writefile(cpioinfo, cpiogetpath, buffers)
+            except EnvironmentError as e:
+                errors.append(e)
+            # Don't leave the reader blocked on a file that failed.
+            for buf in buffers:
+                pass
+
+    def _makeupperdirs(self, cpiogetpath):
+        """Create the directories leading up to cpiogetpath.
+        """
+        upperdirs = os.path.dirname(cpiogetpath)
+        if upperdirs and not os.path.isdir(upperdirs):
+            try:
+                os.makedirs(upperdirs, 0777)
+            except EnvironmentError as e:
+                # Another writer may have got there first.
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _extracterror(self, e):
+        """Raise or log an error from extraction according to errorlevel.
+        """
+        if isinstance(e, ExtractError):
+            if self.errorlevel > 1:
+                raise e
+            self._dbg(1, "cpiofile: %s" % e)
+        elif self.errorlevel > 0:
+            raise e
+        elif e.filename is None:
+            self._dbg(1, "cpiofile: %s" % e.strerror)
+        else:
+            self._dbg(1, "cpiofile: %s %r" % (e.strerror, e.filename))
+
     def extractfile(self, member):
         """Extract a member from the archive as a file object. `member' may be
            a filename or a CpioInfo object. If `member' is a regular file, a
@@ -1495,10 +1821,53 @@ class CpioFile(object):
         if extractinfo:
             source = self.extractfile(extractinfo)
             cpioget = file(cpiogetpath, "wb")
-            copyfileobj(source, cpioget)
+            self._writedata(cpioget, extractinfo.size,
+                            iter(lambda: source.read(64 * 1024), ""))
             source.close()
             cpioget.close()
 
+    def writefile(self, cpioinfo, cpiogetpath, buffers):
+        """Write a file called cpiogetpath from an iterable of data
+           buffers. Used by the writer threads of extractall().
+        """
+        self._makeupperdirs(cpiogetpath)
+        cpioget = file(cpiogetpath, "wb")
+        try:
+            if cpioinfo.size >= self.fallocate_threshold and not self.sparse:
+                fallocate(cpioget.fileno(), cpioinfo.size)
+            self._writedata(cpioget, cpioinfo.size, buffers)
+        finally:
+            cpioget.close()
+
+    def _writedata(self, cpioget, size, buffers):
+        """Write the data buffers to the file object cpioget. If
+           self.sparse is set, seek over blocks of zeros instead of
+           writing them.
+        """
+        if not self.sparse:
+            for buf in buffers:
+                cpioget.write(buf)
+            return
+
+        for buf in buffers:
+            if buf.count(NUL) == len(buf):
+                cpioget.seek(len(buf), SEEK_CUR)
+                continue
+            # Write out runs of non-zero blocks in one go.
+            start = pos = 0
+            while pos < len(buf):
+                block = buf[pos:pos + SPARSE_BLOCKSIZE]
+                if block.count(NUL) == len(block):
+                    if pos > start:
+                        cpioget.write(buf[start:pos])
+                    cpioget.seek(len(block), SEEK_CUR)
+                    start = pos + len(block)
+                pos += len(block)
+            if pos > start:
+                cpioget.write(buf[start:pos])
+        # A trailing hole still has to count towards the file size.
+        cpioget.truncate(size)
+
     def makefifo(self, cpioinfo, cpiogetpath):
         """Make a fifo called cpiogetpath.
         """
@@ -1558,14 +1927,7 @@ class CpioFile(object):
         """
         if pwd and hasattr(os, "geteuid") and os.geteuid() == 0:
             # We have to be root to do so.
-            try:
-                g = grp.getgrgid(cpioinfo.gid)[2]
-            except KeyError:
-                g = os.getgid()
-            try:
-                u = pwd.getpwuid(cpioinfo.uid)[2]
-            except KeyError:
-                u = os.getuid()
+            u, g = self._owner(cpioinfo.uid, cpioinfo.gid)
             try:
                 if cpioinfo.issym() and hasattr(os, "lchown"):
                     os.lchown(cpiogetpath, u, g)
@@ -1575,6 +1937,23 @@ class CpioFile(object):
             except EnvironmentError as e:
                 raise ExtractError("could not change owner")
 
+    def _owner(self, uid, gid):
+        """Return the (uid, gid) to give an extracted file owned by
+           uid and gid in the archive, caching the lookups.
+        """
+        key = (uid, gid)
+        if key not in self._owners:
+            try:
+                g = grp.getgrgid(gid)[2]
+            except KeyError:
+                g = os.getgid()
+            try:
+                u = pwd.getpwuid(uid)[2]
+            except KeyError:
+                u = os.getuid()
+            self._owners[key] = (u, g)
+        return self._owners[key]
+
     def chmod(self, cpioinfo, cpiogetpath):
         """Set file permissions of cpiogetpath according to cpioinfo.
         """
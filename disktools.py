@@ -5,11 +5,12 @@
 # countries.
 
 import constants
-import re, subprocess, types, os, time
+import re, subprocess, types, os, stat, glob, time, struct, uuid, zlib, fcntl, errno, threading, Queue, socket, select
 from pprint import pprint
 from copy import copy, deepcopy
 import util
 from xcp import logger
+import simplejson as json
 
 class Segment:
     """Segments are areas, e.g. disk partitions or LVM segments, defined by start address and size"""
@@ -35,52 +36,67 @@ class MoveChunk:
     def __repr__(self):
         return str(self.__dict__)
 
-class FreePool:
-    """FreePool manages the allotment of segments a pool of free segments, and
-    divides segments as necessary to fill the requested size exactly"""
-    def __init__(self, freeSegments, usedThreshold=0):
-        self.freeSegments = freeSegments
-        # Instead of altering the free segment list as free space is consumed by takeSegments,
-        # this class maintains a usedThreshold address.  Addresses lower than the threshold
-        # have already been used, and those at or above it are still available
-        self.usedThreshold = usedThreshold
+class BestFitPool:
+    """BestFitPool allots free segments below a threshold using best-fit.  A request is
+    placed in the smallest single segment that can hold it, and is only split, across
+    the largest segments first, when none can.  This keeps each moved segment in as
+    few pieces as possible"""
+    def __init__(self, freeSegments, threshold):
+        self.freeSegments = []
+        self.clip(threshold, freeSegments)
+
+    def clip(self, threshold, freeSegments=None):
+        """Discards free space at or above threshold, which cannot be used as a destination"""
+        if freeSegments is None:
+            freeSegments = self.freeSegments
+        self.freeSegments = []
+        for seg in freeSegments:
+            size = min(seg.end(), threshold) - seg.start
+            if size > 0:
+                self.freeSegments.append(Segment(seg.start, size))
 
     def freeSpace(self):
-        sizeLeft = 0
-        for seg in self.freeSegments:
-            freeSize = min(seg.size, seg.end() - self.usedThreshold)
-            if freeSize > 0:
-                sizeLeft += freeSize
-
-        return sizeLeft
+        return sum([seg.size for seg in self.freeSegments])
 
     def takeSegments(self, size):
-        """Returns a LIST of segments that fill the requested size, and effectively removes
-        those segments from the free pool by increasing usedThreshold"""
-        initialFreeSpace = self.freeSpace()
+        """Returns a LIST of segments that fill the requested size, and removes those
+        segments from the free pool"""
+        if size > self.freeSpace():
+            raise Exception("Disk allocation failed - out of space")
+
+        fits = [seg for seg in self.freeSegments if seg.size >= size]
+        if fits:
+            candidates = [min(fits, key=lambda seg: (seg.size, seg.start))]
+        else:
+            candidates = sorted(self.freeSegments, key=lambda seg: (-seg.size, seg.start))
+
         segsToTake = []
         sizeLeft = size
-        for seg in self.freeSegments:
-            availableStart = max(seg.start, self.usedThreshold)
-            sizeToTake = min(seg.end() - availableStart, sizeLeft)
-            if sizeToTake > 0:
-                takenSegment = Segment(availableStart, sizeToTake)
-                segsToTake.append(takenSegment)
-                self.usedThreshold = takenSegment.end()
-                sizeLeft -= takenSegment.size
-            assert sizeLeft >= 0 # Underflow implies a logic error
-
-        if sizeLeft > 0:
-            raise Exception("Disk allocation failed - out of space")
+        for seg in candidates:
+            sizeToTake = min(seg.size, sizeLeft)
+            segsToTake.append(Segment(seg.start, sizeToTake))
+            seg.start += sizeToTake
+            seg.size -= sizeToTake
+            sizeLeft -= sizeToTake
+            if sizeLeft == 0:
+                break
+        self.freeSegments = [seg for seg in self.freeSegments if seg.size > 0]
 
         assert size == sum([seg.size for seg in segsToTake]) # Check we've allocated the size required
-        assert size == initialFreeSpace - self.freeSpace() # Check that free space has shrunk by the right amount
-
         return segsToTake
 
     def __repr__(self):
         return str(self.__dict__)
 
+# Snapshot of the LVM configuration shared by all LVMTool instances, so that
+# the installer scans LVM once rather than once per caller.  Anything that
+# changes PVs, VGs or LVs must call invalidateLVMSnapshot().
+cached_lvm_snapshot = None
+
+def invalidateLVMSnapshot():
+    global cached_lvm_snapshot
+    cached_lvm_snapshot = None
+
 class LVMTool:
     # Separation character - mustn't appear in anything we expect back from pvs/vgs/lvs
     SEP = '#'
@@ -102,6 +118,8 @@ class LVMTool:
     PVREMOVE = ['pvremove']
     PVRESIZE = ['pvresize']
 
+    PVMOVE_INTERVAL = 5 # Seconds between pvmove progress reports
+
     VGS_INFO = { # For one-per-VG records
         'command' : ['/sbin/lvm', 'vgs'],
         'arguments' : ['--noheadings', '--nosuffix', '--units', 'b', '--separator', SEP],
@@ -128,6 +146,18 @@ class LVMTool:
         'integer_options' : ['pe_start', 'pv_size', 'pv_free', 'pv_pe_count', 'dev_size']
     }
 
+    # Fields requested from each sub-report of 'lvm fullreport'.  Records are
+    # assembled into the same form as the four VGS/LVS/LVS_SEG/PVS queries above.
+    FULLREPORT_INFO = {
+        'command' : ['/sbin/lvm', 'fullreport', '--reportformat', 'json', '--units', 'b', '--nosuffix',
+                     '--configreport', 'vg', '--options', 'vg_name',
+                     '--configreport', 'lv', '--options', 'lv_name',
+                     '--configreport', 'seg', '--options', 'seg_pe_ranges',
+                     '--configreport', 'pvseg', '--options', 'pvseg_start',
+                     '--configreport', 'pv', '--options', ','.join(PVS_INFO['string_options'][:1] +
+                                                                   PVS_INFO['integer_options'])],
+    }
+
     def __init__(self):
         self.readAllInfo()
         self.pvsToDelete = []
@@ -173,18 +203,62 @@ class LVMTool:
 
         return retVal
 
-    def readAllInfo(self):
-        self.vgs = self.readInfo(self.VGS_INFO)
-        self.lvs = self.readInfo(self.LVS_INFO)
-        self.lvSegs = self.readInfo(self.LVS_SEG_INFO)
-        self.pvs = self.readInfo(self.PVS_INFO)
+    def readFullReport(self):
+        """Reads VGs, LVs, LV segments and PVs with a single LVM command.  Returns
+        None if this version of LVM cannot produce a JSON full report"""
+        try:
+            report = json.loads(self.cmdWrap(self.FULLREPORT_INFO['command']))['report']
+        except Exception as e:
+            logger.log("LVM full report unavailable, using separate queries: " + str(e))
+            return None
+
+        vgs, lvs, lvSegs, pvs = [], [], [], []
+        for item in report:
+            # Each item covers one VG; orphan PVs are reported with no VG.
+            # JSON strings decode as unicode, but everything else here uses str.
+            vg_name = ''
+            for vg in item.get('vg', []):
+                vg_name = str(vg['vg_name'])
+                vgs.append({'vg_name': vg_name})
+            for lv in item.get('lv', []):
+                lvs.append({'lv_name': str(lv['lv_name']), 'vg_name': vg_name})
+            for seg in item.get('seg', []):
+                lvSegs.append({'seg_pe_ranges': str(seg['seg_pe_ranges'])})
+            for pv in item.get('pv', []):
+                data = {'pv_name': str(pv['pv_name']), 'vg_name': vg_name}
+                for name in self.PVS_INFO['integer_options']:
+                    data[name] = int(pv[name])
+                pvs.append(data)
+        return {'vgs': vgs, 'lvs': lvs, 'lvSegs': lvSegs, 'pvs': pvs}
+
+    def readSnapshot(self):
+        snapshot = self.readFullReport()
+        if snapshot is None:
+            snapshot = {
+                'vgs': self.readInfo(self.VGS_INFO),
+                'lvs': self.readInfo(self.LVS_INFO),
+                'lvSegs': self.readInfo(self.LVS_SEG_INFO),
+                'pvs': self.readInfo(self.PVS_INFO),
+                }
         # For DM nodes "pvs" incorrectly returns /dev/dm-n, which does not exist.
         # Replace occurrences of /dev/dm-n with the correct node under /dev/mapper/
-        for pv in self.pvs:
+        for pv in snapshot['pvs']:
             name = pv['pv_name']
             if name.startswith('/dev/dm-'):
                 n = int(name[8:])
                 pv['pv_name'] = getDeviceMapperNode(n)
+        return snapshot
+
+    def readAllInfo(self):
+        global cached_lvm_snapshot
+        if cached_lvm_snapshot is None:
+            cached_lvm_snapshot = self.readSnapshot()
+        # Instances annotate and modify their records, so take private copies
+        snapshot = deepcopy(cached_lvm_snapshot)
+        self.vgs = snapshot['vgs']
+        self.lvs = snapshot['lvs']
+        self.lvSegs = snapshot['lvSegs']
+        self.pvs = snapshot['pvs']
 
     @classmethod
     def decodeSegmentRange(cls, segRange):
@@ -247,23 +321,13 @@ class LVMTool:
                 segsToMove.append(Segment(start, seg.end() - start))
         return segsToMove
 
-    def makeSpaceAfterThreshold(self, device, thresholdExtent):
-        """Queues up a set of MoveChunks that will free up space at the end of a PV so that
-        a pvresize cammand can succeed, and these will lead to pvmove commands at
-        commit time.  Doesn't queue up the pvresize command itself - resizeDevice will do that..
-        Also safe to call if no pvmoves are necessary"""
-        pv = self.deviceToPV(device)
-        # Extents >= thresholdExtent must be freed.
+    def planMoves(self, device, thresholdExtent, freePool):
+        """Returns the MoveChunks that free all extents of device at or above
+        thresholdExtent, taking destinations from freePool.  Segments are placed
+        largest first so that they are split as little as possible"""
+        freePool.clip(thresholdExtent)
         segsToMove = self.segmentsToMove(device, thresholdExtent)
-
-        # Calculate the free pool if we haven't already.  If we have done it already, we've been
-        # here before for this device, so use the existing FreePool object as it knows how much
-        # free space is already used by reallocation
-        if 'free-pool' not in pv:
-            pv['free-pool'] =  FreePool(self.freeSegmentList(device))
-
-        # Take a copy.  We'll only commit our modified copy back to pv['free-pool']  if our transaction succeeds
-        freePool = deepcopy(pv['free-pool'])
+        segsToMove.sort(key=lambda seg: (-seg.size, seg.start))
         moveList = []
 
         for srcSeg in segsToMove:
@@ -278,12 +342,69 @@ class LVMTool:
                 moveList.append(MoveChunk(srcStart, destStart, destSeg.size))
                 srcOffset += destSeg.size
             assert srcOffset == srcSeg.size # Logic error if not
+        moveList.sort(key=lambda move: move.src)
+        return moveList
+
+    def makeSpaceAfterThreshold(self, device, thresholdExtent):
+        """Queues up a set of MoveChunks that will free up space at the end of a PV so that
+        a pvresize cammand can succeed, and these will lead to pvmove commands at
+        commit time.  Doesn't queue up the pvresize command itself - resizeDevice will do that..
+        Also safe to call if no pvmoves are necessary"""
+        pv = self.deviceToPV(device)
+
+        # Calculate the free pool if we haven't already.  If we have done it already, we've been
+        # here before for this device, so use the existing pool object as it knows how much
+        # free space is already used by reallocation
+        if 'free-pool' not in pv:
+            pv['free-pool'] = BestFitPool(self.freeSegmentList(device), thresholdExtent)
+
+        # Take a copy.  We'll only commit our modified copy back to pv['free-pool']  if our transaction succeeds
+        freePool = deepcopy(pv['free-pool'])
+        moveList = self.planMoves(device, thresholdExtent, freePool)
 
         # Add our moves to the current MoveChunk list for this device, creating the
         # dict element if necessary
         self.moveLists[device] = self.moveLists.get(device, []) + moveList
         pv['free-pool'] = freePool
 
+    def extentBytes(self, device):
+        pv = self.deviceToPV(device)
+        return pv['pv_size'] / pv['pv_pe_count'] # Typically 4MiB
+
+    def resizeThreshold(self, device, byteSize):
+        pv = self.deviceToPV(device)
+        if byteSize > pv['dev_size']:
+            raise Exception("Size requested for "+str(device)+" ("+str(byteSize)+
+                ") is greater than device size ("+str(pv['dev_size'])+")")
+
+        extentBytes = self.extentBytes(device)
+        # Calculate the threshold in extents beyond which segments must be moved elsewhere.
+        # Round down, so enough space is freed for pvresize to complete, and allow
+        # PVRESIZE_EXTENT_MARGIN for extents consumed by LVM metadata
+        metadataExtents = (pv['pe_start'] + extentBytes - 1) / extentBytes # Round up
+
+        return byteSize / extentBytes - metadataExtents - self.PVRESIZE_EXTENT_MARGIN
+
+    def planResize(self, device, byteSize):
+        """Dry run of resizeDevice, e.g. to estimate how long repartitioning
+        will take: the moves are planned on a copy of this tool, so nothing is
+        queued here and no pvmove is run.  Returns a dict with the MoveChunks,
+        the number of pvmove commands they need and the bytes
+        plannedMoveBytes() reports they would copy"""
+        plan = deepcopy(self)
+        plan.resizeDevice(device, byteSize)
+        moveList = plan.moveLists.get(device, [])
+        return {
+            'moves' : moveList,
+            'pvmoves' : len(self.coalesceMoves(moveList)),
+            'bytes' : plan.plannedMoveBytes(),
+            }
+
+    def plannedMoveBytes(self):
+        """Returns the number of bytes that the moves queued so far will copy"""
+        return sum([sum([move.size for move in moveList]) * self.extentBytes(device)
+                    for device, moveList in self.moveLists.iteritems()])
+
     def deviceToPVOrNone(self, device):
         """ Returns the PV record for a given device (partition), or None if there is no PV
         for that device."""
@@ -315,18 +436,7 @@ class LVMTool:
     def resizeDevice(self, device, byteSize):
         """ Resizes the PV on a device, moving extents around if necessary
         """
-        pv = self.deviceToPV(device)
-        if byteSize > pv['dev_size']:
-            raise Exception("Size requested for "+str(device)+" ("+str(byteSize)+
-                ") is greater than device size ("+str(pv['dev_size'])+")")
-
-        extentBytes = pv['pv_size'] / pv['pv_pe_count'] # Typically 4MiB
-        # Calculate the threshold in extents beyond which segments must be moved elsewhere.
-        # Round down, so enough space is freed for pvresize to complete, and allow
-        # PVRESIZE_EXTENT_MARGIN for extents consumed by LVM metadata
-        metadataExtents = (pv['pe_start'] + extentBytes - 1) / extentBytes # Round up
-
-        thresholdExtent = byteSize / extentBytes - metadataExtents - self.PVRESIZE_EXTENT_MARGIN
+        thresholdExtent = self.resizeThreshold(device, byteSize)
         self.makeSpaceAfterThreshold(device, thresholdExtent)
         self.resizeList.append({'device' : device, 'bytesize' : byteSize})
 
@@ -404,31 +514,95 @@ class LVMTool:
             except Exception as e:
                 logger.logException(e)
 
+    @classmethod
+    def coalesceMoves(cls, moveList):
+        """Merges MoveChunks that are contiguous in both source and destination, so that
+        each maximal range can be moved by a single pvmove"""
+        merged = []
+        for move in sorted(moveList, key=lambda move: move.src):
+            if merged:
+                last = merged[-1]
+                if last.src + last.size == move.src and last.dest + last.size == move.dest:
+                    last.size += move.size
+                    continue
+            merged.append(MoveChunk(move.src, move.dest, move.size))
+        return merged
+
+    @classmethod
+    def runPvmove(cls, progress_callback, srcRange, destRange):
+        """Runs a single pvmove, passing the percentage it reports to progress_callback"""
+        cmd = cls.PVMOVE + ['--alloc', 'anywhere', '--interval', str(cls.PVMOVE_INTERVAL),
+                            srcRange, destRange]
+
+        def pvmove_progress(line):
+            matches = re.search(r'Moved:\s*([0-9.]+)%', line)
+            if matches:
+                progress_callback(int(float(matches.group(1))))
+
+        rv, out, err = util.runCmdStream(cmd, stdout_callback=pvmove_progress, with_stdout=True, with_stderr=True)
+        if rv != 0:
+            raise Exception(out+err+"\nError="+str(rv))
+
     @classmethod
     def executeMoves(cls, progress_callback, device, moveList):
         # Call commit instead this method unless you have special requirements
-        """Issues pvmove commands to move MoveChunks specified by the MoveList.  Doesn't
-        handle overlapping source and destination segments in a single MoveChunk, but in
-        a makeSpaceAtEnd scenario those aren't generated"""
-        sizeStep = 16 # Moving 16 extents takes only slightly more time than moving 1
-        totalExtents = sum(move.size for move in moveList)
+        """Issues one pvmove command per contiguous range of the MoveChunks specified by
+        the MoveList.  Doesn't handle overlapping source and destination segments in a
+        single MoveChunk, but in a makeSpaceAtEnd scenario those aren't generated"""
+        moves = cls.coalesceMoves(moveList)
+        totalExtents = sum(move.size for move in moves)
         extentsSoFar = 0
-        for move in moveList:
-            offset = 0
-            while offset < move.size:
-                progress_callback((100 * extentsSoFar) / totalExtents)
-                chunkSize = min(sizeStep, move.size - offset)
-                srcRange = cls.encodeSegmentRange(device, move.src + offset, chunkSize)
-                destRange = cls.encodeSegmentRange(device, move.dest + offset, chunkSize)
-                cls.cmdWrap(cls.PVMOVE +
-                    [
-                    '--alloc',
-                    'anywhere',
-                    srcRange,
-                    destRange
-                ])
-                offset += chunkSize
-                extentsSoFar += chunkSize
+        for move in moves:
+            callback = lambda percent : progress_callback((100 * extentsSoFar + move.size * percent) / totalExtents)
+            callback(0)
+            srcRange = cls.encodeSegmentRange(device, move.src, move.size)
+            destRange = cls.encodeSegmentRange(device, move.dest, move.size)
+            cls.runPvmove(callback, srcRange, destRange)
+            extentsSoFar += move.size
+
+    def executeAllMoves(self, progress_callback):
+        """Executes the queued moves for all devices.  Devices in different VGs are
+        independent so are moved concurrently, but LVM only runs one pvmove at a time
+        within a VG.  progress_callback is called from this thread only, with the
+        number of extents moved so far"""
+        groups = {}
+        for device, moveList in self.moveLists.iteritems():
+            vg = self.deviceToPV(device)['vg_name']
+            groups.setdefault(vg, []).append((device, moveList))
+
+        updates = Queue.Queue()
+        def moveGroup(group):
+            try:
+                for device, moveList in sorted(group):
+                    size = sum([ move.size for move in moveList ])
+                    callback = lambda percent : updates.put((device, size * percent / 100))
+                    self.executeMoves(callback, device, moveList)
+                    updates.put((device, size))
+            except Exception as e:
+                updates.put((None, e))
+            else:
+                updates.put((None, None))
+
+        threads = [threading.Thread(target=moveGroup, args=(group,)) for group in groups.values()]
+        for thread in threads:
+            thread.start()
+
+        extentsMoved = {}
+        errors = []
+        running = len(threads)
+        while running > 0:
+            device, value = updates.get()
+            if device is None:
+                running -= 1
+                if value is not None:
+                    errors.append(value)
+            else:
+                extentsMoved[device] = value
+                progress_callback(sum(extentsMoved.values()))
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
 
     def commit(self, progress_callback=lambda _ : ()):
         """Commit the changes queued up by issuing LVM commands, delete our queues as they
@@ -458,13 +632,11 @@ class LVMTool:
         totalExtents = 0
         for moveList in self.moveLists.values():
             totalExtents += sum([ move.size for move in moveList ])
-        extentsSoFar = 0
 
-        for device, moveList in sorted(self.moveLists.iteritems()):
-            thisSize = sum([ move.size for move in moveList ])
-            callback = lambda percent : (progress_callback( 5 + (98 - 5) * (extentsSoFar + thisSize * percent / 100) / totalExtents) )
-            self.executeMoves(callback, device, moveList)
-            extentsSoFar +=  thisSize
+        if totalExtents > 0:
+            logger.log("Moving %d bytes of LVM extents" % self.plannedMoveBytes())
+            callback = lambda extents : (progress_callback( 5 + (98 - 5) * extents / totalExtents) )
+            self.executeAllMoves(callback)
         self.moveLists = {}
 
         # Process resize list
@@ -473,6 +645,7 @@ class LVMTool:
             self.cmdWrap(self.PVRESIZE + ['--setphysicalvolumesize', str(resize['bytesize']/1024)+'k', resize['device']])
         self.resizeList = []
 
+        invalidateLVMSnapshot()
         self.readAllInfo() # Reread the new LVM configuration
         progress_callback(99)
         self.deactivateAll() # Stop active LVs preventing changes to the partition structure
@@ -516,6 +689,9 @@ class PartitionToolBase:
 
     DEFAULT_SECTOR_SIZE = 512 # Used if sfdisk won't print its (hardcoded) value
 
+    NODE_TIMEOUT = 30 # Seconds to wait for partition device nodes
+    UDEV_EVENT_TIMEOUT = 5 # Seconds to wait for udev to process the events for this disk
+
     def __init__(self, device):
         self.device = device
         self.midfix = determineMidfix(device)
@@ -553,14 +729,94 @@ class PartitionToolBase:
         except:
             logger.log('udevsettle with %d second timeout failed' % timeout)
 
-    def waitForDeviceNodes(self):
-        # Ensure new device nodes are available before we continue.
-        # Wait a second to ensure that udev picks up the change event from
-        # the kernel, then call settle to wait for all events complete.
-        time.sleep(1)
-        self.settleUdev()
+    def partitionNodesReady(self, present, absent):
+        """Returns True once there is a device node for each partition number in present
+        that matches the kernel's view of that partition, and none for those in absent"""
+        for num in absent:
+            if os.path.exists(self._partitionDevice(num)):
+                return False
+        scale = self.sectorSize / 512 # sysfs counts 512 byte sectors
+        for num in present:
+            try:
+                st = os.stat(self._partitionDevice(num))
+            except OSError:
+                return False
+            if not stat.S_ISBLK(st.st_mode):
+                return False
+            sysfs = '/sys/dev/block/%d:%d' % (os.major(st.st_rdev), os.minor(st.st_rdev))
+            if not os.path.exists(sysfs):
+                return False # Stale node
+            if os.path.exists(os.path.join(sysfs, 'start')):
+                # Not a device mapper node, check the kernel has re-read the table
+                part = self.partitions[num]
+                if int(open(os.path.join(sysfs, 'start')).read()) != part['start'] * scale:
+                    return False
+                # The kernel shows extended partitions as 1KiB
+                if part['id'] not in MBR_ID_EXTENDED and \
+                        int(open(os.path.join(sysfs, 'size')).read()) != part['size'] * scale:
+                    return False
+        return True
+
+    def watchUdev(self):
+        """Returns a socket receiving the events udev finishes processing, to
+        be opened before writing the partition table so that waitForUdevEvents
+        sees all of those it causes, or None if they cannot be watched"""
+        if isDeviceMapperNode(self.device):
+            # udev does not watch device mapper nodes for changes
+            return None
+        return openUdevSocket()
+
+    def waitForUdevEvents(self, sock, present, absent):
+        """Returns True once udev has processed an event for the disk and for
+        each partition number in present, received on sock, and the nodes are
+        ready.  Returns False if that is not seen within UDEV_EVENT_TIMEOUT
+        seconds, or events were lost."""
+        waiting = set([os.path.realpath(self.device)] +
+                      [os.path.realpath(self._partitionDevice(num)) for num in present])
+        deadline = time.time() + self.UDEV_EVENT_TIMEOUT
+        while waiting or not self.partitionNodesReady(present, absent):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logger.log('Timed out waiting for udev to process the events for %s' % self.device)
+                return False
+            ready, _, _ = select.select([sock], [], [], min(remaining, 0.5))
+            if not ready:
+                continue
+            events = readUdevEvents(sock)
+            if events is None:
+                return False
+            for event in events:
+                devname = event.get('DEVNAME')
+                if devname is None:
+                    continue
+                if event.get('ACTION') == 'remove' and devname != os.path.realpath(self.device):
+                    # an add is to follow if the partition is still there
+                    if devname in [os.path.realpath(self._partitionDevice(num)) for num in present]:
+                        waiting.add(devname)
+                else:
+                    waiting.discard(devname)
+        return True
+
+    def waitForDeviceNodes(self, absent=[], udev_sock=None):
+        # Ensure new device nodes are available before we continue.  First
+        # wait for the nodes of this disk to match the new table.
+        present = self.partitions.keys()
+        dirs = set(['/dev'] + [os.path.dirname(self._partitionDevice(num)) for num in present + absent])
+        if not util.waitForCondition(lambda: self.partitionNodesReady(present, absent),
+                                     list(dirs), self.NODE_TIMEOUT):
+            logger.log('Timed out waiting for partition nodes of %s' % self.device)
+        # Closing the writable fd on the disk makes udev synthesize a change
+        # event and re-read the table asynchronously, which may remove and
+        # re-add nodes that already look right.  Wait for udev to process the
+        # events for this disk and its partitions, and only if that cannot be
+        # seen call settle to wait for all events to complete.
+        if udev_sock is None or not self.waitForUdevEvents(udev_sock, present, absent):
+            self.settleUdev()
 
     def writePartitionTable(self, dryrun=False, log=False):
+        udev_sock = None
+        if not dryrun:
+            udev_sock = self.watchUdev()
         try:
             self.writeThisPartitionTable(self.partitions, dryrun, log)
         except Exception as e:
@@ -571,7 +827,14 @@ class PartitionToolBase:
                 raise Exception('The new partition table could not be written: '+str(e)+'\nReversion also failed: '+str(e2))
             raise Exception('The new partition table could not be written but was reverted successfully: '+str(e))
         else:
-            self.waitForDeviceNodes()
+            if not dryrun:
+                self.waitForDeviceNodes([num for num in self.origPartitions if num not in self.partitions],
+                                        udev_sock)
+        finally:
+            if udev_sock:
+                udev_sock.close()
+            # PVs may have been created, moved or removed along with partitions
+            invalidateLVMSnapshot()
 
     # Public methods from here onward:
     def getPartition(self, number, default=None):
@@ -724,6 +987,167 @@ class PartitionToolBase:
         logger.log(output)
 
 
+# Block device ioctls, see linux/fs.h and linux/hdreg.h
+BLKRRPART = 0x125f
+BLKSSZGET = 0x1268
+BLKGETSIZE64 = 0x80001272 | (struct.calcsize('L') << 16) # _IOR(0x12, 114, size_t)
+HDIO_GETGEO = 0x0301
+HD_GEOMETRY_FORMAT = 'BBHL'
+
+def getBlockDeviceSize(device):
+    """Returns (logical sector size, size in bytes) of a block device"""
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        sectorSize = struct.unpack('i', fcntl.ioctl(fd, BLKSSZGET, struct.pack('i', 0)))[0]
+        sizeBytes = struct.unpack('Q', fcntl.ioctl(fd, BLKGETSIZE64, struct.pack('Q', 0)))[0]
+    finally:
+        os.close(fd)
+    return sectorSize, sizeBytes
+
+def getDiskGeometry(device, default=(255, 63)):
+    """Returns the (heads, sectors per track) the kernel reports for device, as
+    printed by sfdisk -g, or default if the device has no geometry"""
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        try:
+            buf = fcntl.ioctl(fd, HDIO_GETGEO, '\0' * struct.calcsize(HD_GEOMETRY_FORMAT))
+        except IOError:
+            return default
+    finally:
+        os.close(fd)
+    heads, sectors, _, _ = struct.unpack(HD_GEOMETRY_FORMAT, buf)
+    if heads == 0 or sectors == 0:
+        return default
+    return heads, sectors
+
+def rereadPartitionTable(device):
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, BLKRRPART)
+    finally:
+        os.close(fd)
+
+# On-disk MBR structures
+MBR_SIGNATURE = '\x55\xaa'
+MBR_ENTRY_FORMAT = '<B3sB3sII'
+MBR_ENTRY_SIZE = struct.calcsize(MBR_ENTRY_FORMAT) # 16
+MBR_TABLE_OFFSET = 446
+MBR_ACTIVE = 0x80
+MBR_ID_EXTENDED = (0x05, 0x0f, 0x85)
+MBR_MAX_LOGICAL = 128
+
+def decodeMBREntries(sector):
+    """Returns the four (active, id, start, size) entries of an MBR or EBR"""
+    entries = []
+    for i in range(4):
+        offset = MBR_TABLE_OFFSET + i * MBR_ENTRY_SIZE
+        status, _, idt, _, start, size = \
+            struct.unpack(MBR_ENTRY_FORMAT, sector[offset:offset + MBR_ENTRY_SIZE])
+        entries.append((status == MBR_ACTIVE, idt, start, size))
+    return entries
+
+def lbaToCHS(lba, heads, sectors):
+    cylinder = lba / (heads * sectors)
+    if cylinder > 1023:
+        return '\xfe\xff\xff'
+    head = (lba / sectors) % heads
+    sector = lba % sectors + 1
+    return struct.pack('BBB', head, ((cylinder >> 2) & 0xc0) | sector, cylinder & 0xff)
+
+def encodeMBREntry(partition, heads, sectors):
+    if partition is None or partition['size'] == 0:
+        return '\0' * MBR_ENTRY_SIZE
+    start = partition['start']
+    end = start + partition['size'] - 1
+    return struct.pack(MBR_ENTRY_FORMAT, partition['active'] and MBR_ACTIVE or 0,
+                       lbaToCHS(start, heads, sectors), partition['id'],
+                       lbaToCHS(end, heads, sectors), start, partition['size'])
+
+def readMBR(device, sectorSize):
+    """Reads the primary partitions and the logical partitions in any extended
+    partition of device.  Returns a dict in the same form as
+    DOSPartitionTool.partitionTable, which is empty if there is no table"""
+    partitions = {}
+    f = open(device, 'rb')
+    try:
+        mbr = f.read(512)
+        if len(mbr) < 512:
+            raise Exception("Could not read the MBR of %s" % device)
+        if mbr[510:512] != MBR_SIGNATURE:
+            return partitions
+
+        extended = None
+        for number, (active, idt, start, size) in enumerate(decodeMBREntries(mbr)):
+            if size == 0:
+                continue # Treat partitions of size 0 as not present
+            partitions[number + 1] = {'start': start, 'size': size, 'id': idt, 'active': active}
+            if idt in MBR_ID_EXTENDED and extended is None:
+                extended = start
+
+        # Logical partitions are numbered from 5 following the chain of EBRs,
+        # each of which has the logical partition (relative to the EBR) and a
+        # link to the next EBR (relative to the extended partition)
+        number = 5
+        ebr = extended
+        visited = set()
+        while ebr is not None:
+            if ebr in visited:
+                raise Exception("EBR loop at sector %d of %s" % (ebr, device))
+            if len(visited) >= MBR_MAX_LOGICAL:
+                raise Exception("Too many logical partitions on %s, EBR loop?" % device)
+            visited.add(ebr)
+            f.seek(ebr * sectorSize)
+            sector = f.read(512)
+            if len(sector) < 512 or sector[510:512] != MBR_SIGNATURE:
+                raise Exception("Invalid EBR at sector %d of %s" % (ebr, device))
+            entries = decodeMBREntries(sector)
+            active, idt, start, size = entries[0]
+            if size != 0:
+                partitions[number] = {'start': ebr + start, 'size': size, 'id': idt, 'active': active}
+                number += 1
+            _, idt, start, size = entries[1]
+            if size == 0 or idt not in MBR_ID_EXTENDED:
+                break
+            ebr = extended + start
+    finally:
+        f.close()
+    return partitions
+
+def writeMBR(device, table, heads, sectors, dryrun=False):
+    """Writes a table of primary partitions to the MBR of device, keeping the
+    boot code and disk signature already there"""
+    if [num for num in table.keys() if num < 1 or num > 4]:
+        raise Exception("Only primary partitions can be written to the MBR")
+
+    entries = ''.join([encodeMBREntry(table.get(num), heads, sectors) for num in range(1, 5)])
+    fd = os.open(device, dryrun and os.O_RDONLY or os.O_RDWR)
+    try:
+        mbr = os.read(fd, 512)
+        if len(mbr) < 512:
+            raise Exception("Could not read the MBR of %s" % device)
+        mbr = mbr[:MBR_TABLE_OFFSET] + entries + MBR_SIGNATURE
+        if not dryrun:
+            os.lseek(fd, 0, 0)
+            os.write(fd, mbr)
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def checkPartitionTable(table, sectorExtent):
+    """Raises an exception if any partitions in table overlap"""
+    extents = [(part['start'], part['start'] + part['size'], num) for num, part in table.items()
+               if part['size'] != 0 and part['id'] not in MBR_ID_EXTENDED]
+    extents.sort()
+    for i in range(1, len(extents)):
+        if extents[i][0] < extents[i - 1][1]:
+            raise Exception("Partitions %d and %d overlap" % (extents[i - 1][2], extents[i][2]))
+    for start, end, num in extents:
+        if start == 0:
+            raise Exception("Partition %d overlaps the partition table" % num)
+        if end > sectorExtent:
+            logger.log("Warning: partition %d extends past end of disk" % num)
+
+
 class DOSPartitionTool(PartitionToolBase):
 
     ID_LINUX_SWAP = 0x82
@@ -744,16 +1168,7 @@ class DOSPartitionTool(PartitionToolBase):
         cylinders = int(matches.group(1))
         heads = int(matches.group(2))
         sectors = int(matches.group(3))
-        self.sectorExtent = cylinders * heads * sectors
-
-        # DOS partition tables have 32bit sector addresses so we may need to truncate sectorExtent
-        # Actually truncate a bit more because sfdisk has unfathomablely lower limit
-        self.sectorExtent = min([self.sectorExtent, 0xffe00000]) # 2047G
-        cylinders = int(self.sectorExtent/(heads * sectors))
-        self.sectorExtent = cylinders * heads * sectors # Ignore partial cylinder at end
-
-        self.sectorFirstUsable = sectors # Some SANs require bootable disks to start on sector boundary
-        self.sectorLastUsable = self.sectorExtent - 1
+        self.__setExtent(cylinders * heads * sectors, heads, sectors)
 
         # Read sector size.  This will fail if the disk has no partition table at all
         self.sectorSize = None
@@ -777,22 +1192,48 @@ class DOSPartitionTool(PartitionToolBase):
         sectors = 63
         self.sectorSize = 512
         out = self.cmdWrap([self.BLOCKDEV, '--getsize64', self.device])
-        self.sectorExtent = int(out)/self.sectorSize
+        self.__setExtent(int(out)/self.sectorSize, heads, sectors)
+
+    def __readNativeDiskDetails(self):
+        sectorSize, sizeBytes = getBlockDeviceSize(self.device)
+        if isDeviceMapperNode(self.device):
+            # DM nodes don't have a geometry, use the default sfdisk would
+            heads, sectors = 255, 63
+            sectorSize = 512
+        else:
+            heads, sectors = getDiskGeometry(self.device)
+        self.sectorSize = sectorSize
+        self.__setExtent(sizeBytes / sectorSize, heads, sectors)
+
+    def __setExtent(self, sectorExtent, heads, sectors):
+        self.geometry = (heads, sectors)
         # DOS partition tables have 32bit sector addresses so we may need to truncate sectorExtent
         # Actually truncate a bit more because sfdisk has unfathomablely lower limit
-        self.sectorExtent = min([self.sectorExtent, 0xffe00000]) # 2047G
+        self.sectorExtent = min([sectorExtent, 0xffe00000]) # 2047G
         cylinders = int(self.sectorExtent/(heads * sectors))
         self.sectorExtent = cylinders * heads * sectors # Ignore partial cylinder at end
         self.sectorFirstUsable = sectors # Some SANs require bootable disks to start on sector boundary
         self.sectorLastUsable = self.sectorExtent - 1
 
     def readDiskDetails(self):
+        try:
+            self.__readNativeDiskDetails()
+            return
+        except Exception as e:
+            logger.log("Could not read details of %s directly, using sfdisk: %s" % (self.device, str(e)))
         if isDeviceMapperNode(self.device):
             self.__readDeviceMapperDiskDetails()
         else:
             self.__readDiskDetails()
 
     def partitionTable(self):
+        try:
+            return readMBR(self.device, self.sectorSize)
+        except Exception as e:
+            logger.log("Could not read MBR of %s directly, using sfdisk: %s" % (self.device, str(e)))
+        return self.sfdiskPartitionTable()
+
+    def sfdiskPartitionTable(self):
         out = self.cmdWrap([self.SFDISK, '-Ld', self.device])
         state = 0
         partitions = {}
@@ -829,11 +1270,65 @@ class DOSPartitionTool(PartitionToolBase):
         return partitions
 
     def commitActivePartitiontoDisk(self, part_num):
-        self.settleUdev()
-        self.cmdWrap([self.SFDISK, '--no-reread', '-A%d' % part_num, self.device]) # BIOS bootable flag set for one and unset for others partition
+        try:
+            # BIOS bootable flag set for one and unset for others partition
+            table = dict([(num, part) for num, part in readMBR(self.device, self.sectorSize).items() if num <= 4])
+            if part_num not in table:
+                raise Exception("Partition %d is not a primary partition" % part_num)
+            for num, part in table.items():
+                part['active'] = (num == part_num)
+            heads, sectors = self.geometry
+            writeMBR(self.device, table, heads, sectors)
+        except Exception as e:
+            logger.log("Could not set active partition of %s directly, using sfdisk: %s" % (self.device, str(e)))
+            self.settleUdev()
+            self.cmdWrap([self.SFDISK, '--no-reread', '-A%d' % part_num, self.device]) # BIOS bootable flag set for one and unset for others partition
         self.waitForDeviceNodes()
 
     def writeThisPartitionTable(self, table, dryrun=False, log=False):
+        if [num for num in table.keys() if num > 4]:
+            # Logical partitions need EBRs, leave those to sfdisk
+            return self.sfdiskWritePartitionTable(table, dryrun, log)
+
+        checkPartitionTable(table, self.sectorExtent)
+        if log:
+            logger.log('Writing MBR of %s:\n%s' % (self.device, '\n'.join(
+                ['%d: start=%d, size=%d, Id=%x%s' % (num, part['start'], part['size'], part['id'],
+                                                     part['active'] and ', bootable' or '')
+                 for num, part in sorted(table.items())])))
+
+        if isDeviceMapperNode(self.device):
+            # Destroy device mapper partitions before re-writing partition table on mpath device
+            rv = destroyPartnodes(self.device)
+            if rv:
+                raise Exception('Failed to destroy partitions on ' + self.device)
+        self.settleUdev()
+        heads, sectors = self.geometry
+        writeMBR(self.device, table, heads, sectors, dryrun)
+
+        if isDeviceMapperNode(self.device):
+            # Create partitions using device mapper
+            rv = createPartnodes(self.device)
+            if rv:
+                raise Exception('Failed to create partitions on %s using kpartx ' % self.device)
+            self.checkPartnodeSizes(table)
+        elif not dryrun:
+            try:
+                rereadPartitionTable(self.device)
+            except IOError as e:
+                if e.errno == errno.EBUSY:
+                    raise Exception('The disk appears to be in use and partition changes cannot be applied. Reboot and repeat the installation')
+                raise
+
+    def checkPartnodeSizes(self, table):
+        """Raises an exception if the device mapper partitions of self.device
+        do not have the sizes in table"""
+        for number in table.keys():
+            size = int(self.cmdWrap([self.BLOCKDEV, '--getsize64', '%sp%d' % (self.device, number)]))/self.sectorSize
+            if size != table[number]['size']:
+                raise Exception('Failed to create partition %sp%d of size %d' % (self.device, number, table[number]['size']))
+
+    def sfdiskWritePartitionTable(self, table, dryrun=False, log=False):
         input = 'unit: sectors\n\n'
 
         # sfdisk doesn't allow us to skip partitions, so invent lines for empty slot
@@ -884,10 +1379,7 @@ class DOSPartitionTool(PartitionToolBase):
             rv = createPartnodes(self.device)
             if rv:
                 raise Exception('Failed to create partitions on %s using kpartx ' % self.device)
-            for number in table.keys():
-                size = int(self.cmdWrap([self.BLOCKDEV, '--getsize64', '%sp%d' % (self.device, number)]))/self.sectorSize
-                if size != table[number]['size']:
-                    raise Exception('Failed to create partition %sp%d of size %d' % (self.device, number, table[number]['size']))
+            self.checkPartnodeSizes(table)
 
         else:
             if process.returncode != 0:
@@ -912,6 +1404,118 @@ class DOSPartitionTool(PartitionToolBase):
         return [num for num in self.partitions.keys() if self.partitions[num]['id'] == self.ID_DELL_UTILITY]
 
 
+# On-disk GPT structures, see the UEFI specification chapter 5
+GPT_SIGNATURE = 'EFI PART'
+GPT_HEADER_FORMAT = '<8sIIIIQQQQ16sQIII'
+GPT_HEADER_SIZE = struct.calcsize(GPT_HEADER_FORMAT) # 92
+GPT_ENTRY_FORMAT = '<16s16sQQQ72s'
+GPT_ENTRY_SIZE = struct.calcsize(GPT_ENTRY_FORMAT) # 128
+GPT_ATTR_LEGACY_BIOS_BOOTABLE = 1 << 2
+MBR_ID_GPT_PROTECTIVE = 0xee
+
+def crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+def guidToString(raw):
+    """Formats a GUID stored in mixed-endian on-disk order the way sgdisk prints it"""
+    return str(uuid.UUID(bytes_le=raw)).upper()
+
+def readGPTHeader(f, lba, sectorSize):
+    """Reads and validates the GPT header at lba and the partition entry array it
+    describes.  Returns (header, entries) or None if there is no valid header there"""
+    f.seek(lba * sectorSize)
+    buf = f.read(sectorSize)
+    if len(buf) < GPT_HEADER_SIZE:
+        return None
+    fields = struct.unpack(GPT_HEADER_FORMAT, buf[:GPT_HEADER_SIZE])
+    header = dict(zip(['signature', 'revision', 'header_size', 'header_crc', 'reserved',
+                       'current_lba', 'backup_lba', 'first_usable', 'last_usable', 'disk_guid',
+                       'entries_lba', 'num_entries', 'entry_size', 'entries_crc'], fields))
+    if header['signature'] != GPT_SIGNATURE:
+        return None
+    if header['header_size'] < GPT_HEADER_SIZE or header['header_size'] > sectorSize:
+        return None
+    # The header CRC is calculated with the CRC field itself zeroed
+    if crc32(buf[:16] + '\0' * 4 + buf[20:header['header_size']]) != header['header_crc']:
+        logger.log("GPT header at LBA %d has a bad CRC" % lba)
+        return None
+    if header['current_lba'] != lba or header['entry_size'] < GPT_ENTRY_SIZE:
+        return None
+
+    f.seek(header['entries_lba'] * sectorSize)
+    entries = f.read(header['num_entries'] * header['entry_size'])
+    if len(entries) != header['num_entries'] * header['entry_size'] or \
+            crc32(entries) != header['entries_crc']:
+        logger.log("GPT partition entries for header at LBA %d have a bad CRC" % lba)
+        return None
+    return header, entries
+
+def decodeGPTEntries(header, entries):
+    """Returns a partition dict, keyed by partition number, in the same form as
+    GPTPartitionTool.partitionTable"""
+    partitions = {}
+    size = header['entry_size']
+    for i in range(header['num_entries']):
+        typeGUID, uniqueGUID, first, last, attributes, name = \
+            struct.unpack(GPT_ENTRY_FORMAT, entries[i * size:i * size + GPT_ENTRY_SIZE])
+        if typeGUID == '\0' * 16:
+            continue # Unused entry
+        partlabel = name.decode('utf-16-le', 'replace').split(u'\0', 1)[0].encode('utf-8')
+        partitions[i + 1] = {
+            'start': first,
+            'size': last + 1 - first,
+            'id': guidToString(typeGUID),
+            'active': (attributes & GPT_ATTR_LEGACY_BIOS_BOOTABLE) != 0,
+            'partlabel': partlabel,
+            'partuuid': guidToString(uniqueGUID),
+            }
+    return partitions
+
+def readGPT(device, sectorSize, sectorExtent):
+    """Reads the GPT of device directly, without spawning sgdisk or opening the device
+    for writing.  Uses the backup header if the primary one is damaged.  Returns the
+    partition dict, an empty dict for a disk with no partition table at all, or None
+    if the disk needs sgdisk to interpret it (e.g. an MBR to convert, or both headers
+    damaged)"""
+    f = open(device, 'rb')
+    try:
+        mbr = f.read(512)
+        if len(mbr) < 512:
+            raise Exception("Could not read the MBR of %s" % device)
+        mbr_types = [ord(mbr[446 + 16 * i + 4]) for i in range(4)]
+
+        gpt = readGPTHeader(f, 1, sectorSize)
+        if gpt is None:
+            gpt = readGPTHeader(f, sectorExtent - 1, sectorSize)
+            if gpt is not None:
+                logger.log("Warning: primary GPT on %s is damaged, using backup" % device)
+    finally:
+        f.close()
+
+    if gpt is None:
+        if mbr[510:512] != MBR_SIGNATURE or mbr_types == [0, 0, 0, 0]:
+            # Blank disk: sgdisk would just create an empty table in memory
+            return {}
+        return None
+
+    if mbr[510:512] != MBR_SIGNATURE or MBR_ID_GPT_PROTECTIVE not in mbr_types:
+        logger.log("Warning: GPT on %s has no protective MBR" % device)
+    return decodeGPTEntries(*gpt)
+
+
+def wipeGPTHeaders(device, sectorSize, sectorExtent):
+    """Zeroes the primary and backup GPT headers of device.  The partition entries
+    and the MBR are left alone; without a header they are ignored"""
+    fd = os.open(device, os.O_WRONLY)
+    try:
+        for lba in (1, sectorExtent - 1):
+            os.lseek(fd, lba * sectorSize, 0)
+            os.write(fd, '\0' * sectorSize)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 class GPTPartitionTool(PartitionToolBase):
 
     # These are partition type GUIDs
@@ -940,6 +1544,16 @@ class GPTPartitionTool(PartitionToolBase):
         self.sectorLastUsable  = self.sectorExtent - 34
 
     def partitionTable(self):
+        try:
+            partitions = readGPT(self.device, self.sectorSize, self.sectorExtent)
+        except Exception as e:
+            logger.log("Could not read GPT of %s directly: %s" % (self.device, str(e)))
+            partitions = None
+        if partitions is not None:
+            return partitions
+        return self.sgdiskPartitionTable()
+
+    def sgdiskPartitionTable(self):
         cmd = [self.SGDISK, '--print', self.device]
         rv, out, err = util.runCmd2(cmd, True, True)
         if rv != 0:
@@ -1000,11 +1614,13 @@ class GPTPartitionTool(PartitionToolBase):
         return partitions
 
     def commitActivePartitiontoDisk(self, partnum):
+        cmd = [self.SGDISK]
         for num, part in self.iteritems():
             if num == partnum:
-                self.cmdWrap([self.SGDISK, '--attributes=%d:set:2' % num, self.device]) # BIOS bootable flag set
+                cmd.append('--attributes=%d:set:2' % num) # BIOS bootable flag set
             else:
-                self.cmdWrap([self.SGDISK, '--attributes=%d:clear:2' % num, self.device]) # BIOS bootable flag clear
+                cmd.append('--attributes=%d:clear:2' % num) # BIOS bootable flag clear
+        self.cmdWrap(cmd + [self.device])
 
         self.waitForDeviceNodes()
 
@@ -1019,21 +1635,31 @@ class GPTPartitionTool(PartitionToolBase):
             if rv:
                 raise Exception('Failed to destroy GPT partitions on ' + self.device)
 
-        # Bring us to a known state.
-        try:
-            # --clear is called to clear the backup GPT first, since --zap does not clear this and
-            # will restore the backup GPT if the main GPT is damaged (which is not what we want).
-            self.cmdWrap([self.SGDISK, '--clear', self.device])
-        except:
-            # Ignore error code which results from inconsistent initial state
-            pass
+        # Bring us to a known state: wipe both GPT headers so that sgdisk does not
+        # restore a damaged main GPT from the backup.
+        wipeGPTHeaders(self.device, self.sectorSize, self.sectorExtent)
 
-        try:
-            self.cmdWrap([self.SGDISK, '--zap', self.device])
-        except:
-            # Ignore error code which results from inconsistent initial state
-            pass
-        self.cmdWrap([self.SGDISK, '--mbrtogpt', '--clear', self.device])
+        # Build the whole table as one sgdisk invocation so that it is written,
+        # and the kernel re-reads it, exactly once.
+        # Ensure that we write out in on-disk order to prevent conflicts when
+        # partition sizes get rounded.
+        cmd = [self.SGDISK, '--mbrtogpt', '--clear']
+        items = sorted(table.items(), key=lambda item: item[1]['start'])
+        for num,part in items:
+            start  = part['start']
+            end    = part['size'] + start - 1
+            idt    = part['id']
+            active = part['active']
+            cmd += ['--new=%d:%d:%d' % (num,start,end),
+                    '--typecode=%d:%s' % (num,self.GUID_to_type_code[idt])]
+            if active:
+                cmd.append('--attributes=%d:set:2' % num) # BIOS bootable flag
+            if 'partlabel' in part and part['partlabel']:
+                cmd.append('--change-name=%d:%s' % (num, part['partlabel']))
+            if 'partuuid' in part:
+                cmd.append('--partition-guid=%d:%s' % (num, part['partuuid']))
+        cmd.append(self.device)
+        self.cmdWrap(cmd)
 
         has_esp = False
         for part in table.values():
@@ -1047,26 +1673,10 @@ class GPTPartitionTool(PartitionToolBase):
             # bootloader uses a DOS partition table.  Instead the BIOSes _should_ just check for 0x55,0xaa
             # at location 0x1fe.
             # However, let's keep them happy by making the single partition in the protective MBR "active".
+            # This is done after sgdisk since --clear writes a fresh protective MBR.
             self.settleUdev()
             self.cmdWrap(['sfdisk', '--no-reread', '-A1', self.device])
 
-        # Ensure that we write out in on-disk order to prevent conflicts when
-        # partition sizes get rounded.
-        items = sorted(table.items(), key=lambda item: item[1]['start'])
-        for num,part in items:
-            start  = part['start']
-            end    = part['size'] + start - 1
-            idt    = part['id']
-            active = part['active']
-            self.cmdWrap([self.SGDISK, '--new=%d:%d:%d' % (num,start,end), self.device])
-            self.cmdWrap([self.SGDISK, '--typecode=%d:%s' % (num,self.GUID_to_type_code[idt]), self.device])
-            if active:
-                self.cmdWrap([self.SGDISK, '--attributes=%d:set:2' % num, self.device]) # BIOS bootable flag
-            if 'partlabel' in part and part['partlabel']:
-                self.cmdWrap([self.SGDISK, '--change-name=%d:%s' % (num, part['partlabel']), self.device])
-            if 'partuuid' in part:
-                self.cmdWrap([self.SGDISK, '--partition-guid=%d:%s' % (num, part['partuuid']), self.device])
-
         if isDeviceMapperNode(self.device):
             # Create partitions using device mapper
             rv = createPartnodes(self.device)
@@ -1101,29 +1711,65 @@ def PartitionTool(device, partitionType=None):
     elif partitionType == constants.PARTITION_GPT:
         return GPTPartitionTool(device)
 
+DM_PARALLEL = 8 # kpartx processes to run at once when creating partition nodes
+
+def dmPartitionMaps(devs):
+    """Returns the /dev/mapper nodes of the partition maps of the device-mapper devices devs"""
+    dmnodes = [ '/dev/mapper/%s' % name for name in getBlockTopology().dmNames.values() ]
+    return [dmnode for dmnode in sorted(dmnodes)
+            if [dev for dev in devs if re.match(re.escape(dev) + r'p?\d+$', dmnode)]]
+
+def destroyPartnodesBatch(devs):
+    """Removes the partition maps of all of devs with a single dmsetup command,
+    falling back to one command per map if this dmsetup cannot remove several"""
+    partitions = dmPartitionMaps(devs)
+    if not partitions:
+        return 0
+    # the obvious way to do this is to use "kpartx -d" but that's broken!
+    rv = util.runCmd2(['dmsetup', 'remove'] + partitions)
+    if rv:
+        for partition in partitions:
+            if os.path.exists(partition):
+                rv = util.runCmd2(['dmsetup', 'remove', partition])
+                if rv: break
+    invalidateBlockTopology()
+    return rv
+
+def createPartnodesBatch(devs, parallel=DM_PARALLEL):
+    """Creates partition maps for all of devs, running up to parallel kpartx
+    processes at once.  Returns the first non-zero exit status, or 0"""
+    results = util.parallelMap(lambda dev: util.runCmd2(['kpartx', '-a', dev]), devs, parallel)
+    invalidateBlockTopology()
+    return ([rv for rv in results if rv] + [0])[0]
+
 def destroyPartnodes(dev):
     # Destroy partition nodes for a device-mapper device
-    dmnodes = [ '/dev/mapper/%s' % f for f in os.listdir('/dev/mapper') ]
-    partitions = filter(lambda dmnode: re.match(dev + r'p?\d+$', dmnode), dmnodes)
-    for partition in partitions:
-        # the obvious way to do this is to use "kpartx -d" but that's broken!
-        rv = util.runCmd2(['dmsetup', 'remove', partition])
-        if rv: return rv
-    return 0
+    return destroyPartnodesBatch([dev])
 
 def destroyMpathPartnodes():
-    mpnodes = getMpathNodes()
-    for mpnode in mpnodes:
-        rv = destroyPartnodes(mpnode)
-        if rv: return rv
-    return 0
+    return destroyPartnodesBatch(getMpathNodes())
 
 def createPartnodes(dev):
     # Create partition nodes for a device-mapper device
-    return util.runCmd2(['kpartx', '-a', dev])
+    return createPartnodesBatch([dev])
 
 def createMpathPartnodes():
-    return util.runCmd2(['dmsetup', 'ls', '--target', 'multipath', '--exec', "kpartx -a"])
+    return createPartnodesBatch(getMpathNodes())
+
+def dmNodesReady():
+    """Returns True once every device mapper device the kernel knows about has its
+    node under /dev/mapper"""
+    for name in glob.glob('/sys/block/dm-*/dm/name'):
+        try:
+            node = '/dev/mapper/' + open(name).read().strip()
+        except IOError:
+            continue # Removed while we were looking
+        if not os.path.exists(node):
+            return False
+    return True
+
+def waitForDmNodes(timeout=30):
+    return util.waitForCondition(dmNodesReady, ['/dev/mapper'], timeout)
 
 def getMpathNodes():
     nodes = []
@@ -1158,80 +1804,209 @@ def isDeviceMapperNode(dev):
     except OSError:
         return False
 
-def getSysfsDir(dev):
-    major, minor = getMajMin(dev)
-    parts = open("/proc/partitions")
-    partlines = map(lambda x: re.sub(" +", " ", x).strip(),
-                    parts.readlines())
-    parts.close()
-    # parse it:
-    disks = []
-    for l in partlines:
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+UEVENT_UDEV_GROUP = 2
+
+def openUeventSocket():
+    """Returns a non-blocking socket receiving kernel uevents, or None if this is
+    not possible (e.g. not running as root)"""
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        sock.bind((0, UEVENT_KERNEL_GROUP))
+        sock.setblocking(0)
+        return sock
+    except (socket.error, AttributeError) as e:
+        logger.log("Cannot monitor uevents, block topology will not be cached: %s" % str(e))
+        return None
+
+def openUdevSocket():
+    """Returns a non-blocking socket receiving the uevents udev has finished
+    processing, or None if this is not possible"""
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        sock.bind((0, UEVENT_UDEV_GROUP))
+        sock.setblocking(0)
+        return sock
+    except (socket.error, AttributeError) as e:
+        logger.log("Cannot monitor udev events: %s" % str(e))
+        return None
+
+def readUdevEvents(sock):
+    """Reads all queued udev events, returning the properties of each as a
+    dict, or None if events were lost"""
+    events = []
+    while True:
         try:
-           (_major, _minor, size, name) = l.split(" ")
-           if (major, minor) == (int(_major), int(_minor)):
-               name = name.replace('/','!')
-               return '/sys/block/%s' % name
-        except:
-            pass
-    raise RuntimeError("Couldn't find sysfs dir for device %s" % dev)
+            msg = sock.recv(16384)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return events
+            return None # ENOBUFS
+        if not msg.startswith('libudev\0'):
+            continue
+        # The properties follow a binary header, as NUL separated KEY=VALUE
+        events.append(dict([field.split('=', 1) for field in msg.split('\0')
+                            if '=' in field and field[:1].isupper()]))
+
+def blockUeventsPending(sock):
+    """Reads all queued uevents and returns True if any were for block devices"""
+    pending = False
+    while True:
+        try:
+            msg = sock.recv(16384)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return pending
+            return True # Including ENOBUFS: events were lost
+        if '\0SUBSYSTEM=block\0' in msg:
+            pending = True
+
+class BlockTopology:
+    """Index of the block devices the kernel knows about, built in one walk of
+    /sys/class/block: major:minor, kernel name, holders, slaves and device mapper
+    name.  Kernel names use '!' for '/', as sysfs does"""
+    SYSFS_CLASS = '/sys/class/block'
+
+    def __init__(self):
+        self.names = {}         # (major, minor) -> name
+        self.devs = {}          # name -> (major, minor)
+        self.holders = {}       # name -> [name]
+        self.slaves = {}        # name -> [name]
+        self.partitions = set()
+        self.dmNames = {}       # name -> device mapper name
+        for name in os.listdir(self.SYSFS_CLASS):
+            path = os.path.join(self.SYSFS_CLASS, name)
+            try:
+                dev = tuple(map(int, open(os.path.join(path, 'dev')).read().strip().split(':')))
+            except (IOError, ValueError):
+                continue # Removed while we were looking
+            self.names[dev] = name
+            self.devs[name] = dev
+            for relation in ('holders', 'slaves'):
+                try:
+                    getattr(self, relation)[name] = os.listdir(os.path.join(path, relation))
+                except OSError:
+                    getattr(self, relation)[name] = []
+            if os.path.exists(os.path.join(path, 'partition')):
+                self.partitions.add(name)
+            try:
+                self.dmNames[name] = open(os.path.join(path, 'dm', 'name')).read().strip()
+            except IOError:
+                pass
+
+    def name(self, dev):
+        """Returns the kernel name of device node dev"""
+        name = self.names.get(getMajMin(dev))
+        if name is None:
+            raise RuntimeError("Couldn't find sysfs dir for device %s" % dev)
+        return name
+
+    def sysfsDir(self, name):
+        return '/sys/block/%s' % name
+
+    def mapperNode(self, name):
+        """Returns the /dev/mapper node for device mapper device name, e.g. 'dm-0'"""
+        if name not in self.devs:
+            return None
+        if name in self.dmNames:
+            dmdev = '/dev/mapper/%s' % self.dmNames[name]
+            try:
+                if getMajMin(dmdev) == self.devs[name]:
+                    return dmdev
+            except OSError:
+                pass
+        # Fall back to looking for the node, e.g. if udev escaped the name
+        for i in os.listdir('/dev/mapper'):
+            dmdev = '/dev/mapper/%s' % i
+            if getMajMin(dmdev) == self.devs[name]:
+                return dmdev
+        return None
+
+cached_block_topology = None
+block_uevent_socket = None
+# Disks are probed from several threads at once
+block_topology_lock = threading.Lock()
+
+def getBlockTopology():
+    """Returns the cached BlockTopology, rebuilding it if any block uevent has
+    happened since it was built"""
+    global cached_block_topology, block_uevent_socket
+    block_topology_lock.acquire()
+    try:
+        if block_uevent_socket is None:
+            block_uevent_socket = openUeventSocket() or False
+            cached_block_topology = None
+        if not block_uevent_socket or blockUeventsPending(block_uevent_socket):
+            cached_block_topology = None
+        if cached_block_topology is None:
+            cached_block_topology = BlockTopology()
+        return cached_block_topology
+    finally:
+        block_topology_lock.release()
+
+def invalidateBlockTopology():
+    global cached_block_topology
+    block_topology_lock.acquire()
+    try:
+        cached_block_topology = None
+    finally:
+        block_topology_lock.release()
+
+def getSysfsDir(dev):
+    topology = getBlockTopology()
+    return topology.sysfsDir(topology.name(dev))
 
 def hasDeviceMapperHolder(dev):
-    sysfs = getSysfsDir(dev)
-    if os.path.exists('%s/holders' % sysfs):
-        for holder in os.listdir('%s/holders' % sysfs):
-            if holder.startswith('dm-'):
-                return True
+    topology = getBlockTopology()
+    name = topology.name(dev)
+    if name in topology.partitions:
+        return False # Only whole disks, as with /sys/block/*/holders
+    for holder in topology.holders.get(name, []):
+        if holder.startswith('dm-'):
+            return True
     return False
 
 
 def getDeviceMapperNode(n):
     "Return the /dev/mapper/node corresponding to /sys/block/dm-n"
-    (major,minor) = map(int,open('/sys/block/dm-%s/dev' % str(n)).read().strip().split(':'))
-    for i in os.listdir('/dev/mapper'):
-        dmdev = '/dev/mapper/%s' % i
-        if getMajMin(dmdev) == (major,minor):
-            return dmdev
-    return None
+    return getBlockTopology().mapperNode('dm-%s' % str(n))
 
 
 def getDeviceSlaves(disk):
     """ Return the list of slaves for an device or an empty list """
-    slaves = []
-    major, minor = getMajMin(disk)
-    rv, out = util.runCmd2(['sh','-c','ls -d1 /sys/block/*/holders/*/dev'],with_stdout=True)
-    lines = out.strip().split('\n')
-    lines = filter(lambda x: x != '', lines)
-    for f in lines:
-        _, _, _, dev, _, _, _ = f.split('/')
-        __major, __minor = map(int, open(f).read().split(':'))
-        if (__major, __minor) == (major, minor):
-            dev = '/dev/' + dev.replace("!", "/")
-            slaves.append(dev)
-    return slaves
+    topology = getBlockTopology()
+    try:
+        name = topology.name(disk)
+    except RuntimeError:
+        return []
+    # Only whole disks, as with /sys/block/*/holders
+    return ['/dev/' + slave.replace("!", "/") for slave in sorted(topology.slaves.get(name, []))
+            if slave not in topology.partitions]
 
 def getMpathMaster(dev):
     "Returns master device or None"
     try:
-        d = getSysfsDir(dev)
+        topology = getBlockTopology()
+        name = topology.name(dev)
 
         if dev.startswith('/dev/dm-'):
             holder = dev[5:]
+        elif name in topology.partitions:
+            return None # Only whole disks, as with /sys/block/*/holders
         else:
-            holders = os.listdir('%s/holders' % d)
+            holders = topology.holders.get(name, [])
             if len(holders) != 1 or (not holders[0].startswith('dm-')):
-                logger.log('getMpathMaster: contents of %s/holders/ is %s' % (d,str(holders)))
+                logger.log('getMpathMaster: contents of %s/holders/ is %s' % (topology.sysfsDir(name),str(holders)))
                 return None
             else:
                 holder = holders[0]
 
-        (major,minor) = map(int,open('/sys/block/%s/dev' % holder).read().strip().split(':'))
-        for i in os.listdir('/dev/mapper'):
-            dmdev = '/dev/mapper/%s' % i
-            if getMajMin(dmdev) == (major,minor):
-                logger.log('getMpathMaster: %s has master %s' % (dev,dmdev))
-                return dmdev
-        logger.log('getMpathMaster: could not find master %d:%d of %s in /dev/mapper/' % (major,minor,dev))
+        dmdev = topology.mapperNode(holder)
+        if dmdev:
+            logger.log('getMpathMaster: %s has master %s' % (dev,dmdev))
+            return dmdev
+        logger.log('getMpathMaster: could not find master %s of %s in /dev/mapper/' % (holder,dev))
 
     except OSError:
         return None
@@ -17,6 +17,8 @@ import constants
 import CDROM
 import fcntl
 import glob
+import struct
+import uuid
 import util
 import netutil
 from util import dev_null
@@ -51,7 +53,7 @@ def mpath_part_scan(force=False):
     if not force and not use_mpath:
         return 0
     ret = createMpathPartnodes()
-    if ret == 0:
+    if ret == 0 and not waitForDmNodes():
          util.runCmd2(util.udevsettleCmd())
     return ret
 
@@ -75,6 +77,7 @@ def mpath_enable():
 
     # Tell DM to create partition nodes for newly created mpath devices
     assert 0 == mpath_part_scan(True)
+    invalidateLVMSnapshot()
     logger.log("created multipath device(s)");
     use_mpath = True
 
@@ -82,6 +85,7 @@ def mpath_disable():
     destroyMpathPartnodes()
     util.runCmd2(['killall','multipathd'])
     util.runCmd2(['/sbin/multipath','-F'])
+    invalidateLVMSnapshot()
     use_mpath = False
 
 # hd* -> (ide has majors 3, 22, 33, 34, 56, 57, 88, 89, 90, 91, each major has
@@ -180,6 +184,7 @@ def create_raid(configuration):
                 cmd = ['mdadm', '--create', raid_device, '--run', '--metadata=1.0', '--level=mirror',
                        '--raid-devices=%s' % (len(members))] + members
                 rc, out, err = util.runCmd2(cmd, with_stdout=True, with_stderr=True)
+                invalidateLVMSnapshot()
                 if rc != 0:
                     raise Exception('Error running: %s\n%s\n\n%s' % (' '.join(cmd), out, err))
 
@@ -311,6 +316,53 @@ def getDiskDeviceSize(dev):
     elif os.path.exists("/sys/block/%s/size" % dev):
         return int(__readOneLineFile__("/sys/block/%s/size" % dev))
 
+UDEV_DB = '/run/udev/data'
+
+def readUdevProperty(dev, key):
+    """Returns property key of block device dev from the udev database, or None"""
+    try:
+        major, minor = getMajMin(dev)
+        for line in open('%s/b%d:%d' % (UDEV_DB, major, minor)):
+            if line.startswith('E:%s=' % key):
+                return line.rstrip('\n').split('=', 1)[1]
+    except (IOError, OSError):
+        pass
+    return None
+
+def readVpdPage(dev, page):
+    """Returns the payload of SCSI VPD page (0x80 or 0x83) of dev as cached by the
+    kernel in sysfs, or None"""
+    name = dev[5:].replace("/", "!")
+    try:
+        data = open('/sys/block/%s/device/vpd_pg%x' % (name, page), 'rb').read()
+    except IOError:
+        return None
+    if len(data) < 4 or ord(data[1]) != page:
+        return None
+    length = struct.unpack('>H', data[2:4])[0]
+    return data[4:4 + length]
+
+def readDiskSerialNumber(dev):
+    # The unit serial number VPD page is what sdparm -p sn reports
+    serial = readVpdPage(dev, 0x80)
+    if serial is not None:
+        serial = serial.strip(' \0')
+    if not serial:
+        serial = readUdevProperty(dev, 'ID_SERIAL_SHORT')
+    if not serial:
+        serial = _sysfsBlockAttr(dev, 'device/serial') # NVMe, MMC
+    if serial:
+        return serial
+
+    rc, out = util.runCmd2(['/bin/sdparm', '-q', '-i', '-p', 'sn', dev], with_stdout=True)
+    if rc == 0:
+        lines = out.split('\n')
+        if len(lines) >= 2:
+            return lines[1].strip()
+    return ""
+
+cached_serials = {}
+
 def getDiskSerialNumber(dev):
     # For Multipath nodes return info about 1st slave
     if not dev.startswith("/dev/"):
@@ -321,12 +373,39 @@ def getDiskSerialNumber(dev):
         serials = set(map(getDiskSerialNumber, getDeviceSlaves(dev)))
         return '/'.join(serials)
 
-    rc, out = util.runCmd2(['/bin/sdparm', '-q', '-i', '-p', 'sn', dev], with_stdout=True)
-    if rc == 0:
-        lines = out.split('\n')
-        if len(lines) >= 2:
-            return lines[1].strip()
-    return ""
+    if dev not in cached_serials:
+        cached_serials[dev] = readDiskSerialNumber(dev)
+    return cached_serials[dev]
+
+VPD_DESIGNATOR_NAA = 3
+
+def readVpdNAA(dev):
+    """Returns the NAA logical unit designator from the device identification
+    VPD page of dev in the form used by the kernel's wwid, or None"""
+    page = readVpdPage(dev, 0x83)
+    offset = 0
+    while page is not None and offset + 4 <= len(page):
+        designator_type = ord(page[offset + 1]) & 0x0f
+        association = (ord(page[offset + 1]) >> 4) & 0x03
+        length = ord(page[offset + 3])
+        if designator_type == VPD_DESIGNATOR_NAA and association == 0:
+            return 'naa.' + page[offset + 4:offset + 4 + length].encode('hex')
+        offset += 4 + length
+    return None
+
+cached_wwns = {}
+
+def getDiskWWN(dev):
+    """Returns the world wide name of a disk, or "" if it has none"""
+    if not dev.startswith("/dev/"):
+        dev = '/dev/' + dev
+    if isDeviceMapperNode(dev):
+        slaves = getDeviceSlaves(dev)
+        return slaves and getDiskWWN(slaves[0]) or ""
+    if dev not in cached_wwns:
+        cached_wwns[dev] = _sysfsBlockAttr(dev, 'device/wwid') or _sysfsBlockAttr(dev, 'wwid') or \
+                           readVpdNAA(dev) or readUdevProperty(dev, 'ID_WWN') or ""
+    return cached_wwns[dev]
 
 def isRemovable(path):
 
@@ -379,14 +458,65 @@ def getExtendedDiskInfo(disk, inMb=0):
             inMb and (getDiskDeviceSize(disk)/2048) or getDiskDeviceSize(disk))
 
 
+# ext2/3/4 superblock layout, see struct ext4_super_block
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_SUPERBLOCK_SIZE = 1024
+EXT_SUPER_MAGIC = 0xef53
+
+def readExtSuperblock(partition):
+    """Reads the superblock of an ext2/3/4 filesystem directly from partition.
+    Returns a dict with its label, uuid, last write time and feature flags, or
+    None if partition does not hold an ext filesystem"""
+    f = open(partition, 'rb')
+    try:
+        f.seek(EXT_SUPERBLOCK_OFFSET)
+        sb = f.read(EXT_SUPERBLOCK_SIZE)
+    finally:
+        f.close()
+    if len(sb) < EXT_SUPERBLOCK_SIZE:
+        return None
+    magic, = struct.unpack('<H', sb[0x38:0x3a])
+    if magic != EXT_SUPER_MAGIC:
+        return None
+    wtime, = struct.unpack('<I', sb[0x30:0x34])
+    rev_level, = struct.unpack('<I', sb[0x4c:0x50])
+    feature_compat, feature_incompat, feature_ro_compat = struct.unpack('<III', sb[0x5c:0x68])
+    return {
+        'label': sb[0x78:0x88].split('\0', 1)[0],
+        'uuid': str(uuid.UUID(bytes=sb[0x68:0x78])),
+        'wtime': wtime,
+        'rev_level': rev_level,
+        'feature_compat': feature_compat,
+        'feature_incompat': feature_incompat,
+        'feature_ro_compat': feature_ro_compat,
+        }
+
+def readExtSuperblocks(partitions):
+    """Batch form of readExtSuperblock: returns a dict mapping each of partitions
+    to its superblock dict, or None if it is not ext or cannot be read"""
+    superblocks = {}
+    for partition in partitions:
+        try:
+            superblocks[partition] = readExtSuperblock(partition)
+        except (IOError, OSError) as e:
+            logger.log("Could not read superblock of %s: %s" % (partition, str(e)))
+            superblocks[partition] = None
+    return superblocks
+
 def readExtPartitionLabel(partition):
     """Read the ext partition label."""
-    rc, out = util.runCmd2(['/sbin/e2label', partition], with_stdout=True)
-    if rc == 0:
-        label = out.strip()
-    else:
+    try:
+        sb = readExtSuperblock(partition)
+    except (IOError, OSError):
+        sb = None
+    if sb is None:
         raise Exception("%s is not ext partition" % partition)
-    return label
+    return sb['label']
+
+def readExtPartitionLabels(partitions):
+    """Returns a dict mapping each of partitions that holds an ext filesystem to its label"""
+    return dict([(partition, sb['label']) for partition, sb in readExtSuperblocks(partitions).items()
+                 if sb is not None])
 
 def getMdDeviceName(disk):
     rv, out = util.runCmd2(['mdadm', '--detail', '--export', disk],
@@ -419,6 +549,118 @@ def getHumanDiskName(disk):
         return disk[5:]
     return disk
 
+class DiskInfo(object):
+    """Immutable description of a disk as shown to the user.  Multipath nodes
+    describe their first path, RAID arrays combine their members"""
+    __slots__ = ('device', 'vendor', 'model', 'size', 'serial', 'wwn', 'humanName',
+                 'removable', 'isRaid', 'isDeviceMapper', 'slaves')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("DiskInfo is immutable")
+
+    def extendedInfo(self):
+        """Returns (vendor, model, size) as getExtendedDiskInfo does"""
+        return (self.vendor, self.model, self.size)
+
+    def entryText(self):
+        return "%s - %s [%s %s]" % (self.humanName, getHumanDiskSize(self.size), self.vendor, self.model)
+
+    def __repr__(self):
+        return "<DiskInfo %s>" % ', '.join(['%s=%r' % (name, getattr(self, name)) for name in self.__slots__])
+
+def _sysfsBlockAttr(dev, attr):
+    path = "/sys/block/%s/%s" % (dev[5:].replace("/", "!"), attr)
+    if os.path.exists(path):
+        return __readOneLineFile__(path).strip(' \n')
+    return None
+
+def _probeDiskInfo(dev, md_nodes):
+    is_dm = isDeviceMapperNode(dev)
+    is_raid = dev in md_nodes
+    slaves = (is_dm or is_raid) and getDeviceSlaves(dev) or []
+
+    # Multipath nodes describe their first path
+    if is_dm and slaves:
+        info = _probeDiskInfo(slaves[0], md_nodes)
+        return DiskInfo(device=dev, vendor=info.vendor, model=info.model, size=info.size,
+                        serial=info.serial, wwn=info.wwn, humanName=info.humanName, removable=False,
+                        isRaid=False, isDeviceMapper=True, slaves=tuple(slaves))
+
+    if is_raid:
+        members = [_probeDiskInfo(slave, md_nodes) for slave in slaves]
+        vendor = '/'.join(set([member.vendor for member in members]))
+        model = '/'.join(set([member.model for member in members]))
+        serial = '/'.join(set([member.serial for member in members]))
+        humanName = getHumanDiskName(dev)
+    else:
+        vendor = _sysfsBlockAttr(dev, 'device/vendor') or ""
+        model = _sysfsBlockAttr(dev, 'device/model') or ""
+        serial = getDiskSerialNumber(dev)
+        humanName = getHumanDiskName(dev)
+
+    size = _sysfsBlockAttr(dev, 'device/block/size') or _sysfsBlockAttr(dev, 'size')
+    return DiskInfo(device=dev, vendor=vendor, model=model, size=size and int(size),
+                    serial=serial, wwn=not is_raid and getDiskWWN(dev) or "", humanName=humanName, removable=isRemovable(dev),
+                    isRaid=is_raid, isDeviceMapper=is_dm, slaves=tuple(slaves))
+
+class DiskInventory(object):
+    """DiskInfo records for a set of disks (by default all of them), probed in
+    parallel.  Iterates in the order of the disks given"""
+    PARALLEL = 8
+
+    def __init__(self, disks=None):
+        if disks is None:
+            disks = getQualifiedDiskList()
+        self.disks = [disk.startswith('/dev/') and disk or '/dev/' + disk for disk in disks]
+        md_nodes = getMdNodes()
+
+        def probe(disk):
+            try:
+                return _probeDiskInfo(disk, md_nodes)
+            except Exception as e:
+                logger.log("Failed to probe disk %s: %s" % (disk, str(e)))
+                return None
+
+        infos = util.parallelMap(probe, self.disks, self.PARALLEL)
+        self.info = dict([(info.device, info) for info in infos if info is not None])
+        self.disks = [disk for disk in self.disks if disk in self.info]
+
+    def __iter__(self):
+        return iter([self.info[disk] for disk in self.disks])
+
+    def __len__(self):
+        return len(self.disks)
+
+    def __contains__(self, disk):
+        return disk in self.info
+
+    def __getitem__(self, disk):
+        return self.info[disk]
+
+    def get(self, disk, default=None):
+        return self.info.get(disk, default)
+
+    def raidMembers(self):
+        """Returns the set of disks that are members of a RAID array in the inventory"""
+        return set([slave for info in self if info.isRaid for slave in info.slaves])
+
+cached_inventory = None
+
+def getDiskInventory(disks=None, refresh=False):
+    """Returns the DiskInventory of disks, reusing the last one built if it
+    covers them unless refresh is set"""
+    global cached_inventory
+    if disks is not None:
+        disks = [disk.startswith('/dev/') and disk or '/dev/' + disk for disk in disks]
+    if refresh or cached_inventory is None or \
+            (disks is not None and [disk for disk in disks if disk not in cached_inventory]):
+        cached_inventory = DiskInventory(disks)
+    return cached_inventory
+
 # given a list of disks, work out which ones are part of volume
 # groups that will cause a problem if we install XE to those disks:
 def findProblematicVGs(disks):
@@ -465,7 +707,8 @@ def log_available_disks():
     else:
         # make sure that we have enough disk space:
         logger.log("Found disks: %s" % str(disks))
-        diskSizes = [getDiskDeviceSize(x) for x in disks]
+        inventory = getDiskInventory(disks, refresh=True)
+        diskSizes = [info.size for info in inventory]
         diskSizesGB = [blockSizeToGBSize(x) for x in diskSizes]
         logger.log("Disk sizes: %s" % str(diskSizesGB))
 
@@ -483,7 +726,16 @@ INSTALL_RETAIL = 1
 STORAGE_LVM = 1
 STORAGE_EXT3 = 2
 
-def probeDisk(device, justInstall=False):
+PROBE_PARALLEL = 8 # Disks to probe at once
+
+def probeDisks(devices, justInstall=False):
+    """Runs probeDisk on each of devices concurrently, sharing one LVM snapshot.
+    Returns the results in the order of devices"""
+    lv_tool = not justInstall and LVMTool() or None
+    return util.parallelMap(lambda device: probeDisk(device, justInstall, lv_tool),
+                            devices, PROBE_PARALLEL)
+
+def probeDisk(device, justInstall=False, lv_tool=None):
     """Examines device and reports the apparent presence of a XenServer installation and/or related usage
     Returns a tuple (boot, state, storage)
 
@@ -503,15 +755,11 @@ def probeDisk(device, justInstall=False):
     possible_srs = []
 
     tool = PartitionTool(device)
+    labels = readExtPartitionLabels([tool._partitionDevice(num) for num, part in tool.iteritems()
+                                     if part['id'] == tool.ID_LINUX])
     for num, part in tool.iteritems():
-        label = None
         part_device = tool._partitionDevice(num)
-
-        if part['id'] == tool.ID_LINUX:
-            try:
-                label = readExtPartitionLabel(part_device)
-            except:
-                pass
+        label = labels.get(part_device)
 
         if part['id'] == tool.ID_LINUX:
             # probe for retail
@@ -530,7 +778,7 @@ def probeDisk(device, justInstall=False):
             boot = (True, part_device)
 
     if not justInstall:
-        lv_tool = len(possible_srs) and LVMTool()
+        lv_tool = len(possible_srs) and (lv_tool or LVMTool())
         for num in possible_srs:
             part_device = tool._partitionDevice(num)
 
@@ -549,6 +797,37 @@ def probeDisk(device, justInstall=False):
 
     return (boot, root, state, storage, logs)
 
+# Bytes at the start of a partition that hold its LVM label and metadata
+# area header, or its ext superblock
+PROBE_HEADER_SIZE = 8192
+
+def readPartitionFingerprint(partition, superblock=None):
+    """Returns a list identifying the contents probeDisk looks at on partition:
+    its size and, for an ext filesystem, its uuid and last write time, or
+    otherwise a checksum of the header holding any LVM metadata"""
+    _, size = getBlockDeviceSize(partition)
+    if superblock:
+        return [size, superblock['uuid'], superblock['wtime']]
+    f = open(partition, 'rb')
+    try:
+        header = f.read(PROBE_HEADER_SIZE)
+    finally:
+        f.close()
+    return [size, crc32(header)]
+
+def readDiskFingerprint(device):
+    """Returns a list that changes whenever the result of probeDisk(device)
+    might, read without mounting anything, or None if device cannot be read"""
+    try:
+        tool = PartitionTool(device)
+        parts = [(num, part, tool._partitionDevice(num)) for num, part in tool.iteritems()]
+        superblocks = readExtSuperblocks([part_device for _, _, part_device in parts])
+        return [[num, part['id'], part['start'], part['size'],
+                 readPartitionFingerprint(part_device, superblocks[part_device])]
+                for num, part, part_device in parts]
+    except Exception as e:
+        logger.log("Could not fingerprint %s: %s" % (device, str(e)))
+        return None
 
 # Keep track of iscsi disks we have logged into
 iscsi_disks = []
@@ -753,6 +1032,7 @@ def process_ibft(ui, interactive):
 
     # Attach disks
     rv = util.runCmd2(['iscsistart', '-b'])
+    invalidateLVMSnapshot()
     if rv:
         raise RuntimeError('Failed to attach iSCSI target disk(s)')
 
@@ -776,6 +1056,7 @@ def release_ibft_disks():
     if util.pidof('iscsid'):
         util.runCmd2([ '/sbin/iscsiadm', '-m', 'session', '-u'])
         util.runCmd2([ '/sbin/iscsiadm', '-k', '0'])
+        invalidateLVMSnapshot()
         iscsi_disks = []
 
 
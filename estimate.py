@@ -0,0 +1,115 @@
+# Copyright (c) Citrix Systems 2009.  All rights reserved.
+# Xen, the Xen logo, XenCenter, XenMotion are trademarks or registered
+# trademarks of Citrix Systems, Inc., in the United States and other
+# countries.
+
+###
+#
+# Rough predictions of how long a backup, restore or repartitioning will
+# take, from the amount of data involved and short sequential read probes of
+# the partitions involved.  Nothing is written to them.
+#
+###
+
+import os
+import time
+import util
+from xcp import logger
+
+# Amount of data read by one throughput probe
+PROBE_BYTES = 64 * 2**20
+PROBE_BLOCK_MB = 1
+# Number of entries looked at to measure the cost of scanning a tree
+SAMPLE_ENTRIES = 2000
+# Seconds spent creating a file and setting its ownership, mode and times,
+# on top of moving its data
+FILE_OVERHEAD = 0.0005
+# Throughput assumed when a partition cannot be probed
+DEFAULT_THROUGHPUT = 50 * 2**20
+# Seconds taken to write a partition table and for udev to catch up
+REPARTITION_SECONDS = 10
+# mkfs.ext3 zeroes its inode tables, a 256 byte inode for every 16KiB, and
+# writes a journal of up to 128MiB
+MKFS_INODE_RATIO = 64
+MKFS_JOURNAL_BYTES = 128 * 2**20
+
+class TreeSize:
+    """The amount of data in a filesystem, and the time taken to scan one of
+    its entries"""
+    def __init__(self, bytes, files, scan_cost):
+        self.bytes = bytes
+        self.files = files
+        self.scan_cost = scan_cost
+
+def measureTree(root):
+    """Returns the TreeSize of the filesystem mounted at root.  The totals
+    come from statvfs; only a sample of the tree is walked, to time scanning
+    it."""
+    st = os.statvfs(root)
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    files = st.f_files - st.f_ffree
+
+    sampled = 0
+    started = time.time()
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            try:
+                os.lstat(os.path.join(dirpath, name))
+            except OSError:
+                pass
+            sampled += 1
+        if sampled >= SAMPLE_ENTRIES:
+            break
+    scan_cost = (time.time() - started) / max(sampled, 1)
+    logger.log("%s: %d bytes in %d files, %.6fs to scan each (%d sampled)" %
+               (root, used, files, scan_cost, sampled))
+    return TreeSize(used, files, scan_cost)
+
+def _timeDd(args, size):
+    started = time.time()
+    rc, err = util.runCmd2(['dd', 'bs=%dM' % PROBE_BLOCK_MB, 'count=%d' % (size / (PROBE_BLOCK_MB * 2**20))] + args,
+                           with_stderr=True)
+    elapsed = time.time() - started
+    if rc != 0:
+        logger.log("Throughput probe failed: %s" % err.strip())
+        return None
+    return size / max(elapsed, 0.001)
+
+def readThroughput(device):
+    """Returns the sequential read rate of device in bytes per second, or
+    None if it could not be measured"""
+    return _timeDd(['if=' + device, 'of=/dev/null', 'iflag=direct'], PROBE_BYTES)
+
+def mkfsBytes(size):
+    """Returns the number of bytes mkfs.ext3 writes to a device of size bytes"""
+    return size / MKFS_INODE_RATIO + min(size / 1024, MKFS_JOURNAL_BYTES)
+
+def copySeconds(bytes, files, read_rate, write_rate, scan_cost=0):
+    """Predicts the seconds taken to copy bytes of data in files files"""
+    return bytes / float(min(read_rate, write_rate)) + files * (scan_cost + FILE_OVERHEAD)
+
+def formatDuration(seconds):
+    if seconds >= 90:
+        return "%d minutes" % ((seconds + 30) / 60)
+    return "%d seconds" % max(seconds, 1)
+
+class Estimate:
+    """The predicted duration of each phase of an operation"""
+    def __init__(self):
+        self.phases = []
+
+    def add(self, name, bytes, seconds):
+        self.phases.append((name, bytes, int(seconds)))
+
+    def seconds(self):
+        return sum([seconds for _, _, seconds in self.phases])
+
+    def __str__(self):
+        return "about %s (%s)" % (formatDuration(self.seconds()),
+                                  ", ".join(["%s %d MB: %s" % (name, bytes / 2**20, formatDuration(seconds))
+                                             for name, bytes, seconds in self.phases]))
+
+    def log(self, what):
+        for name, bytes, seconds in self.phases:
+            logger.log("Estimate for %s: %s of %d bytes, %d seconds" % (what, name, bytes, seconds))
+        logger.log("Estimate for %s: %d seconds in total" % (what, self.seconds()))
@@ -97,6 +97,7 @@ def start_fcoe(interfaces):
     # of seconds for FCoE to stabilize.
     time.sleep(30)
     util.runCmd2(util.udevsettleCmd())
+    invalidateLVMSnapshot()
     for interface, status in result.iteritems():
         if status == 'OK':
             logger.log(get_luns_on_intf(interface))
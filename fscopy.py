@@ -0,0 +1,465 @@
+# Copyright (c) Citrix Systems 2009.  All rights reserved.
+# Xen, the Xen logo, XenCenter, XenMotion are trademarks or registered
+# trademarks of Citrix Systems, Inc., in the United States and other
+# countries.
+
+###
+#
+# Native copy of a filesystem tree, preserving ownership, permissions,
+# extended attributes (and so ACLs), hardlinks, device nodes and sparse files
+# the way 'cp -a' does, copying file data from a pool of threads.
+#
+###
+
+import os
+import stat
+import shutil
+import hashlib
+import errno
+import time
+import threading
+import Queue
+try:
+    import ctypes, ctypes.util
+except ImportError:
+    ctypes = None
+from xcp import logger
+
+# Number of files copied at once
+COPY_PARALLEL = 8
+# Largest amount of data moved by one copy_file_range or read/write call
+COPY_CHUNK = 8 * 2**20
+# Seconds between calls to the progress callback
+PROGRESS_INTERVAL = 0.5
+
+SEEK_DATA = 3
+SEEK_HOLE = 4
+XATTR_LIST_SIZE = 64 * 1024
+XATTR_VALUE_SIZE = 64 * 1024
+
+libc = None
+if ctypes:
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        pass
+
+def _libcFunction(name, restype, argtypes):
+    if libc is None or not hasattr(libc, name):
+        return None
+    f = getattr(libc, name)
+    f.restype = restype
+    f.argtypes = argtypes
+    return f
+
+if libc:
+    class timeval(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_usec', ctypes.c_long)]
+
+    _copy_file_range = _libcFunction('copy_file_range', ctypes.c_ssize_t,
+                                     [ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+                                      ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+                                      ctypes.c_size_t, ctypes.c_uint])
+    _llistxattr = _libcFunction('llistxattr', ctypes.c_ssize_t,
+                                [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t])
+    _lgetxattr = _libcFunction('lgetxattr', ctypes.c_ssize_t,
+                               [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t])
+    _lsetxattr = _libcFunction('lsetxattr', ctypes.c_int,
+                               [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t,
+                                ctypes.c_int])
+    _lutimes = _libcFunction('lutimes', ctypes.c_int,
+                             [ctypes.c_char_p, ctypes.POINTER(timeval)])
+else:
+    _copy_file_range = _llistxattr = _lgetxattr = _lsetxattr = _lutimes = None
+
+def _libcError(path):
+    e = ctypes.get_errno()
+    return OSError(e, os.strerror(e), path)
+
+def listXattrs(path):
+    """Returns the names of the extended attributes of path, not following
+    symlinks, or [] if they cannot be read"""
+    if _llistxattr is None:
+        return []
+    buf = ctypes.create_string_buffer(XATTR_LIST_SIZE)
+    size = _llistxattr(path, buf, XATTR_LIST_SIZE)
+    if size < 0:
+        e = ctypes.get_errno()
+        if e in (errno.ENOTSUP, errno.ENOSYS):
+            return []
+        raise _libcError(path)
+    return [name for name in buf.raw[:size].split('\0') if name]
+
+def getXattr(path, name):
+    buf = ctypes.create_string_buffer(XATTR_VALUE_SIZE)
+    size = _lgetxattr(path, name, buf, XATTR_VALUE_SIZE)
+    if size < 0:
+        raise _libcError(path)
+    return buf.raw[:size]
+
+def setXattr(path, name, value):
+    if _lsetxattr(path, name, value, len(value), 0) != 0:
+        raise _libcError(path)
+
+def copyXattrs(src, dest):
+    """Copies the extended attributes of src, which include its POSIX ACLs and
+    security labels, to dest.  Like 'cp -a', those that the filesystem of dest
+    does not support or does not allow to be set are skipped with a warning."""
+    for name in listXattrs(src):
+        try:
+            setXattr(dest, name, getXattr(src, name))
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP, errno.EPERM):
+                raise
+            logger.log("Warning: cannot copy extended attribute %s of %s: %s" % (name, src, e.strerror))
+
+def setTimes(path, st):
+    """Sets the access and modification times of path to those in st, without
+    following symlinks"""
+    if not stat.S_ISLNK(st.st_mode):
+        os.utime(path, (st.st_atime, st.st_mtime))
+    elif _lutimes:
+        times = (timeval * 2)()
+        for tv, t in zip(times, (st.st_atime, st.st_mtime)):
+            tv.tv_sec = int(t)
+            tv.tv_usec = int((t - int(t)) * 1000000)
+        if _lutimes(path, times) != 0:
+            raise _libcError(path)
+
+def copyMetadata(src, dest, st, id_map=None):
+    """Gives dest the ownership, permissions, extended attributes and times of
+    src, whose lstat result is st.  If given, id_map(uid, gid) returns the
+    (uid, gid) to give dest instead of those of src."""
+    uid, gid = st.st_uid, st.st_gid
+    if id_map:
+        uid, gid = id_map(uid, gid)
+    os.lchown(dest, uid, gid)
+    if not stat.S_ISLNK(st.st_mode):
+        # after chown, which clears setuid and setgid bits
+        os.chmod(dest, stat.S_IMODE(st.st_mode))
+    copyXattrs(src, dest)
+    setTimes(dest, st)
+
+def _dataSegments(fd, size, sparse):
+    """Yields (offset, length) for the parts of the file open on fd holding
+    data.  Holes are only looked for if sparse is True."""
+    if not sparse:
+        yield 0, size
+        return
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # no more data before the end of the file
+                return
+            if e.errno == errno.EINVAL:
+                # SEEK_DATA not supported
+                yield offset, size - offset
+                return
+            raise
+        end = os.lseek(fd, start, SEEK_HOLE)
+        yield start, end - start
+        offset = end
+
+def removePath(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+def fileDigest(path):
+    h = hashlib.md5()
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(COPY_CHUNK)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+    return h.digest()
+
+class TreeCopy(object):
+    """Copies the tree under src into the existing directory dest like
+    'cp -a src/* dest/' would.  The tree is walked once up front by scan() so
+    that copy() can report progress in bytes.
+
+    Top-level entries named in empty_dirs are created as empty directories
+    rather than copied, e.g. for mount points of pseudo filesystems.
+
+    If include_root is True, src itself is copied to dest like 'cp -a src
+    dest' would, giving dest the metadata of src.  This is implied when src is
+    not a directory.
+
+    If update is True, dest may already hold an older copy of the tree, which
+    is brought up to date rsync-style: entries not in src are removed, and
+    files whose size and modification time (and contents, if checksum is True)
+    match are kept, only having their metadata refreshed.  If merge is True,
+    entries already in dest are replaced by those from src and others are left
+    alone.
+
+    id_map is passed to copyMetadata to translate the ownership of entries."""
+
+    def __init__(self, src, dest, empty_dirs=[], parallel=COPY_PARALLEL, update=False, checksum=False,
+                 include_root=False, merge=False, id_map=None):
+        self.src = src
+        self.dest = dest
+        self.empty_dirs = empty_dirs
+        self.parallel = parallel
+        self.update = update
+        self.checksum = checksum
+        self.include_root = include_root
+        self.merge = merge
+        self.id_map = id_map
+        self.entries = None
+        self.totalBytes = 0
+        self.copiedBytes = 0
+        self.lock = threading.Lock()
+        self.useCopyFileRange = _copy_file_range is not None
+
+    def _src(self, path):
+        return path and os.path.join(self.src, path) or self.src
+
+    def _dest(self, path):
+        return path and os.path.join(self.dest, path) or self.dest
+
+    def scan(self):
+        """Walks src, recording every entry to copy and the number of bytes in
+        regular files.  Files hardlinked together are only counted once."""
+        self.entries = []
+        self.totalBytes = 0
+        inodes = {}
+
+        def walk(rel):
+            for name in sorted(os.listdir(self._src(rel))):
+                path = os.path.join(rel, name)
+                st = os.lstat(self._src(path))
+                link = None
+                if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                    link = inodes.setdefault((st.st_dev, st.st_ino), path)
+                    if link == path:
+                        link = None
+                self.entries.append((path, st, link))
+                if stat.S_ISREG(st.st_mode) and link is None:
+                    self.totalBytes += st.st_size
+                elif stat.S_ISDIR(st.st_mode) and not (rel == '' and name in self.empty_dirs):
+                    walk(path)
+
+        st = os.lstat(self.src)
+        if self.include_root or not stat.S_ISDIR(st.st_mode):
+            self.entries.append(('', st, None))
+            if stat.S_ISREG(st.st_mode):
+                self.totalBytes += st.st_size
+        if stat.S_ISDIR(st.st_mode):
+            walk('')
+        logger.log("%s holds %d entries, %d bytes in files" % (self.src, len(self.entries), self.totalBytes))
+        return self.totalBytes
+
+    def copy(self, progress_callback=lambda copied, total, eta: ()):
+        """Copies the tree, calling progress_callback from this thread with the
+        bytes copied so far, the total and an estimate of the seconds left (or
+        None until one can be made)."""
+        if self.entries is None:
+            self.scan()
+        started = time.time()
+
+        def progress():
+            copied = self.copiedBytes
+            eta = None
+            elapsed = time.time() - started
+            if copied > 0 and elapsed > 0:
+                eta = int((self.totalBytes - copied) * elapsed / copied)
+            progress_callback(copied, self.totalBytes, eta)
+
+        if self.update:
+            self._removeExtraneous()
+
+        # Create the directories and everything else that has no data first,
+        # so that the files can be copied in any order
+        files = []
+        kept = 0
+        for path, st, link in self.entries:
+            dest = self._dest(path)
+            mode = st.st_mode
+            if (self.update or self.merge) and link is None and os.path.lexists(dest):
+                dest_st = os.lstat(dest)
+                if stat.S_ISDIR(mode) and stat.S_ISDIR(dest_st.st_mode):
+                    # kept, and given the metadata of src (through id_map)
+                    # by the last pass below, as 'cp -a' would
+                    continue
+                if self.update and self._unchanged(path, st, dest_st):
+                    copyMetadata(self._src(path), dest, st, self.id_map)
+                    kept += 1
+                    if stat.S_ISREG(mode):
+                        with self.lock:
+                            self.copiedBytes += st.st_size
+                    continue
+                removePath(dest)
+            if stat.S_ISDIR(mode):
+                if path in self.empty_dirs:
+                    if not os.path.isdir(dest):
+                        os.mkdir(dest, 0755)
+                elif not os.path.isdir(dest):
+                    os.mkdir(dest, 0700)
+            elif stat.S_ISLNK(mode):
+                os.symlink(os.readlink(self._src(path)), dest)
+                copyMetadata(self._src(path), dest, st, self.id_map)
+            elif stat.S_ISREG(mode):
+                if link is None:
+                    files.append((path, st))
+            else:
+                os.mknod(dest, stat.S_IFMT(mode) | 0600, st.st_rdev)
+                copyMetadata(self._src(path), dest, st, self.id_map)
+        progress()
+
+        self._copyFiles(files, progress)
+
+        for path, st, link in self.entries:
+            if link is not None:
+                target = self._dest(link)
+                dest = self._dest(path)
+                if (self.update or self.merge) and os.path.lexists(dest):
+                    if os.path.samefile(target, dest):
+                        continue
+                    removePath(dest)
+                os.link(target, dest)
+
+        # Deepest first, so creating entries doesn't change a parent's mtime
+        for path, st, link in reversed(self.entries):
+            if stat.S_ISDIR(st.st_mode) and path not in self.empty_dirs:
+                copyMetadata(self._src(path), self._dest(path), st, self.id_map)
+        progress()
+        if self.update:
+            logger.log("Kept %d unchanged entries in %s" % (kept, self.dest))
+        logger.log("Copied %d bytes from %s to %s in %d seconds" %
+                   (self.copiedBytes, self.src, self.dest, time.time() - started))
+
+    def _unchanged(self, path, st, dest_st):
+        """Returns True if the existing dest_st, the lstat result of path in
+        dest, can be kept as the copy of path, whose lstat result is st."""
+        if stat.S_IFMT(st.st_mode) != stat.S_IFMT(dest_st.st_mode):
+            return False
+        if stat.S_ISLNK(st.st_mode):
+            return os.readlink(self._src(path)) == os.readlink(self._dest(path))
+        if stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+            return st.st_rdev == dest_st.st_rdev
+        if stat.S_ISREG(st.st_mode):
+            if st.st_size != dest_st.st_size or int(st.st_mtime) != int(dest_st.st_mtime):
+                return False
+            if self.checksum:
+                return fileDigest(self._src(path)) == fileDigest(self._dest(path))
+        return True
+
+    def _removeExtraneous(self):
+        """Removes everything under dest that is not in src"""
+        paths = set([path for path, st, link in self.entries])
+
+        def prune(rel):
+            for name in os.listdir(self._dest(rel)):
+                path = os.path.join(rel, name)
+                dest = self._dest(path)
+                if path not in paths:
+                    removePath(dest)
+                elif os.path.isdir(dest) and not os.path.islink(dest) and path not in self.empty_dirs:
+                    prune(path)
+
+        prune('')
+
+    def _copyFiles(self, files, progress):
+        pending = Queue.Queue()
+        for f in files:
+            pending.put(f)
+        errors = []
+
+        def worker():
+            while not errors:
+                try:
+                    path, st = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self._copyFile(path, st)
+                except Exception as e:
+                    errors.append((path, e))
+
+        threads = [threading.Thread(target=worker) for _ in range(min(self.parallel, len(files)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.isAlive():
+                thread.join(PROGRESS_INTERVAL)
+                progress()
+        if errors:
+            path, e = errors[0]
+            logger.log("Failed to copy %s: %s" % (path, str(e)))
+            raise e
+
+    def _copyFile(self, path, st):
+        src = self._src(path)
+        dest = self._dest(path)
+        fin = os.open(src, os.O_RDONLY)
+        try:
+            fout = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            try:
+                sparse = st.st_blocks * 512 < st.st_size
+                copied = 0
+                for offset, length in _dataSegments(fin, st.st_size, sparse):
+                    copied += self._copyRange(fin, fout, offset, length)
+                if sparse:
+                    os.ftruncate(fout, st.st_size)
+                    # count the holes as copied too
+                    with self.lock:
+                        self.copiedBytes += max(st.st_size - copied, 0)
+            finally:
+                os.close(fout)
+        finally:
+            os.close(fin)
+        copyMetadata(src, dest, st, self.id_map)
+
+    def _copyRange(self, fin, fout, offset, length):
+        """Copies length bytes at offset between the files open on fin and
+        fout.  Returns the number of bytes copied."""
+        start = offset
+        end = offset + length
+        while offset < end:
+            count = min(COPY_CHUNK, end - offset)
+            done = 0
+            if self.useCopyFileRange:
+                off_in = ctypes.c_longlong(offset)
+                off_out = ctypes.c_longlong(offset)
+                done = _copy_file_range(fin, ctypes.byref(off_in), fout, ctypes.byref(off_out), count, 0)
+                if done < 0:
+                    e = ctypes.get_errno()
+                    if e not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                        raise OSError(e, os.strerror(e))
+                    # not possible between these filesystems, stop trying
+                    self.useCopyFileRange = False
+                    done = 0
+            if not self.useCopyFileRange:
+                os.lseek(fin, offset, os.SEEK_SET)
+                data = os.read(fin, count)
+                os.lseek(fout, offset, os.SEEK_SET)
+                written = 0
+                while written < len(data):
+                    written += os.write(fout, data[written:])
+                done = len(data)
+            if done == 0:
+                # the file shrank while being copied
+                break
+            offset += done
+            with self.lock:
+                self.copiedBytes += done
+        return offset - start
+
+def formatProgress(copied, total, eta):
+    """Describes the progress of a copy in a few words"""
+    text = "%d of %d MB copied" % (copied / 2**20, total / 2**20)
+    if eta is not None:
+        if eta >= 90:
+            text += ", about %d minutes left" % ((eta + 30) / 60)
+        else:
+            text += ", about %d seconds left" % eta
+    return text
@@ -0,0 +1,271 @@
+# Copyright (c) Citrix Systems 2009.  All rights reserved.
+# Xen, the Xen logo, XenCenter, XenMotion are trademarks or registered
+# trademarks of Citrix Systems, Inc., in the United States and other
+# countries.
+
+###
+#
+# Block-level images of ext2/3/4 filesystems.  Only the blocks the block
+# bitmaps mark as in use are copied, into a sparse image file at their
+# original offsets, with a manifest listing them so that a restore is one
+# sequential pass over the target partition.
+#
+###
+
+import os
+import struct
+import hashlib
+import time
+import simplejson as json
+import util
+from disktools import getBlockDeviceSize
+from xcp import logger
+
+IMAGE_FILE = '.xen-root.img'
+MANIFEST_FILE = '.xen-root-image.json'
+MANIFEST_VERSION = 1
+
+# Largest amount of data moved by one read/write
+IMAGE_CHUNK = 8 * 2**20
+# Seconds between calls to the progress callback
+PROGRESS_INTERVAL = 0.5
+
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_SUPERBLOCK_SIZE = 1024
+EXT_SUPER_MAGIC = 0xef53
+EXT_FEATURE_INCOMPAT_RECOVER = 0x0004
+EXT_FEATURE_INCOMPAT_META_BG = 0x0010
+EXT_FEATURE_INCOMPAT_64BIT = 0x0080
+EXT_FEATURE_RO_COMPAT_BIGALLOC = 0x0200
+# sparse_super, large_file, huge_file, uninit_bg, dir_nlink, extra_isize,
+# quota, metadata_csum, readonly, project, verity and orphan_present, which
+# leave the block bitmaps one bit per block
+EXT_FEATURE_RO_COMPAT_SUPPORTED = 0x1b57b
+EXT_BG_BLOCK_UNINIT = 0x0002
+EXT_MIN_DESC_SIZE_64BIT = 64
+
+class ExtLayout:
+    """The geometry of an ext filesystem, read from its superblock"""
+    def __init__(self, sb):
+        (self.blocksCount, self.firstDataBlock, logBlockSize,
+         self.blocksPerGroup) = struct.unpack('<I12xII4xI', sb[0x04:0x24])
+        self.blockSize = 1024 << logBlockSize
+        self.featureIncompat, self.featureRoCompat = struct.unpack('<II', sb[0x60:0x68])
+        self.uuid = sb[0x68:0x78].encode('hex')
+        self.label = sb[0x78:0x88].split('\0', 1)[0]
+        self.descSize = 32
+        if self.featureIncompat & EXT_FEATURE_INCOMPAT_64BIT:
+            blocksCountHi, = struct.unpack('<I', sb[0x150:0x154])
+            self.blocksCount |= blocksCountHi << 32
+            self.descSize = max(struct.unpack('<H', sb[0xfe:0x100])[0], EXT_MIN_DESC_SIZE_64BIT)
+        self.groups = (self.blocksCount - self.firstDataBlock + self.blocksPerGroup - 1) / self.blocksPerGroup
+
+def readExtLayout(device):
+    """Returns the ExtLayout of the filesystem on device, or None if it is not
+    an ext filesystem this module can image: one whose journal needs
+    recovering, whose group descriptors are not in one table (meta_bg), or
+    with read-only compatible features it does not know (such as bigalloc,
+    where a bitmap bit covers a cluster of blocks)."""
+    f = open(device, 'rb')
+    try:
+        f.seek(EXT_SUPERBLOCK_OFFSET)
+        sb = f.read(EXT_SUPERBLOCK_SIZE)
+    finally:
+        f.close()
+    if len(sb) < EXT_SUPERBLOCK_SIZE or struct.unpack('<H', sb[0x38:0x3a])[0] != EXT_SUPER_MAGIC:
+        return None
+    layout = ExtLayout(sb)
+    if layout.featureIncompat & (EXT_FEATURE_INCOMPAT_RECOVER | EXT_FEATURE_INCOMPAT_META_BG):
+        logger.log("Cannot image %s, incompatible features %#x" % (device, layout.featureIncompat))
+        return None
+    if layout.featureRoCompat & ~EXT_FEATURE_RO_COMPAT_SUPPORTED:
+        logger.log("Cannot image %s, read-only compatible features %#x" % (device, layout.featureRoCompat))
+        return None
+    return layout
+
+def _bitmapExtents(bitmap, first, count):
+    """Yields (start, length) runs of set bits in the first count bits of
+    bitmap, offset by first"""
+    start = None
+    for byte in range((count + 7) / 8):
+        value = ord(bitmap[byte])
+        if value == 0xff and start is not None:
+            continue
+        if value == 0 and start is None:
+            continue
+        for bit in range(8):
+            block = byte * 8 + bit
+            if block >= count:
+                break
+            if value & (1 << bit):
+                if start is None:
+                    start = block
+            elif start is not None:
+                yield first + start, block - start
+                start = None
+    if start is not None:
+        yield first + start, count - start
+
+def usedExtents(device, layout):
+    """Returns a sorted list of (first block, number of blocks) covering every
+    block in use on device.  Groups whose bitmap is not initialised are
+    treated as entirely in use."""
+    extents = []
+
+    def add(start, length):
+        if extents and extents[-1][0] + extents[-1][1] == start:
+            extents[-1] = (extents[-1][0], extents[-1][1] + length)
+        else:
+            extents.append((start, length))
+
+    if layout.firstDataBlock > 0:
+        add(0, layout.firstDataBlock)
+    f = open(device, 'rb')
+    try:
+        f.seek((layout.firstDataBlock + 1) * layout.blockSize)
+        descs = f.read(layout.groups * layout.descSize)
+        for group in range(layout.groups):
+            desc = descs[group * layout.descSize:(group + 1) * layout.descSize]
+            bitmap, = struct.unpack('<I', desc[0x00:0x04])
+            flags, = struct.unpack('<H', desc[0x12:0x14])
+            if layout.descSize >= EXT_MIN_DESC_SIZE_64BIT:
+                bitmap |= struct.unpack('<I', desc[0x20:0x24])[0] << 32
+            first = layout.firstDataBlock + group * layout.blocksPerGroup
+            count = min(layout.blocksPerGroup, layout.blocksCount - first)
+            if flags & EXT_BG_BLOCK_UNINIT:
+                add(first, count)
+                continue
+            f.seek(bitmap * layout.blockSize)
+            for start, length in _bitmapExtents(f.read(layout.blockSize), first, count):
+                add(start, length)
+    finally:
+        f.close()
+    return extents
+
+def _copyExtents(src, dest, extents, blockSize, progress_callback):
+    """Copies extents, in blocks of blockSize, from the file open on src to
+    the same offsets in the file open on dest.  Returns the md5 hex digest of
+    the data copied, in order."""
+    total = sum([length for _, length in extents]) * blockSize
+    copied = 0
+    digest = hashlib.md5()
+    started = last = time.time()
+    for start, length in extents:
+        offset = start * blockSize
+        end = offset + length * blockSize
+        while offset < end:
+            os.lseek(src, offset, os.SEEK_SET)
+            data = os.read(src, min(IMAGE_CHUNK, end - offset))
+            if not data:
+                raise IOError("Unexpected end of data at offset %d" % offset)
+            os.lseek(dest, offset, os.SEEK_SET)
+            written = 0
+            while written < len(data):
+                written += os.write(dest, data[written:])
+            digest.update(data)
+            offset += len(data)
+            copied += len(data)
+            if time.time() - last >= PROGRESS_INTERVAL:
+                last = time.time()
+                elapsed = last - started
+                progress_callback(copied, total, int((total - copied) * elapsed / copied))
+    progress_callback(copied, total, 0)
+    return digest.hexdigest()
+
+def imageSize(device):
+    """Returns the number of bytes an image of device would take, or None if
+    device cannot be imaged."""
+    layout = readExtLayout(device)
+    if layout is None:
+        return None
+    return sum([length for _, length in usedExtents(device, layout)]) * layout.blockSize
+
+def createImage(device, directory, progress_callback=lambda copied, total, eta: ()):
+    """Writes an image of the ext filesystem on device, which must not be
+    mounted read-write, and its manifest into directory.  progress_callback
+    is called with the bytes copied so far, the total and the seconds left."""
+    layout = readExtLayout(device)
+    if layout is None:
+        raise RuntimeError("%s does not hold a filesystem that can be imaged" % device)
+    extents = usedExtents(device, layout)
+    usedBytes = sum([length for _, length in extents]) * layout.blockSize
+    logger.log("Imaging %d of %d bytes of %s in %d extents" %
+               (usedBytes, layout.blocksCount * layout.blockSize, device, len(extents)))
+
+    image = os.path.join(directory, IMAGE_FILE)
+    src = os.open(device, os.O_RDONLY)
+    try:
+        dest = os.open(image, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            md5 = _copyExtents(src, dest, extents, layout.blockSize, progress_callback)
+            os.ftruncate(dest, layout.blocksCount * layout.blockSize)
+            os.fsync(dest)
+        finally:
+            os.close(dest)
+    finally:
+        os.close(src)
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'source': device,
+        'uuid': layout.uuid,
+        'label': layout.label,
+        'block-size': layout.blockSize,
+        'blocks': layout.blocksCount,
+        'bytes': usedBytes,
+        'md5': md5,
+        'extents': extents,
+        }
+    fd = open(os.path.join(directory, MANIFEST_FILE), 'w')
+    try:
+        json.dump(manifest, fd)
+    finally:
+        fd.close()
+
+def readManifest(directory):
+    """Returns the manifest of the image in directory, or None if there is no
+    image there."""
+    path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    fd = open(path, 'r')
+    try:
+        manifest = json.load(fd)
+    finally:
+        fd.close()
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise RuntimeError("Unsupported backup image version %s" % manifest.get('version'))
+    return manifest
+
+def mountImage(directory, tmp_prefix):
+    """Mounts the image in directory read-only, returning its util.TempMount"""
+    return util.TempMount(os.path.join(directory, IMAGE_FILE), tmp_prefix, ['ro', 'loop'])
+
+def restoreImage(directory, device, progress_callback=lambda copied, total, eta: ()):
+    """Writes the image in directory to device, then checks the filesystem and
+    grows it to fill device."""
+    manifest = readManifest(directory)
+    imageBytes = manifest['blocks'] * manifest['block-size']
+    _, deviceBytes = getBlockDeviceSize(device)
+    if deviceBytes < imageBytes:
+        raise RuntimeError("%s is too small to restore a %d byte image to" % (device, imageBytes))
+
+    src = os.open(os.path.join(directory, IMAGE_FILE), os.O_RDONLY)
+    try:
+        dest = os.open(device, os.O_WRONLY)
+        try:
+            md5 = _copyExtents(src, dest, manifest['extents'], manifest['block-size'], progress_callback)
+            os.fsync(dest)
+        finally:
+            os.close(dest)
+    finally:
+        os.close(src)
+    if md5 != manifest['md5']:
+        raise RuntimeError("Backup image is corrupt, checksum mismatch")
+
+    # e2fsck exits with 1 when it corrected something
+    if util.runCmd2(['e2fsck', '-f', '-y', device]) not in (0, 1):
+        raise RuntimeError("Restored filesystem on %s failed to check" % device)
+    if deviceBytes >= imageBytes + manifest['block-size']:
+        if util.runCmd2(['resize2fs', device]) != 0:
+            raise RuntimeError("Failed to resize restored filesystem on %s" % device)
@@ -40,6 +40,7 @@ import restore
 # general
 import repository
 import xelogging
+import cmdprofile
 import scripts
 from xcp import logger
 
@@ -153,6 +154,8 @@ def go(ui, args, answerfile_address, answerfile_script):
         elif opt == "--netinstall":
             results['netinstall'] = True
             logger.log("This is a netinstall.")
+        elif opt == "--profile-commands":
+            cmdprofile.enable()
 
     if boot_console and not serial_console:
         serial_console = boot_console
@@ -194,6 +197,8 @@ def go(ui, args, answerfile_address, answerfile_script):
             try:
                 results.update(a.parseScripts())
                 results.update(a.processAnswerfileSetup())
+                if results['profile-commands']:
+                    cmdprofile.enable()
 
                 if ui and results.get('ui-confirmation-prompt',False):
                     if not ui.init.confirm_proceed():
@@ -253,6 +258,7 @@ def go(ui, args, answerfile_address, answerfile_script):
         # UI dispatcher.
         aborted = False
         if ui and interactive:
+            cmdprofile.setPhase('user interface')
             uiexit = ui.installer.runMainSequence(
                 results, ram_warning, vt_warning, suppress_extra_cd_dialog
                 )
@@ -266,6 +272,7 @@ def go(ui, args, answerfile_address, answerfile_script):
                 logger.log("SCRIPTS DICTIONARY:")
                 backend.prettyLogAnswers(scripts.script_dict)
                 logger.log("Starting actual restore")
+                cmdprofile.setPhase('restore')
                 backup = results['backup-to-restore']
                 if ui:
                     pd = tui.progress.initProgressDialog("Restoring %s" % backup,
@@ -37,13 +37,22 @@ THIS_PLATFORM_VERSION = Version.from_string(version.PLATFORM_VERSION)
 XENSERVER_7_0_0 = Version([2, 1, 0]) # Platform version
 XENSERVER_MIN_VERSION = XENSERVER_7_0_0
 
+# What has been read from each installation's state and boot partitions,
+# keyed by (state device, boot device), so that repeated queries from the UI
+# don't mount them again
+cached_installation_state = {}
+
+# Number of candidate backup partitions mounted at once
+BACKUP_PROBE_PARALLEL = 8
+
 class ExistingInstallation:
     def __init__(self, primary_disk, boot_device, state_device):
         self.primary_disk = primary_disk
         self.boot_device = boot_device
         self.state_device = state_device
         self.state_prefix = ''
-        self.settings = None
+        self.state_fs = None
+        self.state_fs_users = 0
         self.root_fs = None
         self._boot_fs = None
         self.boot_fs_mount = None
@@ -52,13 +61,21 @@ class ExistingInstallation:
         return "%s %s" % (
             self.visual_brand, self.visual_version)
 
-    def mount_state(self):
-        """ Mount main state partition on self.state_fs. """
-        self.state_fs = util.TempMount(self.state_device, 'state-', )
+    def mount_state(self, ro=False):
+        """ Mount main state partition on self.state_fs.  Nested calls share
+        the mount made by the outermost one. """
+        if self.state_fs_users == 0:
+            opts = None
+            if ro:
+                opts = ['ro']
+            self.state_fs = util.TempMount(self.state_device, 'state-', opts)
+        self.state_fs_users += 1
 
     def unmount_state(self):
-        self.state_fs.unmount()
-        self.state_fs = None
+        self.state_fs_users -= 1
+        if self.state_fs_users == 0:
+            self.state_fs.unmount()
+            self.state_fs = None
 
     def join_state_path(self, *path):
         """ Construct an absolute path to a file in the main state partition. """
@@ -67,7 +84,47 @@ class ExistingInstallation:
     def getInventoryValue(self, k):
         return self.inventory[k]
 
+    def stateFingerprint(self):
+        """ Returns a value that changes whenever the filesystems read by
+        readState are written to, taken from their superblocks without
+        mounting them. """
+        devices = [self.state_device, getattr(self, 'root_device', self.boot_device)]
+        fingerprint = []
+        for sb in [diskutil.readExtSuperblocks([d])[d] for d in devices]:
+            if sb:
+                fingerprint.append((sb['uuid'], sb['wtime']))
+            else:
+                fingerprint.append(None)
+        return tuple(fingerprint)
+
+    def readState(self):
+        """ Reads the upgradeability and settings of the installation in a
+        single read-only mount of its state partition, or returns them from
+        the cache if the partitions have not changed since. """
+        key = (self.state_device, self.boot_device)
+        state = cached_installation_state.get(key)
+        if state and state['fingerprint'] == self.stateFingerprint():
+            return state
+
+        state = {'settings': None, 'settings-error': None}
+        self.mount_state(ro=True)
+        try:
+            state['upgradeable'] = self._isUpgradeable()
+            try:
+                state['settings'] = self._readSettings()
+            except Exception as e:
+                state['settings-error'] = e
+        finally:
+            self.unmount_state()
+        # Taken after unmounting, in case mounting replayed the journal
+        state['fingerprint'] = self.stateFingerprint()
+        cached_installation_state[key] = state
+        return state
+
     def isUpgradeable(self):
+        return self.readState()['upgradeable']
+
+    def _isUpgradeable(self):
         self.mount_state()
         result = True
         try:
@@ -410,18 +467,22 @@ class ExistingInstallation:
             self.boot_fs_mount = None
 
     def readSettings(self):
-        if not self.settings:
-            self.settings = self._readSettings()
-        return self.settings
+        state = self.readState()
+        if state['settings-error']:
+            raise state['settings-error']
+        return state['settings']
 
 
 class ExistingRetailInstallation(ExistingInstallation):
-    def __init__(self, primary_disk, boot_device, root_device, state_device, storage):
+    def __init__(self, primary_disk, boot_device, root_device, state_device, storage, inventory=None):
         self.variant = 'Retail'
         ExistingInstallation.__init__(self, primary_disk, boot_device, state_device)
         self.root_device = root_device
         self._boot_fs_mounted = False
-        self.readInventory()
+        if inventory is None:
+            self.readInventory()
+        else:
+            self.setInventory(inventory)
 
     def __repr__(self):
         return "<ExistingRetailInstallation: %s on %s>" % (str(self), self.root_device)
@@ -450,41 +511,48 @@ class ExistingRetailInstallation(ExistingInstallation):
     def readInventory(self):
         self.mount_root()
         try:
-            self.inventory = util.readKeyValueFile(os.path.join(self.root_fs.mount_point,
-                                                                constants.INVENTORY_FILE),
-                                                   strip_quotes=True)
-            self.build = self.inventory['BUILD_NUMBER']
-            self.version = Version.from_string("%s-%s" % (self.inventory['PLATFORM_VERSION'],
-                                                          self.build))
-            if 'PRODUCT_NAME' in self.inventory:
-                self.name = self.inventory['PRODUCT_NAME']
-                self.brand = self.inventory['PRODUCT_BRAND']
-            else:
-                self.name = self.inventory['PLATFORM_NAME']
-                self.brand = self.inventory['PLATFORM_NAME']
+            inventory = util.readKeyValueFile(os.path.join(self.root_fs.mount_point,
+                                                           constants.INVENTORY_FILE),
+                                              strip_quotes=True)
+        finally:
+            self.unmount_root()
+        self.setInventory(inventory)
+
+    def setInventory(self, inventory):
+        """ Set the product details from the contents of xensource-inventory. """
+        self.inventory = inventory
+        self.build = self.inventory['BUILD_NUMBER']
+        self.version = Version.from_string("%s-%s" % (self.inventory['PLATFORM_VERSION'],
+                                                      self.build))
+        if 'PRODUCT_NAME' in self.inventory:
+            self.name = self.inventory['PRODUCT_NAME']
+            self.brand = self.inventory['PRODUCT_BRAND']
+        else:
+            self.name = self.inventory['PLATFORM_NAME']
+            self.brand = self.inventory['PLATFORM_NAME']
 
-            if 'OEM_BRAND' in self.inventory:
-                self.oem_brand = self.inventory['OEM_BRAND']
-                self.visual_brand = self.oem_brand
+        if 'OEM_BRAND' in self.inventory:
+            self.oem_brand = self.inventory['OEM_BRAND']
+            self.visual_brand = self.oem_brand
+        else:
+            self.visual_brand = self.brand
+        if 'OEM_VERSION' in self.inventory:
+            self.oem_version = self.inventory['OEM_VERSION']
+            self.visual_version = "%s-%s" % (self.inventory['OEM_VERSION'],
+                                             self.build)
+        else:
+            if '/' in self.build:
+                self.visual_version = self.inventory['PRODUCT_VERSION']
             else:
-                self.visual_brand = self.brand
-            if 'OEM_VERSION' in self.inventory:
-                self.oem_version = self.inventory['OEM_VERSION']
-                self.visual_version = "%s-%s" % (self.inventory['OEM_VERSION'],
+                self.visual_version = "%s-%s" % (self.inventory['PRODUCT_VERSION'],
                                                  self.build)
-            else:
-                if '/' in self.build:
-                    self.visual_version = self.inventory['PRODUCT_VERSION']
-                else:
-                    self.visual_version = "%s-%s" % (self.inventory['PRODUCT_VERSION'],
-                                                     self.build)
-        finally:
-            self.unmount_root()
 
 class XenServerBackup:
-    def __init__(self, part, mnt):
+    def __init__(self, part, mnt=None, inventory=None):
         self.partition = part
-        self.inventory = util.readKeyValueFile(os.path.join(mnt, constants.INVENTORY_FILE), strip_quotes=True)
+        if inventory is None:
+            inventory = util.readKeyValueFile(os.path.join(mnt, constants.INVENTORY_FILE), strip_quotes=True)
+        self.inventory = inventory
         self.build = self.inventory['BUILD_NUMBER']
         self.version = Version.from_string("%s-%s" % (self.inventory['PLATFORM_VERSION'],
                                                       self.build))
@@ -523,54 +591,139 @@ class XenServerBackup:
     def __repr__(self):
         return "<XenServerBackup: %s on %s>" % (str(self), self.partition)
 
+def isBackupCandidate(superblock):
+    """Returns True if an ext superblock, as returned by
+    diskutil.readExtSuperblock, could belong to a backup partition.  Backup
+    partitions are created without a label, so anything carrying one of the
+    labels given to the installation's own filesystems is ruled out."""
+    if superblock is None:
+        return False
+    label = superblock['label']
+    return not (label.startswith(constants.rootfs_label % '') or
+                label.startswith(constants.logsfs_label_prefix))
+
+def readScanCache():
+    """Returns the results of earlier scans for installations and backups, as
+    saved by writeScanCache, or an empty cache if there are none."""
+    cache = {}
+    try:
+        with open(constants.SCAN_CACHE_FILE, 'r') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        pass
+    cache.setdefault('products', {})
+    cache.setdefault('backups', {})
+    return cache
+
+def writeScanCache(cache):
+    """Saves cache so that a restarted installer only probes the devices that
+    have changed since."""
+    tmp = constants.SCAN_CACHE_FILE + '.new'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(cache, f)
+        os.rename(tmp, constants.SCAN_CACHE_FILE)
+    except (IOError, OSError) as e:
+        logger.log("Failed to save scan results: %s" % str(e))
+
+def readBackupInventory(partition):
+    """Mounts partition read-only and returns the inventory of the backup on
+    it, or None if it does not hold a backup."""
+    b = util.TempMount(partition, 'backup-', ['ro'], 'ext3')
+    try:
+        if not os.path.exists(os.path.join(b.mount_point, '.xen-backup-partition')):
+            return None
+        return util.readKeyValueFile(os.path.join(b.mount_point, constants.INVENTORY_FILE), strip_quotes=True)
+    finally:
+        b.unmount()
+
 def findXenSourceBackups():
     """Scans the host and find partitions containing backups of XenSource
     products.  Returns a list of device node paths to partitions containing
     said backups. """
-    partitions = diskutil.getQualifiedPartitionList()
-    backups = []
-
-    for p in partitions:
-        b = None
+    # Only unlabelled ext filesystems can hold a backup, so rule out everything
+    # else from the superblock and only mount what is left
+    candidates = diskutil.getQualifiedPartitionList()
+    superblocks = diskutil.readExtSuperblocks(candidates)
+    partitions = [p for p in candidates if isBackupCandidate(superblocks[p])]
+    cache = readScanCache()
+    cached = cache['backups']
+
+    def probe(p):
         try:
-            b = util.TempMount(p, 'backup-', ['ro'], 'ext3')
-            if os.path.exists(os.path.join(b.mount_point, '.xen-backup-partition')):
-                backup = XenServerBackup(p, b.mount_point)
-                if backup.version >= XENSERVER_MIN_VERSION and \
-                        backup.version <= THIS_PLATFORM_VERSION:
-                    backups.append(backup)
-        except:
-            pass
-        if b:
-            b.unmount()
+            fingerprint = diskutil.readPartitionFingerprint(p, superblocks[p])
+            entry = cached.get(p)
+            if entry and entry['fingerprint'] == fingerprint:
+                inventory = entry['inventory']
+            else:
+                inventory = readBackupInventory(p)
+                cached[p] = {'fingerprint': fingerprint, 'inventory': inventory}
+            if inventory is None:
+                return None
+            backup = XenServerBackup(p, inventory=inventory)
+            if backup.version >= XENSERVER_MIN_VERSION and \
+                    backup.version <= THIS_PLATFORM_VERSION:
+                return backup
+        except Exception as e:
+            logger.log("Not a usable backup partition %s: %s" % (p, e))
+        return None
 
-    return backups
+    logger.log("Checking %d of %d partitions for backups" % (len(partitions), len(candidates)))
+    backups = util.parallelMap(probe, partitions, BACKUP_PROBE_PARALLEL)
+    writeScanCache(cache)
+    return [b for b in backups if b is not None]
 
 def findXenSourceProducts():
     """Scans the host and finds XenSource product installations.
     Returns list of ExistingInstallation objects.
 
     Currently requires supervisor privileges due to mounting
-    filesystems."""
+    filesystems.  Disks that have not changed since an earlier scan, even
+    by a previous run of the installer, are not probed again."""
 
     installs = []
 
-    for disk in diskutil.getQualifiedDiskList():
-        (boot, root, state, storage, logs) = diskutil.probeDisk(disk)
+    disks = diskutil.getQualifiedDiskList()
+    fingerprints = dict(zip(disks, util.parallelMap(diskutil.readDiskFingerprint, disks,
+                                                    diskutil.PROBE_PARALLEL)))
+    cache = readScanCache()
+    cached = cache['products']
+    stale = [disk for disk in disks if fingerprints[disk] is None or disk not in cached or
+             cached[disk]['fingerprint'] != fingerprints[disk]]
+    logger.log("Probing %d of %d disks, the rest are unchanged since the last scan" %
+               (len(stale), len(disks)))
+    probes = {}
+    if stale:
+        probes = dict(zip(stale, diskutil.probeDisks(stale)))
+
+    for disk in disks:
+        inventory = None
+        if disk in probes:
+            probe = probes[disk]
+        else:
+            probe = [tuple(x) for x in cached[disk]['probe']]
+            inventory = cached[disk]['inventory']
+        boot, root, state, storage, logs = probe
 
         inst = None
         try:
             if root[0] == diskutil.INSTALL_RETAIL:
-                inst = ExistingRetailInstallation(disk, boot[1], root[1], state[1], storage)
+                inst = ExistingRetailInstallation(disk, boot[1], root[1], state[1], storage, inventory)
         except Exception as e:
             logger.log("A problem occurred whilst scanning for existing installations:")
             logger.logException(e)
             logger.log("This is not fatal.  Continuing anyway.")
+            cached.pop(disk, None)
+        else:
+            if fingerprints[disk] is not None:
+                cached[disk] = {'fingerprint': fingerprints[disk], 'probe': probe,
+                                'inventory': inst and inst.inventory}
 
         if inst:
             logger.log("Found an installation: %s on %s" % (str(inst), disk))
             installs.append(inst)
 
+    writeScanCache(cache)
     return installs
 
 def readInventoryFile(filename):
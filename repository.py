@@ -21,7 +21,6 @@ import urlparse
 import urllib
 import urllib2
 import ftplib
-import subprocess
 import re
 import gzip
 import shutil
@@ -203,25 +202,16 @@ repo_gpgcheck=%d
 
         self.disableInitrdCreation(mounts['root'])
 
-        # Use a temporary file to avoid deadlocking
-        stderr = tempfile.TemporaryFile()
-
         if kernel_alt:
             self._targets.append('kernel-alt')
         yum_command = ['yum', '-c', '/root/yum.conf',
                        '--installroot', mounts['root'],
                        'install', '-y'] + self._targets
         logger.log("Running yum: %s" % ' '.join(yum_command))
-        p = subprocess.Popen(yum_command, stdout=subprocess.PIPE, stderr=stderr)
-        count = 0
-        total = 0
-        verify_count = 0
-        while True:
-            line = p.stdout.readline()
-            if not line:
-                break
+        counts = {'installed': 0, 'total': 0, 'verified': 0}
+
+        def yum_progress(line):
             line = line.rstrip()
-            logger.log("YUM: %s" % line)
             if line == 'Resolving Dependencies':
                 progress_callback(1)
             elif line == 'Dependencies Resolved':
@@ -231,19 +221,17 @@ repo_gpgcheck=%d
             elif line == 'Running transaction':
                 progress_callback(10)
             elif line.endswith(' will be installed') or line.endswith(' will be updated'):
-                total += 1
+                counts['total'] += 1
             elif line.startswith('  Installing : ') or line.startswith('  Updating : '):
-                count += 1
-                if total > 0:
-                    progress_callback(10 + int((count * 80.0) / total))
+                counts['installed'] += 1
+                if counts['total'] > 0:
+                    progress_callback(10 + int((counts['installed'] * 80.0) / counts['total']))
             elif line.startswith('  Verifying  : '):
-                verify_count += 1
-                progress_callback(90 + int((verify_count * 10.0) / total))
-        rv = p.wait()
-        stderr.seek(0)
-        stderr = stderr.read()
-        if stderr:
-            logger.log("YUM stderr: %s" % stderr.strip())
+                counts['verified'] += 1
+                if counts['total'] > 0:
+                    progress_callback(90 + int((counts['verified'] * 10.0) / counts['total']))
+
+        rv, stderr = util.runCmdStream(yum_command, stdout_callback=yum_progress, with_stderr=True)
 
         shutil.rmtree(os.path.join(mounts['root'], self._cachedir))
         self.enableInitrdCreation()
@@ -12,6 +12,9 @@
 
 import backend
 import product
+import upgrade
+import estimate
+import fsimage
 from disktools import *
 import diskutil
 import util
@@ -24,6 +27,27 @@ import shutil
 import xcp.bootloader as bootloader
 from xcp import logger
 
+def estimateRestore(backup):
+    """ Returns an estimate.Estimate of how long restoring backup will take.
+    The backup is not written to, so writes to the root partition, on the
+    same disk, are assumed to be as fast as reads from it. """
+    read_rate = estimate.readThroughput(backup.partition) or estimate.DEFAULT_THROUGHPUT
+    result = estimate.Estimate()
+    backup_fs = util.TempMount(backup.partition, 'restore-backup-', options=['ro'])
+    try:
+        image = fsimage.readManifest(backup_fs.mount_point)
+        if image:
+            result.add('Restore image', image['bytes'],
+                       estimate.copySeconds(image['bytes'], 0, read_rate, read_rate))
+        else:
+            tree = estimate.measureTree(backup_fs.mount_point)
+            result.add('Restore', tree.bytes,
+                       estimate.copySeconds(tree.bytes, tree.files, read_rate, read_rate, tree.scan_cost))
+    finally:
+        backup_fs.unmount()
+    result.log('restore of %s' % backup.partition)
+    return result
+
 def restoreFromBackup(backup, progress=lambda x: ()):
     """ Restore files from backup_partition to the root partition on disk.
     Call progress with a value between 0 and 100.  Re-install bootloader.  Fails if
@@ -69,20 +93,33 @@ def restoreFromBackup(backup, progress=lambda x: ()):
     except:
         pass
 
-    # mount the backup fs
-    backup_fs = util.TempMount(backup_partition, 'restore-backup-', options=['ro'])
-    try:
-        # extract the bootloader config
-        boot_config = bootloader.Bootloader.loadExisting(backup_fs.mount_point)
+    def check_boot_config(boot_config):
         if boot_config.src_fmt == 'grub':
             raise RuntimeError("Backup uses grub bootloader which is no longer supported - " + \
                 "to restore please use a version of the installer that matches the backup partition")
 
-        # format the restore partition(s):
-        try:
-            util.mkfs(constants.rootfs_type, restore_partition)
-        except Exception as e:
-            raise RuntimeError("Failed to create root filesystem: %s" % e)
+    # mount the backup fs
+    backup_fs = util.TempMount(backup_partition, 'restore-backup-', options=['ro'])
+    try:
+        image = fsimage.readManifest(backup_fs.mount_point)
+        if image:
+            # the backup is an image of the root filesystem: write it back
+            # block by block rather than formatting and copying files
+            if efi_boot:
+                raise RuntimeError("Backup image does not include the EFI system partition")
+            logger.log("Restoring image of %s." % image['source'])
+            fsimage.restoreImage(backup_fs.mount_point, restore_partition,
+                                 lambda copied, total, eta: progress(copied * 100 / max(total, 1)))
+        else:
+            # extract the bootloader config
+            boot_config = bootloader.Bootloader.loadExisting(backup_fs.mount_point)
+            check_boot_config(boot_config)
+
+            # format the restore partition(s):
+            try:
+                util.mkfs(constants.rootfs_type, restore_partition)
+            except Exception as e:
+                raise RuntimeError("Failed to create root filesystem: %s" % e)
 
         if efi_boot:
             try:
@@ -94,6 +131,14 @@ def restoreFromBackup(backup, progress=lambda x: ()):
         dest_fs = util.TempMount(restore_partition, 'restore-dest-')
         efi_mounted = False
         try:
+            # the backed up files: the restored image itself, or the backup partition
+            tree = backup_fs.mount_point
+            if image:
+                tree = dest_fs.mount_point
+                upgrade.replaceRollingPoolConfig(tree)
+                boot_config = bootloader.Bootloader.loadExisting(tree)
+                check_boot_config(boot_config)
+
             if efi_boot:
                 esp = os.path.join(dest_fs.mount_point, 'boot', 'efi')
                 os.makedirs(esp)
@@ -101,8 +146,10 @@ def restoreFromBackup(backup, progress=lambda x: ()):
                 efi_mounted = True
 
             # copy files from the backup partition to the restore partition:
-            objs = filter(lambda x: x not in ['lost+found', '.xen-backup-partition', '.xen-gpt.bin'],
-                          os.listdir(backup_fs.mount_point))
+            objs = []
+            if not image:
+                objs = filter(lambda x: x not in ['lost+found', '.xen-backup-partition', '.xen-gpt.bin'],
+                              os.listdir(backup_fs.mount_point))
             for i in range(len(objs)):
                 obj = objs[i]
                 logger.log("Restoring subtree %s..." % obj)
@@ -126,7 +173,7 @@ def restoreFromBackup(backup, progress=lambda x: ()):
                 logger.log("Bootloader is currently installed to MBR, restoring to MBR instead of partition")
                 location = constants.BOOT_LOCATION_MBR
 
-            with open(os.path.join(backup_fs.mount_point, 'etc', 'fstab'), 'r') as fstab:
+            with open(os.path.join(tree, 'etc', 'fstab'), 'r') as fstab:
                 for line in fstab:
                     m = re.match(r'LABEL=(\S+)\s+/boot/efi\s', line)
                     if m:
@@ -140,7 +187,7 @@ def restoreFromBackup(backup, progress=lambda x: ()):
             util.bindMount("/proc", "%s/proc" % dest_fs.mount_point)
             if boot_config.src_fmt == 'grub2':
                 if efi_boot:
-                    branding = util.readKeyValueFile(os.path.join(backup_fs.mount_point, constants.INVENTORY_FILE))
+                    branding = util.readKeyValueFile(os.path.join(tree, constants.INVENTORY_FILE))
                     branding['product-brand'] = branding['PRODUCT_BRAND']
                     backend.setEfiBootEntry(mounts, disk, boot_partnum, constants.INSTALL_TYPE_RESTORE, branding)
                 else:
@@ -156,7 +203,7 @@ def restoreFromBackup(backup, progress=lambda x: ()):
                 backend.installExtLinux(mounts, disk, probePartitioningScheme(disk), location)
 
             # restore bootloader configuration
-            dst_file = boot_config.src_file.replace(backup_fs.mount_point, dest_fs.mount_point, 1)
+            dst_file = boot_config.src_file.replace(tree, dest_fs.mount_point, 1)
             util.assertDir(os.path.dirname(dst_file))
             boot_config.commit(dst_file)
         finally:
@@ -27,6 +27,7 @@ import util
 import socket
 import product
 import upgrade
+import restore
 import netutil
 
 from snack import *
@@ -538,15 +539,12 @@ def setup_runtime_networking(answers):
 
 def raid_array_ui(answers):
     disk_entries = sorted_disk_list()
-    raid_disks = [de for de in disk_entries if diskutil.is_raid(de)]
-    raid_slaves = [slave for master in raid_disks for slave in diskutil.getDeviceSlaves(master)]
+    inventory = diskutil.getDiskInventory(disk_entries)
+    raid_slaves = inventory.raidMembers()
     entries = []
-    for de in disk_entries:
-        if de not in raid_slaves and de not in raid_disks:
-            vendor, model, size = diskutil.getExtendedDiskInfo(de)
-            string_entry = "%s - %s [%s %s]" % (
-                diskutil.getHumanDiskName(de), diskutil.getHumanDiskSize(size), vendor, model)
-            entries.append((string_entry, de))
+    for info in inventory:
+        if info.device not in raid_slaves and not info.isRaid:
+            entries.append((info.entryText(), info.device))
     if len(entries) < 2:
         return SKIP_SCREEN
     text = TextboxReflowed(54, "Do you want to group disks in a software RAID 1 array?  \n\n" +
@@ -603,13 +601,26 @@ def disk_more_info(context):
             if vg_name.startswith('VG_XenStorage-'):
                 usage = 'VM Storage'
 
+    info = diskutil.getDiskInventory([context]).get(context)
+    if info:
+        details = [("Disk:", info.humanName),
+                   ("Vendor:", info.vendor),
+                   ("Model:", info.model),
+                   ("Serial:", info.serial)]
+        if info.wwn:
+            details.append(("WWN:", info.wwn))
+        size = info.size
+    else:
+        # the disk could not be probed along with the others
+        details = [("Disk:", diskutil.getHumanDiskName(context)),
+                   ("Vendor:", diskutil.getDiskDeviceVendor(context)),
+                   ("Model:", diskutil.getDiskDeviceModel(context)),
+                   ("Serial:", diskutil.getDiskSerialNumber(context))]
+        size = diskutil.getDiskDeviceSize(context)
+    details += [("Size:", diskutil.getHumanDiskSize(size)),
+                ("Current usage:", usage)]
     tui.update_help_line([' ', ' '])
-    snackutil.TableDialog(tui.screen, "Details", ("Disk:", diskutil.getHumanDiskName(context)),
-                          ("Vendor:", diskutil.getDiskDeviceVendor(context)),
-                          ("Model:", diskutil.getDiskDeviceModel(context)),
-                          ("Serial:", diskutil.getDiskSerialNumber(context)),
-                          ("Size:", diskutil.getHumanDiskSize(diskutil.getDiskDeviceSize(context))),
-                          ("Current usage:", usage))
+    snackutil.TableDialog(tui.screen, "Details", *details)
     tui.screen.popHelpLine()
     return True
 
@@ -618,14 +629,16 @@ def sorted_disk_list():
                   lambda x, y: len(x) == len(y) and cmp(x, y) or (len(x) - len(y)))
 
 def filter_out_raid_member(diskEntries):
-    raid_disks = [de for de in diskEntries if diskutil.is_raid(de)]
-    raid_slaves = set(member for master in raid_disks for member in diskutil.getDeviceSlaves(master))
-    return [e for e in diskEntries if e not in raid_slaves]
+    inventory = diskutil.getDiskInventory(diskEntries)
+    raid_slaves = inventory.raidMembers()
+    return [e for e in diskEntries if e in inventory and e not in raid_slaves]
 
 # select drive to use as the Dom0 disk:
 def select_primary_disk(answers):
     button = None
-    diskEntries = filter_out_raid_member(sorted_disk_list())
+    # Re-probe the disks as a RAID array may have been created since last time
+    inventory = diskutil.getDiskInventory(sorted_disk_list(), refresh=True)
+    diskEntries = filter_out_raid_member(inventory.disks)
     entries = []
     target_is_sr = {}
 
@@ -633,18 +646,15 @@ def select_primary_disk(answers):
         min_primary_disk_size = constants.min_primary_disk_size
     else:
         min_primary_disk_size = constants.min_primary_disk_size_old
-    for de in diskEntries:
-        (vendor, model, size) = diskutil.getExtendedDiskInfo(de)
-        if min_primary_disk_size <= diskutil.blockSizeToGBSize(size):
-            # determine current usage
-            target_is_sr[de] = False
-            (boot, root, state, storage, logs) = diskutil.probeDisk(de)
-            if storage[0]:
-                target_is_sr[de] = True
-            (vendor, model, size) = diskutil.getExtendedDiskInfo(de)
-            stringEntry = "%s - %s [%s %s]" % (diskutil.getHumanDiskName(de), diskutil.getHumanDiskSize(size), vendor, model)
-            e = (stringEntry, de)
-            entries.append(e)
+    diskEntries = [de for de in diskEntries
+                   if min_primary_disk_size <= diskutil.blockSizeToGBSize(inventory[de].size)]
+    # determine current usage
+    for de, (boot, root, state, storage, logs) in zip(diskEntries, diskutil.probeDisks(diskEntries)):
+        target_is_sr[de] = False
+        if storage[0]:
+            target_is_sr[de] = True
+        e = (inventory[de].entryText(), de)
+        entries.append(e)
 
     # we should have at least one disk
     if len(entries) == 0:
@@ -689,7 +699,7 @@ You may need to change your system settings to boot from this disk.""" % (MY_PRO
     # Warn if not all of the disk is usable.
     # This can happen if we are unable to use GPT because we are currently
     # using DOS and need to preserve some utility partitions.
-    blocks = diskutil.getDiskDeviceSize(answers['primary-disk'])
+    blocks = inventory[answers['primary-disk']].size
     tool = PartitionTool(answers['primary-disk'])
     if diskutil.blockSizeToGBSize(blocks) > constants.max_primary_disk_size_dos and tool.partTableType == 'DOS':
         if constants.GPT_SUPPORT and tool.utilityPartitions():
@@ -770,11 +780,17 @@ def select_guest_disks(answers):
         srtype = answers['sr-type']
 
     # Make a list of entries: (text, item)
+    inventory = diskutil.getDiskInventory(diskEntries)
     entries = []
     for de in diskEntries:
-        (vendor, model, size) = diskutil.getExtendedDiskInfo(de)
-        entry = "%s - %s [%s %s]" % (diskutil.getHumanDiskName(de), diskutil.getHumanDiskSize(size), vendor, model)
-        entries.append((entry, de))
+        info = inventory.get(de)
+        if info:
+            entries.append((info.entryText(), de))
+        else:
+            # the disk could not be probed along with the others
+            (vendor, model, size) = diskutil.getExtendedDiskInfo(de)
+            entry = "%s - %s [%s %s]" % (diskutil.getHumanDiskName(de), diskutil.getHumanDiskSize(size), vendor, model)
+            entries.append((entry, de))
 
     text = TextboxReflowed(54, "Which disks would you like to use for %s storage?  \n\nOne storage repository will be created that spans the selected disks.  You can choose not to prepare any storage if you wish to create an advanced configuration after installation." % BRAND_GUEST)
     buttons = ButtonBar(tui.screen, [('Ok', 'ok'), ('Back', 'back')])
@@ -832,11 +848,33 @@ If you proceed, please refer to the user guide for details on provisioning stora
 
     return RIGHT_FORWARDS
 
+# Estimate sentences by key, so going back and forth between screens does
+# not repeat the throughput probes
+estimate_texts = {}
+
+def estimate_text(key, estimator, *args):
+    """ Calls estimator once for each key, returning the estimate it makes as
+    a sentence to add to a confirmation screen, or '' if there is none. """
+    if key not in estimate_texts:
+        tui.progress.showMessageDialog("Please wait", "Estimating how long this will take...")
+        try:
+            result = estimator(*args)
+            text = result and ("\n\nEstimated time: %s." % result) or ''
+        except Exception as e:
+            logger.log("Failed to estimate the duration of the operation")
+            logger.logException(e)
+            text = ''
+        finally:
+            tui.progress.clearModelessDialog()
+        estimate_texts[key] = text
+    return estimate_texts[key]
+
 def confirm_installation(answers):
     if answers['install-type'] == constants.INSTALL_TYPE_RESTORE:
         backup = answers['backup-to-restore']
         label = "Confirm Restore"
         text = "Are you sure you want to restore your installation with the backup on %s?\n\nYour existing installation will be overwritten with the backup (though VMs will still be intact).\n\nTHIS OPERATION CANNOT BE UNDONE." % diskutil.getHumanDiskName(backup.partition)
+        text += estimate_text(('restore', backup.partition), restore.estimateRestore, backup)
         ok = 'Restore %s' % MY_PRODUCT_BRAND
     else:
         label = "Confirm Installation"
@@ -860,6 +898,10 @@ def confirm_installation(answers):
                                                                                   diskutil.getHumanDiskName(answers['installation-to-overwrite'].primary_disk),
                                                                                   diskutil.getHumanDiskName(answers['primary-disk']))
             text2 += ", preserving existing %s in your storage repository." % BRAND_GUESTS
+            if answers.get('backup-existing-installation'):
+                existing = answers['installation-to-overwrite']
+                text2 += estimate_text(('upgrade', existing.root_device),
+                                       lambda: upgrade.getUpgrader(existing).estimate())
         text = text1 + "\n\n" + text2
         ok = 'Install %s' % MY_PRODUCT_BRAND
 
@@ -18,6 +18,9 @@ import re
 import shutil
 
 import diskutil
+import estimate
+import fscopy
+import fsimage
 import product
 from xcp.version import *
 from xcp import logger
@@ -47,6 +50,8 @@ class Upgrader(object):
     requires_backup = False
     optional_backup = True
     repartition = False
+    # Number of independent preserved files or trees restored at once
+    restore_parallel = 8
 
     def __init__(self, source):
         """ source is the ExistingInstallation object we're to upgrade. """
@@ -133,69 +138,123 @@ class Upgrader(object):
                         logger.error('Failed to parse: ' + line)
                         logger.logException(e)
 
-        # Copy ownership from a path in a source root to another path in a
-        # destination root. The ownership is copied such that it is not
-        # affected by changes in the underlying uid/gid.
-        def copy_ownership(src_root, src_path, dst_root, dst_path):
-            st = os.lstat('%s/%s' % (src_root, src_path))
+        # Map ownership from the source root to the destination root by
+        # user and group name, so that it is not affected by changes in the
+        # underlying uid/gid.
+        unmapped_ids = set()
+
+        def map_ids(uid, gid):
             try:
-                new_uid = dst_uid_map[src_uid_map[st.st_uid]]
-                new_gid = dst_gid_map[src_gid_map[st.st_gid]]
-            except IndexError as e:
-                logger.error('Failed to copy ownership')
-                logger.logException(e)
-                return
-            if st.st_uid != new_uid or st.st_gid != new_gid:
-                os.lchown('%s/%s' % (dst_root, dst_path), new_uid, new_gid)
+                return dst_uid_map[src_uid_map[uid]], dst_gid_map[src_gid_map[gid]]
+            except KeyError as e:
+                if (uid, gid) not in unmapped_ids:
+                    unmapped_ids.add((uid, gid))
+                    logger.error('Failed to map ownership %d:%d' % (uid, gid))
+                    logger.logException(e)
+                return uid, gid
 
         def restore_file(src_base, f, d=None):
             if not d: d = f
             src = os.path.join(src_base, f)
             dst = os.path.join(mounts['root'], d)
-            if os.path.exists(src):
-                logger.log("Restoring /%s" % f)
-                util.assertDir(os.path.dirname(dst))
-                if os.path.isdir(src):
-                    util.runCmd2(['cp', '-a', src, os.path.dirname(dst)])
-                else:
-                    util.runCmd2(['cp', '-a', src, dst])
-
-                abs_f = os.path.join('/', f)
-                abs_d = os.path.join('/', d)
-                copy_ownership(src_base, abs_f, mounts['root'], abs_d)
-                for dirpath, dirnames, filenames in os.walk(src):
-                    for i in dirnames + filenames:
-                        src_path = os.path.join(dirpath, i)[len(src_base):]
-                        dst_path = os.path.join(abs_d, src_path[len(abs_f) + 1:])
-                        copy_ownership(src_base, src_path, mounts['root'], dst_path)
-            else:
-                logger.log("WARNING: /%s did not exist in the backup image." % f)
+            logger.log("Restoring /%s" % f)
+            try:
+                fscopy.TreeCopy(src, dst, include_root=True, merge=True, id_map=map_ids).copy()
+            except (IOError, OSError) as e:
+                logger.log("Failed to restore /%s: %s" % (f, e))
+
+        def restore_group(group):
+            for src_base, f, d in group:
+                restore_file(src_base, f, d)
 
         backup_volume = partitionDevice(target_disk, backup_partnum)
         tds = util.TempMount(backup_volume, 'upgrade-src-', options=['ro'])
+        image_fs = None
         try:
+            src_root = tds.mount_point
+            if fsimage.readManifest(tds.mount_point):
+                # the backup is an image of the old root filesystem
+                image_fs = fsimage.mountImage(tds.mount_point, 'upgrade-image-')
+                src_root = image_fs.mount_point
             self.buildRestoreList()
-            init_id_maps(tds.mount_point, mounts['root'])
+            init_id_maps(src_root, mounts['root'])
 
             logger.log("Restoring preserved files")
+            restores = []
             for f in self.restore_list:
                 if isinstance(f, str):
-                    restore_file(tds.mount_point, f)
+                    restores.append((src_root, f, f))
                 elif isinstance(f, dict):
                     if 'src' in f:
                         assert 'dst' in f
-                        restore_file(tds.mount_point, f['src'], f['dst'])
+                        restores.append((src_root, f['src'], f['dst']))
                     elif 'dir' in f:
                         pat = 're' in f and f['re'] or None
-                        src_dir = os.path.join(tds.mount_point, f['dir'])
+                        src_dir = os.path.join(src_root, f['dir'])
                         if os.path.exists(src_dir):
                             for ff in os.listdir(src_dir):
                                 fn = os.path.join(f['dir'], ff)
                                 if not pat or pat.match(fn):
-                                    restore_file(tds.mount_point, fn)
+                                    restores.append((src_root, fn, fn))
+
+            existing = []
+            for src_base, f, d in restores:
+                src = os.path.join(src_base, f)
+                if os.path.exists(src):
+                    if os.path.isdir(src):
+                        # like 'cp -a src dirname(dst)'
+                        d = os.path.join(os.path.dirname(d), os.path.basename(f))
+                    util.assertDir(os.path.dirname(os.path.join(mounts['root'], d)))
+                    existing.append((src_base, f, d))
+                else:
+                    logger.log("WARNING: /%s did not exist in the backup image." % f)
+
+            # Restores into the same part of the tree are done in order, the
+            # rest concurrently
+            util.parallelMap(restore_group, groupRestores(existing), self.restore_parallel)
         finally:
+            if image_fs:
+                image_fs.unmount()
             tds.unmount()
 
+    def estimate(self):
+        """ Returns an estimate.Estimate of how long the upgrade steps that
+        depend on the existing installation will take, or None. """
+        return None
+
+def groupRestores(restores):
+    """ Splits restores, a list of (source root, source path, destination
+    path), into lists that can be processed independently: any two restores
+    where one destination is equal to or inside the other end up in the same
+    list, in their original order. """
+    groups = []
+    for restore in restores:
+        d = os.path.normpath(restore[2])
+        related = [g for g in groups if [r for r in g if
+                                         d == os.path.normpath(r[2]) or
+                                         d.startswith(os.path.normpath(r[2]) + '/') or
+                                         os.path.normpath(r[2]).startswith(d + '/')]]
+        group = []
+        for g in related:
+            group += g
+            groups.remove(g)
+        group.append(restore)
+        group.sort(key=restores.index)
+        groups.append(group)
+    groups.sort(key=lambda g: restores.index(g[0]))
+    return groups
+
+def replaceRollingPoolConfig(root):
+    """ Replace the bootloader configuration in the tree at root with the one
+    saved there at the start of a rolling pool upgrade, if any. """
+    def replace_config(config_file, destination):
+        src = os.path.join(root, constants.ROLLING_POOL_DIR, config_file)
+        if os.path.exists(src):
+            util.runCmd2(['cp', '-f', src, os.path.join(root, destination)])
+
+    map(replace_config, ('efi-grub.cfg', 'grub.cfg', 'menu.lst', 'extlinux.conf'),
+                        ('boot/efi/EFI/xenserver/grub.cfg', 'boot/grub',
+                         'boot/grub', 'boot'))
 
 class ThirdGenUpgrader(Upgrader):
     """ Upgrader class for series 7+ Retail products. """
@@ -204,6 +263,11 @@ class ThirdGenUpgrader(Upgrader):
     upgrades_variants = [ 'Retail' ]
     requires_backup = True
     optional_backup = False
+    # Back up an image of the used blocks of the root filesystem, rather than
+    # its files, when it fits on the backup partition
+    backup_image = True
+    # Space to leave free on the backup partition after writing an image
+    backup_image_margin = 64 * 2**20
 
     def __init__(self, source):
         Upgrader.__init__(self, source)
@@ -280,10 +344,12 @@ class ThirdGenUpgrader(Upgrader):
                             _, vgs_label = vgs_output_wrong.split(None, 1)
                             util.runCmd2(['vgremove', '-f', vgs_label])
                     util.runCmd2(['vgcreate', self.vgs_output, storage_part])
+                    invalidateLVMSnapshot()
 
                     if self.storage_type == 'ext':
                         _, sr_uuid = self.vgs_output.split('-', 1)
                         util.runCmd2(['lvcreate', '-n', sr_uuid, '-l', '100%VG', self.vgs_output])
+                        invalidateLVMSnapshot()
                         try:
                             util.mkfs('ext3', '/dev/' + self.vgs_output + '/' + sr_uuid, ['-F'])
                         except Exception as e:
@@ -303,6 +369,102 @@ class ThirdGenUpgrader(Upgrader):
                         new_partition_layout = True
                         return new_partition_layout
 
+    # Inventory keys that must match for an existing backup to be updated
+    # in place rather than replaced
+    backup_reuse_keys = ['INSTALLATION_UUID', 'CONTROL_DOMAIN_UUID', 'PLATFORM_VERSION', 'BUILD_NUMBER']
+
+    def reusableBackup(self, backup_partition):
+        """ Returns True if backup_partition already holds a backup of the
+        installation being upgraded, e.g. from an earlier attempt, that can be
+        brought up to date instead of copying everything again. """
+        try:
+            inventory = product.readBackupInventory(backup_partition)
+        except Exception as e:
+            logger.log("No existing backup on %s: %s" % (backup_partition, e))
+            return False
+        if inventory is None:
+            return False
+        for key in self.backup_reuse_keys:
+            if inventory.get(key) != self.source.inventory.get(key):
+                logger.log("Existing backup on %s has a different %s, replacing it" % (backup_partition, key))
+                return False
+        return True
+
+    def planBackup(self, tool, backup_partition, logs_partnum, partition_table_type):
+        """ Returns (repartition, incremental): whether doBackup grows the
+        backup partition into a new partition layout, and whether it updates
+        the backup already on it rather than formatting it. """
+        repartition = (self.safe2upgrade and tool.getPartition(logs_partnum) is None and
+                       partition_table_type == constants.PARTITION_GPT)
+        incremental = not repartition and self.reusableBackup(backup_partition)
+        return repartition, incremental
+
+    def imageBackupSize(self, incremental, boot_mounted, available):
+        """ Returns the size of the image doBackup takes of the root
+        filesystem, or None if it copies its files instead: when updating a
+        backup, when /boot is a separate filesystem, or when the image would
+        not fit in available bytes. """
+        if incremental or not self.backup_image or boot_mounted:
+            return None
+        try:
+            size = fsimage.imageSize(self.source.root_device)
+        except (IOError, OSError) as e:
+            logger.log("Cannot image %s: %s" % (self.source.root_device, e))
+            return None
+        if size is None or size + self.backup_image_margin >= available:
+            return None
+        return size
+
+    def estimate(self):
+        """ Predicts the duration of doBackup and prepareTarget from the size
+        of the root filesystem and the throughput of the root and backup
+        partitions, which are only read. """
+        tool = PartitionTool(self.source.primary_disk)
+        # partition numbering as backend.inspectTargetDisk works it out
+        primary_partnum = tool.partitionNumber(self.source.root_device)
+        backup_partition = partitionDevice(self.source.primary_disk, primary_partnum + 1)
+        repartition, incremental = self.planBackup(tool, backup_partition, primary_partnum + 4,
+                                                   tool.partTableType)
+        if repartition:
+            backup_bytes = constants.backup_size * 2**20
+        else:
+            _, backup_bytes = getBlockDeviceSize(backup_partition)
+
+        read_rate = estimate.readThroughput(self.source.root_device) or estimate.DEFAULT_THROUGHPUT
+        # The backup partition may hold the only copy of a backup, so nothing
+        # is written to it: writes are assumed to be as fast as reads
+        write_rate = estimate.readThroughput(backup_partition) or read_rate
+
+        result = estimate.Estimate()
+        primary_fs = util.TempMount(self.source.root_device, 'primary-', options=['ro'], boot_device=self.source.boot_device)
+        try:
+            tree = estimate.measureTree(primary_fs.mount_point)
+            image_size = self.imageBackupSize(incremental, primary_fs.boot_mounted, backup_bytes)
+        finally:
+            primary_fs.unmount()
+
+        if incremental:
+            # only changed files are copied, but both trees are scanned
+            result.add('Backup update', tree.bytes, 2 * tree.files * tree.scan_cost)
+        elif image_size is not None:
+            result.add('Backup image', image_size, estimate.copySeconds(image_size, 0, read_rate, write_rate))
+        else:
+            result.add('Backup', tree.bytes,
+                       estimate.copySeconds(tree.bytes, tree.files, read_rate, write_rate, tree.scan_cost))
+
+        if repartition:
+            # prepareTarget writes the new partition table and recreates the
+            # local SR, formatting it if it is an ext SR
+            mkfs_bytes = 0
+            storage_partnum = primary_partnum + 2
+            if self.storage_type == 'ext' and tool.getPartition(storage_partnum):
+                _, sr_bytes = getBlockDeviceSize(partitionDevice(self.source.primary_disk, storage_partnum))
+                mkfs_bytes = estimate.mkfsBytes(sr_bytes)
+            result.add('Repartition', mkfs_bytes,
+                       estimate.REPARTITION_SECONDS + mkfs_bytes / float(write_rate))
+        result.log('upgrade of %s' % self.source)
+        return result
+
     doBackupArgs = ['primary-disk', 'backup-partnum', 'boot-partnum', 'storage-partnum', 'logs-partnum', 'partition-table-type']
     doBackupStateChanges = []
     def doBackup(self, progress_callback, target_disk, backup_partnum, boot_partnum, storage_partnum, logs_partnum, partition_table_type):
@@ -310,10 +472,11 @@ class ThirdGenUpgrader(Upgrader):
         tool = PartitionTool(target_disk)
         boot_part = tool.getPartition(boot_partnum)
         boot_device = partitionDevice(target_disk, boot_partnum) if boot_part else None
-        logs_partition = tool.getPartition(logs_partnum)
+        backup_partition = partitionDevice(target_disk, backup_partnum)
+        repartition, incremental = self.planBackup(tool, backup_partition, logs_partnum, partition_table_type)
 
         # Check if possible to create new partition layout, increasing the size, using plugin result
-        if self.safe2upgrade and logs_partition is None and partition_table_type == constants.PARTITION_GPT:
+        if repartition:
             if storage_partnum > 0:
                 # Get current Volume Group
                 rc, out = util.runCmd2(['pvs', '-o', 'pv_name,vg_name', '--noheadings'], with_stdout=True)
@@ -329,6 +492,7 @@ class ThirdGenUpgrader(Upgrader):
                     # Remove LVM Phisical Volume
                     storage_part = partitionDevice(target_disk, storage_partnum)
                     util.runCmd2(['pvremove', storage_part])
+                    invalidateLVMSnapshot()
                 # Delete LVM partition
                 tool.deletePartition(storage_partnum)
             # Resize backup partition
@@ -336,12 +500,17 @@ class ThirdGenUpgrader(Upgrader):
             # Write partition table
             tool.commit(log=True)
 
-        # format the backup partition:
-        backup_partition = partitionDevice(target_disk, backup_partnum)
-        try:
-            util.mkfs('ext3', backup_partition)
-        except Exception as e:
-            raise RuntimeError("Backup: Failed to format filesystem on %s: %s" % (backup_partition, e))
+        # format the backup partition, unless it can be updated in place:
+        def format_backup():
+            try:
+                util.mkfs('ext3', backup_partition)
+            except Exception as e:
+                raise RuntimeError("Backup: Failed to format filesystem on %s: %s" % (backup_partition, e))
+
+        if incremental:
+            logger.log("Updating the existing backup on %s" % backup_partition)
+        else:
+            format_backup()
         progress_callback(10)
 
         # copy the files across:
@@ -350,40 +519,58 @@ class ThirdGenUpgrader(Upgrader):
             backup_fs = util.TempMount(backup_partition, 'backup-')
             try:
                 just_dirs = ['dev', 'proc', 'lost+found', 'sys']
-                top_dirs = os.listdir(primary_fs.mount_point)
-                val = 10
-                for x in top_dirs:
-                    if x in just_dirs:
-                        path = os.path.join(backup_fs.mount_point, x)
-                        if not os.path.exists(path):
-                            os.mkdir(path, 0755)
+
+                def copy_progress(copied, total, eta):
+                    progress_callback(10 + 89 * copied / max(total, 1),
+                                      "Backing up: " + fscopy.formatProgress(copied, total, eta))
+
+                def copy_tree(update):
+                    tree = fscopy.TreeCopy(primary_fs.mount_point, backup_fs.mount_point, just_dirs,
+                                           update=update)
+                    tree.scan()
+                    tree.copy(copy_progress)
+
+                st = os.statvfs(backup_fs.mount_point)
+                image_size = self.imageBackupSize(incremental, primary_fs.boot_mounted, st.f_bavail * st.f_frsize)
+
+                try:
+                    if image_size is not None:
+                        fsimage.createImage(self.source.root_device, backup_fs.mount_point, copy_progress)
+                        # keep the inventory alongside so the backup can be found
+                        inventory = os.path.join(backup_fs.mount_point, constants.INVENTORY_FILE)
+                        util.assertDir(os.path.dirname(inventory))
+                        shutil.copy2(os.path.join(primary_fs.mount_point, constants.INVENTORY_FILE), inventory)
+                    elif incremental:
+                        # so an interrupted update is not mistaken for a backup
+                        os.unlink(os.path.join(backup_fs.mount_point, '.xen-backup-partition'))
+                        try:
+                            copy_tree(True)
+                        except (IOError, OSError) as e:
+                            logger.log("Updating the existing backup failed, making a new one: %s" % e)
+                            backup_fs.unmount()
+                            format_backup()
+                            backup_fs = util.TempMount(backup_partition, 'backup-')
+                            copy_tree(False)
                     else:
-                        cmd = ['cp', '-a'] + \
-                              [ os.path.join(primary_fs.mount_point, x) ] + \
-                              ['%s/' % backup_fs.mount_point]
-                        if util.runCmd2(cmd) != 0:
-                            raise RuntimeError("Backup of %s directory failed" % x)
-                    val += 90 / len(top_dirs)
-                    progress_callback(val)
+                        copy_tree(False)
+                except (IOError, OSError) as e:
+                    raise RuntimeError("Backup of existing installation failed: %s" % e)
 
                 if partition_table_type == constants.PARTITION_GPT:
                     # save the GPT table
                     rc, err = util.runCmd2(["sgdisk", "-b", os.path.join(backup_fs.mount_point, '.xen-gpt.bin'), target_disk], with_stderr=True)
                     if rc != 0:
                         raise RuntimeError("Failed to save partition layout: %s" % err)
-            finally:
-                # replace rolling pool upgrade bootloader config
-                def replace_config(config_file, destination):
-                    src = os.path.join(backup_fs.mount_point, constants.ROLLING_POOL_DIR, config_file)
-                    if os.path.exists(src):
-                        util.runCmd2(['cp', '-f', src, os.path.join(backup_fs.mount_point, destination)])
 
-                map(replace_config, ('efi-grub.cfg', 'grub.cfg', 'menu.lst', 'extlinux.conf'),
-                                    ('boot/efi/EFI/xenserver/grub.cfg', 'boot/grub',
-                                     'boot/grub', 'boot'))
+                # replace rolling pool upgrade bootloader config; for an image
+                # this is done when it is restored
+                replaceRollingPoolConfig(backup_fs.mount_point)
 
+                # only a complete backup is marked as one
                 fh = open(os.path.join(backup_fs.mount_point, '.xen-backup-partition'), 'w')
                 fh.close()
+            finally:
+                # a no-op if the update fallback already unmounted it
                 backup_fs.unmount()
         finally:
             primary_fs.unmount()
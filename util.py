@@ -12,6 +12,7 @@
 
 import os
 import os.path
+import sys
 import subprocess
 import urllib
 import urllib2
@@ -24,6 +25,15 @@ import random
 import string
 import tempfile
 import errno
+import select
+import threading
+import Queue
+import itertools
+import collections
+try:
+    import ctypes, ctypes.util
+except ImportError:
+    ctypes = None
 from version import *
 from xcp import logger
 
@@ -69,48 +79,175 @@ def copyFilesFromDir(sourcedir, dest):
 ###
 # shell
 
-def runCmd2(command, with_stdout=False, with_stderr=False, inputtext=None):
+# Lines of each stream of a command's output kept in the log from its start
+# and from its end; when there are more the full output is written to a file
+# in CMD_OUTPUT_DIR instead
+CMD_LOG_HEAD_LINES = 100
+CMD_LOG_TAIL_LINES = 100
+CMD_OUTPUT_DIR = '/tmp/cmd-output'
+CMD_READ_SIZE = 65536
+
+_cmd_sequence = itertools.count(1)
+
+class _CommandOutput:
+    """ One output stream of a command, split into lines as it is read.  Only
+    the first and last lines are held for the log. """
+    def __init__(self, spill_path, line_callback, keep):
+        self.spill_path = spill_path
+        self.line_callback = line_callback
+        self.data = [] if keep else None
+        self.bytes = 0
+        self.partial = ''
+        self.head = []
+        self.tail = collections.deque()
+        self.omitted = 0
+        self.spill = None
+
+    def feed(self, data):
+        self.bytes += len(data)
+        if self.data is not None:
+            self.data.append(data)
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self._line(line)
+
+    def close(self, flush=True):
+        """ Closes the spill file, first passing on any last line without a
+        newline unless flush is False """
+        if flush and self.partial:
+            self._line(self.partial)
+            self.partial = ''
+        if self.spill:
+            self.spill.close()
+
+    def _line(self, line):
+        if self.line_callback:
+            self.line_callback(line)
+        if self.spill:
+            self.spill.write(line + '\n')
+        if len(self.head) < CMD_LOG_HEAD_LINES:
+            self.head.append(line)
+            return
+        self.tail.append(line)
+        if len(self.tail) > CMD_LOG_TAIL_LINES:
+            if not self.spill:
+                try:
+                    os.makedirs(os.path.dirname(self.spill_path))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                self.spill = open(self.spill_path, 'w')
+                self.spill.write('\n'.join(self.head + list(self.tail)) + '\n')
+            self.tail.popleft()
+            self.omitted += 1
+
+    def output(self):
+        return ''.join(self.data)
 
-    cmd = subprocess.Popen(command, bufsize=1,
+    def text(self):
+        lines = self.head
+        if self.omitted:
+            lines = lines + ["... %d lines omitted, full output in %s ..." % (self.omitted, self.spill_path)]
+        return '\n'.join(lines + list(self.tail))
+
+def _writeInput(pipe, inputtext):
+    try:
+        try:
+            pipe.write(inputtext)
+        finally:
+            pipe.close()
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+
+def runCmdStream(command, stdout_callback=None, stderr_callback=None, inputtext=None,
+                 with_stdout=False, with_stderr=False):
+    """ Runs command, reading its output as it is produced.  Each line of
+    standard output and standard error is passed, without its newline, to
+    stdout_callback and stderr_callback respectively.  The full output is
+    only held in memory if with_stdout or with_stderr ask for it to be
+    returned, as runCmd2 does; the log gets the first and last lines. """
+
+    started = time.time()
+    cmd = subprocess.Popen(command,
                            stdin=(inputtext and subprocess.PIPE or None),
                            stdout=subprocess.PIPE,
                            stderr=subprocess.PIPE,
                            shell=isinstance(command, str),
                            close_fds=True)
 
-#     if inputtext:
-#      (out, err) = cmd.communicate(inputtext)
-#         rv = cmd.returncode
-#     else:
-#         (stdout, stderr) = (cmd.stdout, cmd.stderr)
-#         for line in stdout:
-#             out += line
-#         for line in stderr:
-#             err += line
-#         rv = cmd.wait()
-
-    # the above has a deadlock condition.
-    # The following should suffice in all cases
-    (out, err) = cmd.communicate(inputtext)
-    rv = cmd.returncode
-
-    l = "ran %s; rc %d" % (str(command), rv)
+    name = os.path.basename(isinstance(command, str) and command.split()[0] or command[0])
+    spill_path = os.path.join(CMD_OUTPUT_DIR, '%04d-%s' % (_cmd_sequence.next(), name))
+    out = _CommandOutput(spill_path + '.out', stdout_callback, with_stdout)
+    err = _CommandOutput(spill_path + '.err', stderr_callback, with_stderr)
+    streams = {cmd.stdout.fileno(): out, cmd.stderr.fileno(): err}
+
+    writer = None
+    if inputtext:
+        writer = threading.Thread(target=_writeInput, args=(cmd.stdin, inputtext))
+        writer.start()
+
+    finished = False
+    try:
+        pending = streams.keys()
+        while pending:
+            try:
+                ready, _, _ = select.select(pending, [], [])
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                data = os.read(fd, CMD_READ_SIZE)
+                if data:
+                    streams[fd].feed(data)
+                else:
+                    pending.remove(fd)
+        finished = True
+    finally:
+        if not finished:
+            # a line callback or the spill file failed: with nothing reading
+            # its output the command could block forever, so stop it, and
+            # close the pipes on anything it started through the shell
+            try:
+                cmd.kill()
+            except OSError:
+                pass
+            cmd.stdout.close()
+            cmd.stderr.close()
+        # picked up by cmdprofile when profiling
+        cmd.output_bytes = out.bytes + err.bytes
+        rv = cmd.wait()
+        if writer:
+            writer.join()
+        # after a failure only the spill files are closed, so that a line
+        # callback raising again cannot hide the original exception
+        out.close(finished)
+        err.close(finished)
+
+    l = "ran %s; rc %d; %.2fs" % (str(command), rv, time.time() - started)
     if inputtext:
         l += " with input %s" % inputtext
-    if out != "":
-        l += "\nSTANDARD OUT:\n" + out
-    if err != "":
-        l += "\nSTANDARD ERROR:\n" + err
+    text = out.text()
+    if text != "":
+        l += "\nSTANDARD OUT:\n" + text
+    text = err.text()
+    if text != "":
+        l += "\nSTANDARD ERROR:\n" + text
     logger.log(l)
 
     if with_stdout and with_stderr:
-        return rv, out, err
+        return rv, out.output(), err.output()
     elif with_stdout:
-        return rv, out
+        return rv, out.output()
     elif with_stderr:
-        return rv, err
+        return rv, err.output()
     return rv
 
+def runCmd2(command, with_stdout=False, with_stderr=False, inputtext=None):
+    return runCmdStream(command, inputtext=inputtext, with_stdout=with_stdout, with_stderr=with_stderr)
+
 ###
 # make file system
 
@@ -367,6 +504,91 @@ def udevtriggerCmd():
 def udevinfoCmd():
     return udevadmCmd('info')
 
+def parallelMap(func, items, parallel=8):
+    """Returns [func(item) for item in items], calling func from up to parallel
+    threads at once.  Results are in the order of items.  If any call raises,
+    the exception from the earliest item is re-raised once all calls are done."""
+    items = list(items)
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    pending = Queue.Queue()
+    for index in range(len(items)):
+        pending.put(index)
+
+    def worker():
+        while True:
+            try:
+                index = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(items[index])
+            except Exception:
+                errors[index] = sys.exc_info()
+
+    threads = [threading.Thread(target=worker) for _ in range(min(parallel, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
+
+IN_ATTRIB = 0x004
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = os.O_NONBLOCK
+
+def inotifyWatch(dirs):
+    """Returns an inotify fd watching dirs for entries appearing, disappearing or
+    changing, or None if inotify is not available"""
+    if ctypes is None:
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    for d in dirs:
+        if os.path.isdir(d):
+            libc.inotify_add_watch(fd, d, mask)
+    return fd
+
+def waitForCondition(condition, watch_dirs=['/dev'], timeout=30, poll_interval=0.5):
+    """Waits until condition() returns True.  Rather than waiting for udev to
+    process every pending event, condition is re-checked whenever an entry in
+    one of watch_dirs changes, and at least every poll_interval seconds.
+    Returns False if timeout seconds pass first."""
+    deadline = time.time() + timeout
+    fd = inotifyWatch(watch_dirs)
+    try:
+        while not condition():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if fd is None:
+                time.sleep(min(remaining, poll_interval))
+                continue
+            ready, _, _ = select.select([fd], [], [], min(remaining, poll_interval))
+            if ready:
+                try:
+                    while os.read(fd, 4096):
+                        pass
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+        return True
+    finally:
+        if fd is not None:
+            os.close(fd)
+
 def randomLabelStr():
     return "".join([random.choice(string.ascii_lowercase) for x in range(6)])
 
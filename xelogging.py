@@ -18,6 +18,8 @@ import fcntl
 import datetime
 import traceback
 import constants
+import cmdprofile
+import util
 
 
 def collectLogs(dst, tarball_dir=None):
@@ -46,8 +48,13 @@ def collectLogs(dst, tarball_dir=None):
             shutil.copy("/tmp/install-log", dst)
         if os.path.exists(constants.SCRIPTS_DIR):
             os.system("cp -r "+constants.SCRIPTS_DIR+" %s/" % dst)
-    logs = filter(lambda x: x.endswith('-log') or x == 'answerfile' or
-                  x.startswith(os.path.basename(constants.SCRIPTS_DIR)), os.listdir(dst))
+        # full output of the commands whose log entries were cut short
+        if os.path.exists(util.CMD_OUTPUT_DIR):
+            os.system("cp -r "+util.CMD_OUTPUT_DIR+" %s/" % dst)
+    cmdprofile.writeReport(dst)
+    logs = filter(lambda x: x.endswith('-log') or x == 'answerfile' or x == cmdprofile.TRACE_FILE or
+                  x.startswith(os.path.basename(constants.SCRIPTS_DIR)) or
+                  x == os.path.basename(util.CMD_OUTPUT_DIR), os.listdir(dst))
     logs = " ".join(logs)
 
     if os.path.exists(tarball_dir):